@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import numpy
+
+def get_segment_length(signal_length, nsegments):
+  """gets the length of the segments in the Welch procedure.
+
+  The segments are such that there are nsegments 50% overlapping
+  segments in the signal (8 being Matlab's default).
+
+  Parameters
+  ----------
+  signal_length: int
+    The length of the signal.
+  nsegments: int
+    The number of overlapping segments.
+
+  Returns
+  -------
+  segment_length: int
+    The length of the segments.
+
+  """
+  return (2*signal_length) // (nsegments + 1)
+
+def get_segments(signal, nperseg):
+  """gets the 50% overlapping segments of a signal.
+
+  The segments are the ones used by :py:func:`scipy.signal.welch`
+  (with its default overlap): the trail of the signal that does not
+  fill a whole segment is discarded.
+
+  Parameters
+  ----------
+  signal: numpy.ndarray
+    The signal (or a stack of signals, along the last axis).
+  nperseg: int
+    The length of the segments.
+
+  Returns
+  -------
+  segments: numpy.ndarray
+    The segments, of shape (..., n_segments, nperseg). This is a
+    (read-only) view on the signal.
+
+  """
+  step = nperseg - nperseg // 2
+  from numpy.lib.stride_tricks import sliding_window_view
+  return sliding_window_view(signal, nperseg, axis=-1)[..., ::step, :]
+
+def get_band_frequencies(resolution, min_freq=0.7, max_freq=4.0):
+  """gets the frequencies of a band, at the given resolution.
+
+  The frequencies are strictly inside the band.
+
+  Parameters
+  ----------
+  resolution: float
+    The spacing between the frequencies, in beats per minute.
+  min_freq: float
+    The lower bound of the band, in Hertz.
+  max_freq: float
+    The upper bound of the band, in Hertz.
+
+  Returns
+  -------
+  frequencies: numpy.ndarray
+    The frequencies, in Hertz.
+
+  """
+  step = resolution / 60.0
+  frequencies = min_freq + step * numpy.arange(1, int(numpy.ceil((max_freq - min_freq) / step)) + 1)
+  return frequencies[frequencies < max_freq]
+
+def compute_periodograms(segments, fs, nfft=None, frequencies=None):
+  """computes the periodograms of segments.
+
+  The periodograms are the ones averaged in :py:func:`scipy.signal.welch`
+  (with its default parameters): the mean of each segment is removed,
+  segments are weighted by a Hann window, and the one-sided power
+  spectral density is computed.
+
+  The spectrum is computed either on the nfft-points FFT grid, or only
+  at the given frequencies (with a zoom FFT, see
+  :py:class:`scipy.signal.ZoomFFT`), which is much cheaper when only
+  a narrow band is of interest.
+
+  Parameters
+  ----------
+  segments: numpy.ndarray
+    The segments, of shape (..., nperseg).
+  fs: float
+    The sampling frequency.
+  nfft: int
+    The number of points of the FFT (if frequencies are not given).
+  frequencies: numpy.ndarray
+    Regularly spaced frequencies where the spectrum is evaluated,
+    in Hertz (not including 0 and the Nyquist frequency).
+
+  Returns
+  -------
+  frequencies: numpy.ndarray
+    The frequencies of the periodograms.
+  periodograms: numpy.ndarray
+    The periodograms, of shape (..., n_frequencies).
+
+  """
+  from scipy.signal import get_window
+  nperseg = segments.shape[-1]
+  window = get_window('hann', nperseg)
+  scale = 1.0 / (fs * numpy.sum(window**2))
+  windowed = (segments - numpy.mean(segments, axis=-1, keepdims=True)) * window
+
+  if frequencies is None:
+    if nfft is None:
+      nfft = nperseg
+    spectrum = numpy.fft.rfft(windowed, nfft, axis=-1)
+    frequencies = numpy.fft.rfftfreq(nfft, 1.0 / fs)
+    periodograms = scale * numpy.abs(spectrum)**2
+    # one-sided spectrum: double everything but DC (and Nyquist)
+    if nfft % 2:
+      periodograms[..., 1:] *= 2
+    else:
+      periodograms[..., 1:-1] *= 2
+  else:
+    from scipy.signal import ZoomFFT
+    step = frequencies[1] - frequencies[0] if frequencies.shape[0] > 1 else 1.0
+    zoom = ZoomFFT(nperseg, [frequencies[0], frequencies[0] + step * frequencies.shape[0]],
+        m=frequencies.shape[0], fs=fs)
+    spectrum = zoom(windowed, axis=-1)
+    periodograms = 2 * scale * numpy.abs(spectrum)**2
+  return frequencies, periodograms
+
+def welch(signal, fs, nperseg, nfft=None, frequencies=None):
+  """estimates the power spectral density using Welch's method.
+
+  This is the same as :py:func:`scipy.signal.welch` (with a Hann window
+  and 50% overlapping segments), but the spectrum can be evaluated only
+  at the given frequencies (see :py:func:`compute_periodograms`).
+
+  Parameters
+  ----------
+  signal: numpy.ndarray
+    The signal (or a stack of signals, along the last axis).
+  fs: float
+    The sampling frequency.
+  nperseg: int
+    The length of the segments.
+  nfft: int
+    The number of points of the FFT (if frequencies are not given).
+  frequencies: numpy.ndarray
+    Regularly spaced frequencies where the spectrum is evaluated, in Hertz.
+
+  Returns
+  -------
+  frequencies: numpy.ndarray
+    The frequencies of the spectrum.
+  psd: numpy.ndarray
+    The power spectral density.
+
+  """
+  segments = get_segments(numpy.asarray(signal, dtype='float64'), nperseg)
+  frequencies, periodograms = compute_periodograms(segments, fs, nfft, frequencies)
+  return frequencies, numpy.mean(periodograms, axis=-2)
+
+def get_nfft(nperseg):
+  """gets the number of points of the FFT for a segment length.
+
+  This is the smallest power of two which is not smaller than the 
+  length of the segments.
+
+  Parameters
+  ----------
+  nperseg: int
+    The length of the segments.
+
+  Returns
+  -------
+  nfft: int
+    The number of points of the FFT.
+
+  """
+  return 1 << int(max(nperseg - 1, 0)).bit_length()
+
+def find_peak_frequency(frequencies, psd, min_freq=0.7, max_freq=4.0, interpolation='none'):
+  """finds the frequency of the maximum of the spectrum in a band.
+
+  The band does not include its bounds. The location of the maximum
+  can be refined between the frequency bins, by fitting a parabola to 
+  the spectrum ('parabolic') or to its logarithm ('gaussian') around
+  the maximum. With a Hann window, the latter is almost exact for 
+  a sine, so that a coarse FFT grid can be used.
+
+  Parameters
+  ----------
+  frequencies: numpy.ndarray
+    The (regularly spaced) frequencies of the spectrum.
+  psd: numpy.ndarray
+    The power spectral density (or a stack of them, along the last axis).
+  min_freq: float
+    The lower bound of the band, in Hertz.
+  max_freq: float
+    The upper bound of the band, in Hertz.
+  interpolation: str
+    The interpolation of the peak: 'none', 'parabolic' or 'gaussian'.
+
+  Returns
+  -------
+  frequency: float or numpy.ndarray
+    The frequency of the peak, in Hertz.
+
+  """
+  band = numpy.flatnonzero((frequencies > min_freq) & (frequencies < max_freq))
+  index = band[0] + numpy.argmax(psd[..., band[0]:band[-1]+1], axis=-1)
+  if interpolation == 'none':
+    return frequencies[index]
+  if interpolation not in ('parabolic', 'gaussian'):
+    raise ValueError("Unknown peak interpolation `{0}'".format(interpolation))
+
+  # the values around the peak (the peak itself at the edges of the spectrum)
+  last = psd.shape[-1] - 1
+  index = numpy.asarray(index)
+  around = numpy.stack([numpy.maximum(index - 1, 0), index, numpy.minimum(index + 1, last)], axis=-1)
+  values = numpy.take_along_axis(psd, around, axis=-1)
+  if interpolation == 'gaussian':
+    values = numpy.log(numpy.maximum(values, numpy.finfo('float64').tiny))
+  left, center, right = values[..., 0], values[..., 1], values[..., 2]
+
+  # the vertex of the parabola, in bins (none when the peak is flat or at an edge)
+  curvature = left - 2 * center + right
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    delta = numpy.where(curvature < 0, 0.5 * (left - right) / curvature, 0.0)
+  delta = numpy.clip(delta, -0.5, 0.5)
+  step = frequencies[1] - frequencies[0]
+  return frequencies[index] + delta * step
+
+def compute_heart_rate_trace(signal, fs, window, hop, nperseg, nfft=None, frequencies=None, min_freq=0.7, max_freq=4.0, interpolation='none'):
+  """computes the heart-rate on a sliding window.
+
+  The heart-rate on each window is found with Welch's method, on the
+  segments of length nperseg taken every hop samples inside the window.
+  The periodogram of each segment is computed only once: the spectrum
+  of a window is obtained from the one of the previous window by adding
+  the periodogram of the new segment and removing the one of the oldest
+  segment (using a cumulative sum of the periodograms).
+
+  Parameters
+  ----------
+  signal: numpy.ndarray
+    The signal.
+  fs: float
+    The sampling frequency.
+  window: int
+    The length of the sliding window, in samples.
+  hop: int
+    The step between two windows (and two segments), in samples.
+  nperseg: int
+    The length of the segments (at most the length of the window).
+  nfft: int
+    The number of points of the FFT (if frequencies are not given).
+  frequencies: numpy.ndarray
+    Regularly spaced frequencies where the spectrum is evaluated, in Hertz.
+  min_freq: float
+    The lower bound of the heart-rate band, in Hertz.
+  max_freq: float
+    The upper bound of the heart-rate band, in Hertz.
+  interpolation: str
+    The interpolation of the peaks (see :py:func:`find_peak_frequency`).
+
+  Returns
+  -------
+  times: numpy.ndarray
+    The time of the center of each window, in seconds.
+  heart_rates: numpy.ndarray
+    The heart-rate on each window, in beats per minute.
+
+  """
+  signal = numpy.asarray(signal, dtype='float64')
+  n_windows = max(0, (signal.shape[0] - window) // hop + 1)
+  if n_windows == 0:
+    return numpy.zeros(0), numpy.zeros(0)
+
+  from numpy.lib.stride_tricks import sliding_window_view
+  segments = sliding_window_view(signal, nperseg)[::hop]
+  frequencies, periodograms = compute_periodograms(segments, fs, nfft, frequencies)
+
+  # only the band of interest is needed (and its neighbours, for the interpolation)
+  band = numpy.flatnonzero((frequencies > min_freq) & (frequencies < max_freq))
+  band = slice(max(band[0] - 1, 0), band[-1] + 2)
+  frequencies = frequencies[band]
+  cumulative = numpy.zeros((periodograms.shape[0] + 1, frequencies.shape[0]), dtype='float64')
+  numpy.cumsum(periodograms[:, band], axis=0, out=cumulative[1:])
+
+  # sum of the periodograms of the segments in each window
+  per_window = (window - nperseg) // hop + 1
+  sums = cumulative[per_window:per_window + n_windows] - cumulative[:n_windows]
+  heart_rates = find_peak_frequency(frequencies, sums, min_freq, max_freq, interpolation) * 60.0
+  times = (numpy.arange(n_windows) * hop + window / 2.0) / fs
+  return times, heart_rates
+
+def get_heart_rates_file(hrdir):
+  """gets the file containing the table of heart-rates in a directory.
+
+  Parameters
+  ----------
+  hrdir: str
+    The directory where heart-rates are stored.
+
+  Returns
+  -------
+  filename: str
+    The file containing the table of heart-rates.
+
+  """
+  return os.path.join(hrdir, 'heart_rates.txt')
+
+def save_heart_rates(hrdir, paths, heart_rates, hashes=None):
+  """saves heart-rates in a single table.
+
+  The table is a text file, with the path of an object, its heart-rate
+  (in beats per minute) and the hash of what it was computed from (see
+  :py:func:`bob.rppg.base.store_utils.get_parameters_hash`) on each line.
+  The rows are merged into the existing table: the rows of other objects
+  (e.g. of another subset) are kept.
+
+  Parameters
+  ----------
+  hrdir: str
+    The directory where heart-rates are stored.
+  paths: list of str
+    The paths of the objects.
+  heart_rates: list of float
+    The heart-rates, for each object.
+  hashes: list of str
+    The hash of the parameters of each heart-rate (if None, the rows
+    have no hash).
+
+  """
+  if not os.path.exists(hrdir):
+    import bob.io.base
+    bob.io.base.create_directories_safe(hrdir)
+  table = load_heart_rates(hrdir, with_hashes=True) or {}
+  if hashes is None:
+    hashes = [None] * len(paths)
+  for path, hr, h in zip(paths, heart_rates, hashes):
+    table[path] = (float(hr), h)
+
+  # the table is replaced at once, such that it is never partially written
+  import tempfile
+  filename = get_heart_rates_file(hrdir)
+  fd, tmpname = tempfile.mkstemp(suffix='.txt', prefix='.heart_rates-', dir=hrdir)
+  try:
+    with os.fdopen(fd, 'w') as f:
+      for path in sorted(table.keys()):
+        hr, h = table[path]
+        if h is None:
+          f.write("{0} {1!r}\n".format(path, hr))
+        else:
+          f.write("{0} {1!r} {2}\n".format(path, hr, h))
+    os.rename(tmpname, filename)
+  except Exception:
+    if os.path.exists(tmpname): os.remove(tmpname)
+    raise
+
+def load_heart_rates(hrdir, with_hashes=False):
+  """loads the table of heart-rates of a directory.
+
+  Parameters
+  ----------
+  hrdir: str
+    The directory where heart-rates are stored.
+  with_hashes: bool
+    If the hash of the parameters of each heart-rate is also returned.
+
+  Returns
+  -------
+  heart_rates: dict
+    The heart-rates (or, with hashes, the tuples of the heart-rate and 
+    its hash, which is None for a row without hash), indexed by the paths 
+    of the objects, or None if there is no table in this directory.
+
+  """
+  filename = get_heart_rates_file(hrdir)
+  if not os.path.exists(filename):
+    return None
+  heart_rates = {}
+  with open(filename, 'r') as f:
+    for line in f:
+      if not line.strip():
+        continue
+      # rows written before the hashes were added only have two fields
+      fields = line.rsplit(None, 2)
+      try:
+        path, hr, h = fields[0], float(fields[1]), fields[2]
+        int(h, 16)
+      except (IndexError, ValueError) as e:
+        path, hr = line.rsplit(None, 1)
+        hr, h = float(hr), None
+      heart_rates[path] = (hr, h) if with_hashes else hr
+  return heart_rates
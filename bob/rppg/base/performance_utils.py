@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import numpy
+
+def get_database_version(database):
+  """gets the version of the package providing a database.
+
+  Parameters
+  ----------
+  database: object
+    The database.
+
+  Returns
+  -------
+  version: str
+    The name of the database class, and the version of its package 
+    (if it is found).
+
+  """
+  import pkg_resources
+  module = type(database).__module__
+  name = '{0}.{1}'.format(module, type(database).__name__)
+  parts = module.split('.')
+  for i in range(len(parts), 0, -1):
+    try:
+      return '{0}-{1}'.format(name, pkg_resources.require('.'.join(parts[:i]))[0].version)
+    except (pkg_resources.DistributionNotFound, ValueError) as e:
+      continue
+  return name
+
+
+class GroundTruthCache(object):
+  """caches the real heart-rates of the objects of a database.
+
+  The real heart-rate of an object is computed (see
+  ``load_heart_rate_in_bpm``) the first time it is requested, and 
+  re-used afterwards. The heart-rates are saved to, and loaded from, 
+  a text file. They are only valid for a given version of the database:
+  the ones of another version are discarded when loaded.
+
+  Attributes
+  ----------
+  version: str
+    The version of the database (see :py:func:`get_database_version`).
+  heart_rates: dict
+    The real heart-rates, indexed by the paths of the objects.
+  modified: bool
+    If new heart-rates have been computed since the last save (or load).
+
+  """
+
+  def __init__(self, filename=None, version=''):
+    """Constructor
+
+    Parameters
+    ----------
+    filename: str
+      The file to load the heart-rates from, if it exists.
+    version: str
+      The version of the database.
+
+    """
+    self.version = str(version)
+    self.heart_rates = {}
+    self.modified = False
+    if filename and os.path.exists(filename):
+      self.load(filename)
+
+  def __len__(self):
+    return len(self.heart_rates)
+
+  def __call__(self, obj):
+    """gets the real heart-rate of an object, computing it if not already done.
+
+    Parameters
+    ----------
+    obj: object
+      The object of the database.
+
+    Returns
+    -------
+    heart_rate: float
+      The real heart-rate, in beats per minute.
+
+    """
+    if obj.path not in self.heart_rates:
+      self.heart_rates[obj.path] = float(obj.load_heart_rate_in_bpm())
+      self.modified = True
+    return self.heart_rates[obj.path]
+
+  def save(self, filename):
+    """saves all the heart-rates into a text file.
+
+    The first line contains the version of the database, and the 
+    following ones the path of an object and its heart-rate.
+
+    Parameters
+    ----------
+    filename: str
+      The file.
+
+    """
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+      import bob.io.base
+      bob.io.base.create_directories_safe(dirname)
+    with open(filename, 'w') as f:
+      f.write("# {0}\n".format(self.version))
+      for path in sorted(self.heart_rates.keys()):
+        f.write("{0} {1!r}\n".format(path, self.heart_rates[path]))
+    self.modified = False
+
+  def load(self, filename):
+    """loads heart-rates from a text file.
+
+    The loaded heart-rates are added to the ones already in the cache,
+    unless they were computed for another version of the database.
+
+    Parameters
+    ----------
+    filename: str
+      The file.
+
+    Returns
+    -------
+    valid: bool
+      If the heart-rates were computed for this version of the database.
+
+    """
+    with open(filename, 'r') as f:
+      version = f.readline()[2:].rstrip('\n')
+      if version != self.version:
+        return False
+      for line in f:
+        if line.strip():
+          path, hr = line.rsplit(None, 1)
+          self.heart_rates[path] = float(hr)
+    self.modified = False
+    return True
+
+
+def load_results(objects, hrdir, heart_rates=None, jobs=1, ground_truth_cache=None):
+  """loads the computed heart-rates and the ground truth of objects.
+
+  The heart-rates are either taken from a table (see
+  :py:func:`bob.rppg.base.frequency_utils.load_heart_rates`), or
+  loaded for each object which is not in the table (see 
+  :py:func:`bob.rppg.base.store_utils.load_signal`).
+  Files are loaded concurrently by a pool of threads, since the time 
+  spent in loading them is mostly waiting for the storage.
+
+  Parameters
+  ----------
+  objects: list
+    The objects of the database.
+  hrdir: str
+    The directory where heart-rates are stored.
+  heart_rates: dict
+    The table of heart-rates, indexed by the paths of the objects
+    (if None, all heart-rates are loaded from the files).
+  jobs: int
+    The number of threads used to load the files.
+  ground_truth_cache: :py:class:`GroundTruthCache`
+    The cache of real heart-rates (if None, they are computed).
+
+  Returns
+  -------
+  inferred: numpy.ndarray
+    The computed heart-rate of each object (NaN if not available).
+  ground_truth: numpy.ndarray
+    The real heart-rate of each object (NaN if no heart-rate was computed).
+
+  """
+  inferred = numpy.full(len(objects), numpy.nan, dtype='float64')
+  ground_truth = numpy.full(len(objects), numpy.nan, dtype='float64')
+
+  def _load(i):
+    obj = objects[i]
+    if heart_rates is not None and obj.path in heart_rates:
+      inferred[i] = heart_rates[obj.path]
+    else:
+      from .store_utils import load_signal
+      try:
+        inferred[i] = load_signal(obj, hrdir)[0]
+      except (IOError, RuntimeError) as e:
+        return
+    if ground_truth_cache is not None:
+      ground_truth[i] = ground_truth_cache(obj)
+    else:
+      ground_truth[i] = obj.load_heart_rate_in_bpm()
+
+  if jobs > 1:
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(jobs)
+    try:
+      pool.map(_load, range(len(objects)))
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    for i in range(len(objects)):
+      _load(i)
+
+  return inferred, ground_truth
+
+def compute_statistics(inferred, ground_truth):
+  """computes the performance measures of heart-rate estimation.
+
+  Parameters
+  ----------
+  inferred: numpy.ndarray
+    The computed heart-rates.
+  ground_truth: numpy.ndarray
+    The real heart-rates.
+
+  Returns
+  -------
+  rmse: float
+    The root mean squared error.
+  mean_error_percentage: float
+    The mean of the absolute error relative to the real heart-rate.
+  correlation: float
+    The Pearson's correlation between computed and real heart-rates.
+  p: float
+    The significance of the correlation.
+
+  """
+  from scipy.stats import pearsonr
+  inferred = numpy.asarray(inferred, dtype='float64')
+  ground_truth = numpy.asarray(ground_truth, dtype='float64')
+  errors = inferred - ground_truth
+  rmse = numpy.sqrt(numpy.mean(errors**2))
+  mean_error_percentage = numpy.mean(numpy.abs(errors) / ground_truth)
+  correlation, p = pearsonr(inferred, ground_truth)
+  return rmse, mean_error_percentage, correlation, p
+
+def get_statistics_text(rmse, mean_error_percentage, correlation, p):
+  """gets the description of the performance measures.
+
+  Parameters
+  ----------
+  rmse: float
+    The root mean squared error.
+  mean_error_percentage: float
+    The mean of the absolute error relative to the real heart-rate.
+  correlation: float
+    The Pearson's correlation between computed and real heart-rates.
+  p: float
+    The significance of the correlation.
+
+  Returns
+  -------
+  lines: list of str
+    The description of each performance measure.
+
+  """
+  return ["Root Mean Squared Error = {0:.2f}".format(rmse),
+          "Mean of error-rate percentage = {0:.2f}".format(mean_error_percentage),
+          "Pearson's correlation = {0:.2f} ({1:.2f} significance)".format(correlation, p)]
+
+def compute_bootstrap_statistics(inferred, ground_truth, n_resamples=1000, chunk_size=0, seed=0):
+  """computes the performance measures on bootstrap resamples.
+
+  For each resample, objects are drawn with replacement, and the root
+  mean squared error, the mean error percentage and the Pearson's 
+  correlation are computed (see :py:func:`compute_statistics`). The
+  measures of all resamples in a chunk are computed at once, from 
+  the matrix of the indices of the drawn objects. The resamples do 
+  not depend on the size of the chunks.
+
+  Parameters
+  ----------
+  inferred: numpy.ndarray
+    The computed heart-rates.
+  ground_truth: numpy.ndarray
+    The real heart-rates.
+  n_resamples: int
+    The number of resamples.
+  chunk_size: int
+    The number of resamples processed at once, to bound the memory
+    (all of them if zero).
+  seed: int
+    The seed of the random number generator.
+
+  Returns
+  -------
+  statistics: numpy.ndarray
+    The root mean squared error, the mean error percentage and the 
+    Pearson's correlation of each resample, of shape (n_resamples, 3).
+
+  """
+  inferred = numpy.asarray(inferred, dtype='float64')
+  ground_truth = numpy.asarray(ground_truth, dtype='float64')
+  n = inferred.shape[0]
+  if chunk_size <= 0:
+    chunk_size = n_resamples
+  rng = numpy.random.RandomState(seed)
+  statistics = numpy.zeros((n_resamples, 3), dtype='float64')
+  for start in range(0, n_resamples, chunk_size):
+    end = min(start + chunk_size, n_resamples)
+    indices = rng.randint(0, n, size=(end - start, n))
+    x = inferred[indices]
+    y = ground_truth[indices]
+    errors = x - y
+    statistics[start:end, 0] = numpy.sqrt(numpy.mean(errors**2, axis=1))
+    statistics[start:end, 1] = numpy.mean(numpy.abs(errors) / y, axis=1)
+    x -= numpy.mean(x, axis=1, keepdims=True)
+    y -= numpy.mean(y, axis=1, keepdims=True)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      statistics[start:end, 2] = numpy.sum(x * y, axis=1) / numpy.sqrt(numpy.sum(x**2, axis=1) * numpy.sum(y**2, axis=1))
+  return statistics
+
+def get_confidence_intervals(statistics, confidence=0.95):
+  """gets the confidence intervals of bootstrapped performance measures.
+
+  The intervals are the percentile intervals of the measures over the 
+  resamples (resamples with an undefined measure are ignored).
+
+  Parameters
+  ----------
+  statistics: numpy.ndarray
+    The performance measures of each resample, of shape (n_resamples, n_measures)
+    (see :py:func:`compute_bootstrap_statistics`).
+  confidence: float
+    The confidence level.
+
+  Returns
+  -------
+  intervals: numpy.ndarray
+    The lower and upper bounds of the interval of each measure, 
+    of shape (n_measures, 2).
+
+  """
+  alpha = (1.0 - confidence) / 2.0
+  return numpy.nanpercentile(statistics, [100 * alpha, 100 * (1 - alpha)], axis=0).T
+
+def get_confidence_intervals_text(intervals, confidence=0.95):
+  """gets the description of the confidence intervals of the performance measures.
+
+  Parameters
+  ----------
+  intervals: numpy.ndarray
+    The confidence intervals of the root mean squared error, the mean error
+    percentage and the Pearson's correlation (see :py:func:`get_confidence_intervals`).
+  confidence: float
+    The confidence level.
+
+  Returns
+  -------
+  lines: list of str
+    The description of each confidence interval.
+
+  """
+  names = ["Root Mean Squared Error", "Mean of error-rate percentage", "Pearson's correlation"]
+  return ["{0} {1:g}% confidence interval = [{2:.2f}, {3:.2f}]".format(name, 100 * confidence, low, high)
+      for name, (low, high) in zip(names, intervals)]
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import hashlib
+import json
+import logging
+logger = logging.getLogger("bob.rppg.base")
+
+from .store_utils import get_parameters_hash
+from .store_utils import is_up_to_date
+from .store_utils import load_signal
+from .store_utils import save_signal
+
+class Stage(object):
+  """a step of a pipeline, computing signals from other signals.
+
+  The function of a stage is called with an object, its input signals
+  and the parameters of the stage, and returns its output signals (a
+  tuple if there are several outputs), or None if the object should be
+  skipped. A batch stage processes all its objects at once: its function
+  is called with the list of objects and the list of their inputs, and
+  returns the list of their outputs.
+
+  Attributes
+  ----------
+  name: str
+    The name of the stage.
+  inputs: list of str
+    The names of the input signals.
+  outputs: list of str
+    The names of the output signals.
+  function: callable
+    The processing.
+  parameters: dict
+    The parameters of the processing (passed as keyword arguments).
+  batch: bool
+    If all the objects are processed at once.
+  all_objects: bool
+    If the inputs of all the objects are needed to compute the outputs
+    of any of them (e.g. to compute a statistic on the whole set). Such
+    a stage is also a batch stage.
+
+  """
+
+  def __init__(self, name, inputs, outputs, function, parameters=None, batch=False, all_objects=False):
+    """Constructor
+
+    Parameters
+    ----------
+    name: str
+      The name of the stage.
+    inputs: list of str
+      The names of the input signals.
+    outputs: list of str
+      The names of the output signals.
+    function: callable
+      The processing.
+    parameters: dict
+      The parameters of the processing.
+    batch: bool
+      If all the objects are processed at once.
+    all_objects: bool
+      If the inputs of all the objects are needed.
+
+    """
+    self.name = name
+    self.inputs = list(inputs)
+    self.outputs = list(outputs)
+    self.function = function
+    self.parameters = dict(parameters or {})
+    self.batch = batch or all_objects
+    self.all_objects = all_objects
+
+  def __call__(self, objects, inputs):
+    """processes objects.
+
+    Parameters
+    ----------
+    objects: list
+      The objects of the database.
+    inputs: list of tuple
+      The input signals of each object.
+
+    Returns
+    -------
+    outputs: list of tuple
+      The output signals of each object (None for a skipped object).
+
+    """
+    if self.batch:
+      results = self.function(objects, inputs, **self.parameters)
+    else:
+      results = [self.function(obj, *signals, **self.parameters) for obj, signals in zip(objects, inputs)]
+    if len(self.outputs) == 1:
+      results = [None if r is None else (r,) for r in results]
+    return results
+
+
+class Pipeline(object):
+  """chains stages, passing the signals from one stage to the next in memory.
+
+  The stages are sorted such that each one comes after the stages
+  computing its inputs. Only the requested signals (the targets) are
+  saved, and a signal is only computed if it is needed to get a target
+  which is not up-to-date. A signal is up-to-date if it was saved with
+  the same hash (see :py:meth:`get_hashes`), which covers the parameters
+  of its stage, the hashes of its inputs and their saved signals: changing
+  a parameter, or saving an input signal again, recomputes the signals of
+  the stage and all the signals depending on them. An intermediate
+  signal which was saved by a previous run (and is up-to-date) is loaded
+  instead of being computed again.
+
+  Attributes
+  ----------
+  stages: list of :py:class:`Stage`
+    The stages, in the order they are run.
+  producers: dict
+    The stage computing each signal, indexed by the name of the signal.
+
+  """
+
+  def __init__(self, stages):
+    """Constructor
+
+    Parameters
+    ----------
+    stages: list of :py:class:`Stage`
+      The stages (in any order).
+
+    Raises
+    ------
+    ValueError
+      If a signal is computed by several stages, or if an input cannot be
+      computed (it is not an output of another stage, or the stages depend
+      on each other).
+
+    """
+    self.producers = {}
+    for stage in stages:
+      for name in stage.outputs:
+        if name in self.producers:
+          raise ValueError("Signal `{0}' is computed by stages `{1}' and `{2}'".format(name, self.producers[name].name, stage.name))
+        self.producers[name] = stage
+
+    # topological sort: a stage is added once all its inputs are available
+    self.stages = []
+    available = set()
+    remaining = list(stages)
+    while remaining:
+      ready = [s for s in remaining if all([i in available for i in s.inputs])]
+      if not ready:
+        raise ValueError("Cannot compute the inputs of stages {0}".format(', '.join([s.name for s in remaining])))
+      for stage in ready:
+        self.stages.append(stage)
+        available.update(stage.outputs)
+        remaining.remove(stage)
+
+  def get_hashes(self, objects, directories=None):
+    """computes the hash of each signal of each object.
+
+    The hash of a signal of a stage without inputs is the hash of its
+    parameters, as computed by the scripts running the stage alone (see
+    :py:func:`bob.rppg.base.store_utils.get_parameters_hash`): the signals
+    they saved are hence re-used. For the other stages, the hashes of the
+    inputs are added to the parameters, and, if the stage needs all the
+    objects, the paths of the objects.
+
+    Parameters
+    ----------
+    objects: list
+      The objects of the database.
+    directories: dict
+      The directory of each signal which can be saved or loaded, indexed
+      by the name of the signal. The entries of the inputs of a stage in
+      the manifests of their directories are also added to its hash, such
+      that its signals change when an input signal is saved again (e.g. by
+      the script running the previous stage alone).
+
+    Returns
+    -------
+    hashes: dict
+      The list of the hashes of a signal (one per object), indexed by the
+      name of the signal.
+
+    """
+    hashes = {}
+    for stage in self.stages:
+      stage_hashes = self._get_stage_hashes(stage, objects, hashes, directories or {})
+      for name in stage.outputs:
+        hashes[name] = stage_hashes
+    return hashes
+
+  def _get_stage_hashes(self, stage, objects, hashes, directories):
+    """computes the hashes of the signals of a stage, given the hashes of its inputs."""
+    if not stage.inputs:
+      return [get_parameters_hash(stage.parameters)] * len(objects)
+
+    # what the inputs of each object are computed from, and what they are
+    inputs = [directories[name] for name in stage.inputs if name in directories]
+    keys = [get_parameters_hash(dict(inputs=[hashes[name][i] for name in stage.inputs]), obj, inputs)
+        for i, obj in enumerate(objects)]
+    if stage.all_objects:
+      paths = [obj.path for obj in objects]
+      parameters = dict(stage.parameters, inputs=[k for __, k in sorted(zip(paths, keys))],
+          objects=hashlib.sha1(json.dumps(sorted(paths)).encode('utf-8')).hexdigest())
+      return [get_parameters_hash(parameters)] * len(objects)
+    return [get_parameters_hash(dict(stage.parameters, inputs=k)) for k in keys]
+
+  def run(self, objects, directories, targets, store=False, overwrite=False):
+    """computes and saves the targets of objects.
+
+    Parameters
+    ----------
+    objects: list
+      The objects of the database.
+    directories: dict
+      The directory of each signal which can be saved or loaded, indexed
+      by the name of the signal.
+    targets: list of str
+      The names of the signals to save.
+    store: bool
+      If the signals are saved in the store of their directory.
+    overwrite: bool
+      If all the needed signals are computed again, even if up-to-date.
+
+    Returns
+    -------
+    computed: dict
+      The number of objects processed by each stage, indexed by its name.
+
+    Raises
+    ------
+    ValueError
+      If a target is unknown, or has no directory.
+
+    """
+    for name in targets:
+      if name not in self.producers:
+        raise ValueError("Unknown signal `{0}' (possible signals: {1})".format(name, ', '.join(sorted(self.producers.keys()))))
+      if name not in directories:
+        raise ValueError("No directory to save signal `{0}'".format(name))
+    hashes = self.get_hashes(objects, directories)
+
+    def _is_up_to_date(name, i):
+      return name in directories and not overwrite and is_up_to_date(objects[i], directories[name], hashes[name][i])
+
+    # find what is needed, from the targets back to the first stages: for
+    # each stage, the indices of the objects to compute, and for each
+    # signal, the indices of the objects to load
+    compute = dict([(stage.name, set()) for stage in self.stages])
+    load = dict([(name, set()) for name in self.producers])
+
+    def _require(name, i):
+      stage = self.producers[name]
+      if i in compute[stage.name] or i in load[name]:
+        return
+      if _is_up_to_date(name, i):
+        load[name].add(i)
+        return
+      compute[stage.name].add(i)
+      for input_name in stage.inputs:
+        _require(input_name, i)
+
+    for name in targets:
+      for i, obj in enumerate(objects):
+        if not _is_up_to_date(name, i):
+          _require(name, i)
+        else:
+          logger.debug("Signal `%s' of `%s' is up-to-date", name, obj.path)
+
+    # a stage needing all the objects computes all of them (but only the
+    # requested ones are saved)
+    for stage in reversed(self.stages):
+      if stage.all_objects and compute[stage.name]:
+        for i in range(len(objects)):
+          for input_name in stage.inputs:
+            _require(input_name, i)
+
+    # number of stages still to use each signal, to free the memory as soon as possible
+    consumers = dict([(name, 0) for name in self.producers])
+    for stage in self.stages:
+      if compute[stage.name]:
+        for input_name in stage.inputs:
+          consumers[input_name] += 1
+
+    # run the stages, keeping their outputs in memory
+    signals = dict([(name, {}) for name in self.producers])
+    computed = {}
+    for stage in self.stages:
+      indices = sorted(compute[stage.name])
+      if not indices:
+        continue
+      if stage.all_objects:
+        indices = range(len(objects))
+
+      stage_objects = []
+      stage_indices = []
+      stage_inputs = []
+      for i in indices:
+        obj = objects[i]
+        inputs = []
+        for input_name in stage.inputs:
+          if i in signals[input_name]:
+            inputs.append(signals[input_name][i])
+          elif i in load[input_name]:
+            try:
+              inputs.append(load_signal(obj, directories[input_name]))
+            except (IOError, RuntimeError) as e:
+              logger.warn("Skipping file `%s' (no `%s' signal available)", obj.path, input_name)
+              break
+          else:
+            # the object was skipped by a previous stage
+            break
+        if len(inputs) == len(stage.inputs):
+          stage_objects.append(obj)
+          stage_indices.append(i)
+          stage_inputs.append(tuple(inputs))
+
+      logger.info("Running stage `%s' on %d objects...", stage.name, len(stage_objects))
+      results = stage(stage_objects, stage_inputs)
+      computed[stage.name] = len(stage_objects)
+
+      # the inputs saved by the previous stages are now part of the hashes
+      stage_hashes = self._get_stage_hashes(stage, objects, hashes, directories)
+      for name in stage.outputs:
+        hashes[name] = stage_hashes
+
+      for i, obj, outputs in zip(stage_indices, stage_objects, results):
+        if outputs is None:
+          logger.warn("Skipping file `%s' (no `%s' signal computed)", obj.path, stage.name)
+          continue
+        for name, signal in zip(stage.outputs, outputs):
+          signals[name][i] = signal
+          if name in targets and i in compute[stage.name]:
+            output = save_signal(signal, obj, directories[name], store=store, parameters=hashes[name][i])
+            logger.info("Output saved to `%s'...", output)
+
+      # the signals which are not needed anymore are freed
+      for input_name in stage.inputs:
+        consumers[input_name] -= 1
+      for name in stage.inputs + stage.outputs:
+        if consumers[name] == 0:
+          signals[name].clear()
+
+    return computed
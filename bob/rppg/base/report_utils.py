@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import numpy
+
+def get_results_file(resultdir):
+  """gets the file containing the heart-rates used to compute the performances.
+
+  Parameters
+  ----------
+  resultdir: str
+    The directory where the results are stored.
+
+  Returns
+  -------
+  filename: str
+    The file containing the computed and real heart-rates.
+
+  """
+  return os.path.join(resultdir, 'heart_rates.hdf5')
+
+def save_results(resultdir, inferred, ground_truth):
+  """saves the heart-rates used to compute the performances.
+
+  Parameters
+  ----------
+  resultdir: str
+    The directory where the results are stored.
+  inferred: numpy.ndarray
+    The computed heart-rates.
+  ground_truth: numpy.ndarray
+    The real heart-rates.
+
+  """
+  import bob.io.base
+  f = bob.io.base.HDF5File(get_results_file(resultdir), 'w')
+  f.set('inferred', numpy.asarray(inferred, dtype='float64'))
+  f.set('ground_truth', numpy.asarray(ground_truth, dtype='float64'))
+  del f
+
+def load_results(resultdir):
+  """loads the heart-rates used to compute the performances.
+
+  Parameters
+  ----------
+  resultdir: str
+    The directory where the results are stored.
+
+  Returns
+  -------
+  inferred: numpy.ndarray
+    The computed heart-rates.
+  ground_truth: numpy.ndarray
+    The real heart-rates.
+
+  """
+  import bob.io.base
+  f = bob.io.base.HDF5File(get_results_file(resultdir), 'r')
+  inferred = f.read('inferred')
+  ground_truth = f.read('ground_truth')
+  del f
+  return inferred, ground_truth
+
+def save_report(resultdir, inferred, ground_truth, plot=False):
+  """saves the figures describing the performances.
+
+  The figures are the scatter plot of the computed against the real
+  heart-rates, the distribution of the error, and the distributions
+  of the heart-rates. Unless they are also displayed, they are rendered
+  with the (non-interactive) Agg backend.
+
+  Parameters
+  ----------
+  resultdir: str
+    The directory where the figures are stored.
+  inferred: numpy.ndarray
+    The computed heart-rates.
+  ground_truth: numpy.ndarray
+    The real heart-rates.
+  plot: bool
+    If the figures should also be displayed.
+
+  """
+  import matplotlib
+  if not plot:
+    matplotlib.use('Agg')
+  from matplotlib import pyplot
+  errors = numpy.asarray(inferred) - numpy.asarray(ground_truth)
+
+  # scatter plot
+  f = pyplot.figure()
+  ax = f.add_subplot(1,1,1)
+  ax.scatter(ground_truth, inferred)
+  ax.plot([40, 110], [40, 110], 'r--', lw=2)
+  pyplot.xlabel('Ground truth [bpm]')
+  pyplot.ylabel('Estimated heart-rate [bpm]')
+  ax.set_title('Scatter plot')
+  pyplot.savefig(os.path.join(resultdir, 'scatter.png'))
+
+  # histogram of error
+  f2 = pyplot.figure()
+  ax2 = f2.add_subplot(1,1,1)
+  ax2.hist(errors, bins=50, )
+  ax2.set_title('Distribution of the error')
+  pyplot.savefig(os.path.join(resultdir, 'error_distribution.png'))
+
+  # distribution of HR
+  f3 = pyplot.figure()
+  ax3 = f3.add_subplot(1,1,1)
+  histoargs = {'bins': 50, 'alpha': 0.5, 'histtype': 'bar', 'range': (30, 120)}
+  pyplot.hist(ground_truth, label='Real HR', color='g', **histoargs)
+  pyplot.hist(inferred, label='Estimated HR', color='b', **histoargs)
+  pyplot.ylabel("Test set")
+  pyplot.savefig(os.path.join(resultdir, 'hr_distribution.png'))
+
+  if plot:
+    pyplot.show()
+  else:
+    pyplot.close('all')
@@ -7,7 +7,9 @@ Usage:
   %(prog)s <configuration>
            [--protocol=<string>] [--subset=<string> ...] 
            [--verbose ...] [--plot] [--resultdir=<path>] [--hrdir=<path>] 
-           [--overwrite] 
+           [--jobs=<int>] [--breakdown] [--gtcache=<path>] 
+           [--bootstrap=<int>] [--confidence=<float>] [--chunk-size=<int>]
+           [--report] [--table] [--overwrite] 
 
   %(prog)s (--help | -h)
   %(prog)s (--version | -V)
@@ -26,6 +28,30 @@ Options:
                             will be stored [default: results].
   -O, --overwrite           By default, we don't overwrite existing files. 
                             Set this flag if you want to overwrite existing files.
+  -j, --jobs=<int>          Number of threads loading the heart-rate files
+                            concurrently [default: 1].
+  --breakdown               Also compute the statistics on each subset (the
+                            ones given with --subset, or train, dev and test).
+  --gtcache=<path>          File caching the real heart-rates across runs. They
+                            are computed only for the objects not in the file,
+                            or if the version of the database has changed
+                            [default: ].
+  --bootstrap=<int>         Number of bootstrap resamples used to compute the
+                            confidence intervals of the statistics. If set to
+                            zero, no intervals are computed [default: 0].
+  --confidence=<float>      Confidence level of the intervals [default: 0.95].
+  --chunk-size=<int>        Number of bootstrap resamples processed at once, to
+                            bound the memory. If set to zero, all resamples are
+                            processed at once [default: 0].
+  -r, --report              Render the figures (scatter plot, distributions of
+                            the error and of the heart-rates). If the results
+                            already exist, the figures are rendered from the
+                            saved heart-rates, without computing anything.
+  -t, --table               Read the heart-rates from the table computed with
+                            the --batch flag of the frequency analysis
+                            (heart_rates.txt in the heart-rate directory)
+                            instead of the file of each object. Objects which
+                            are not in the table are loaded from their file.
 
 Examples:
 
@@ -49,6 +75,17 @@ from docopt import docopt
 
 from bob.extension.config import load
 from ..utils import get_parameter
+from ..frequency_utils import load_heart_rates
+from ..performance_utils import get_database_version
+from ..performance_utils import GroundTruthCache
+from ..performance_utils import load_results
+from ..performance_utils import compute_statistics
+from ..performance_utils import get_statistics_text
+from ..performance_utils import compute_bootstrap_statistics
+from ..performance_utils import get_confidence_intervals
+from ..performance_utils import get_confidence_intervals_text
+from ..report_utils import get_results_file
+from ..report_utils import save_results
 
 version = pkg_resources.require('bob.rppg.base')[0].version
 
@@ -75,6 +112,14 @@ def main(user_input=None):
   subset = get_parameter(args, configuration, 'subset', None)
   hrdir = get_parameter(args, configuration, 'hrdir', 'hr')
   resultdir = get_parameter(args, configuration, 'resultdir', 'results')
+  jobs = get_parameter(args, configuration, 'jobs', 1)
+  breakdown = get_parameter(args, configuration, 'breakdown', False)
+  gtcache = get_parameter(args, configuration, 'gtcache', '')
+  bootstrap = get_parameter(args, configuration, 'bootstrap', 0)
+  confidence = get_parameter(args, configuration, 'confidence', 0.95)
+  chunk_size = get_parameter(args, configuration, 'chunk_size', 0)
+  report = get_parameter(args, configuration, 'report', False)
+  table = get_parameter(args, configuration, 'table', False)
   overwrite = get_parameter(args, configuration, 'overwrite', False)
   plot = get_parameter(args, configuration, 'plot', False)
   verbosity_level = get_parameter(args, configuration, 'verbose', 0)
@@ -90,103 +135,117 @@ def main(user_input=None):
     logger.error("Please provide a database in your configuration file !")
     sys.exit()
 
-  # errors
-  errors = []
-  rmse = 0;
-  mean_error_percentage = 0
-
-  inferred = []
-  ground_truth = []
-
   ################
   ### LET'S GO ###
   ################
   
-  # if output dir exists and not overwriting, stop 
+  # if output dir exists and not overwriting, stop (or only render the figures)
   if os.path.exists(resultdir) and not overwrite:
+    if report and os.path.exists(get_results_file(resultdir)):
+      from ..report_utils import load_results as load_saved_results
+      from ..report_utils import save_report
+      logger.info("Rendering figures from `%s'...", get_results_file(resultdir))
+      save_report(resultdir, *load_saved_results(resultdir), plot=plot)
+      return 0
     logger.info("Skipping output `%s': already exists, use --overwrite to force an overwrite", resultdir)
     sys.exit()
   else: 
     bob.io.base.create_directories_safe(resultdir)
 
-  for obj in objects:
-
-    # load the heart rate 
-    logger.debug("Loading computed heart rate from `%s'...", obj.path)
-    hr_file = obj.make_path(hrdir, '.hdf5')
-    try:
-      hr = bob.io.base.load(hr_file)
-    except (IOError, RuntimeError) as e:
-      logger.warn("Skipping file `%s' (no heart rate file available)", obj.path)
-      continue
-
-    hr = hr[0]
-    logger.debug("Computed heart rate : {0}".format(hr))
-
-    # load ground truth
-    gt = obj.load_heart_rate_in_bpm()
-    logger.debug("Real heart rate : {0}".format(gt))
-    ground_truth.append(gt)
-    inferred.append(hr)
-    error = hr - gt
-    logger.debug("Error = {0}".format(error))
-    errors.append(error)
-    rmse += error**2
-    mean_error_percentage += numpy.abs(error)/gt
-
-  # compute global statistics 
-  rmse /= len(errors)
-  rmse = numpy.sqrt(rmse)
-  rmse_text = "Root Mean Squared Error = {0:.2f}". format(rmse)
-  mean_error_percentage /= len(errors)
-  mean_err_percent_text = "Mean of error-rate percentage = {0:.2f}". format(mean_error_percentage)
-  from scipy.stats import pearsonr
-  correlation, p = pearsonr(inferred, ground_truth)
-  pearson_text = "Pearson's correlation = {0:.2f} ({1:.2f} significance)". format(correlation, p)
- 
-  logger.info("==================")
-  logger.info("=== STATISTICS ===")
-  logger.info(rmse_text)
-  logger.info(mean_err_percent_text)
-  logger.info(pearson_text)
+  # heart rates computed in batch are stored in a single table, which is
+  # only read if asked (it may not be up-to-date with the files of each object)
+  heart_rates = None
+  if table:
+    heart_rates = load_heart_rates(hrdir)
+    if heart_rates is None:
+      logger.warn("No table of heart rates in `%s', loading the file of each object", hrdir)
+
+  # the real heart rates computed in previous runs
+  ground_truth_cache = None
+  if gtcache:
+    ground_truth_cache = GroundTruthCache(version=get_database_version(configuration.database))
+    if os.path.exists(gtcache):
+      if ground_truth_cache.load(gtcache):
+        logger.info("Loaded {0} real heart rates from `{1}'".format(len(ground_truth_cache), gtcache))
+      else:
+        logger.info("Discarding real heart rates from `%s' (other version of the database)", gtcache)
+
+  # load the computed and real heart rates of all objects
+  logger.info("Loading heart rates of {0} files...".format(len(objects)))
+  inferred, ground_truth = load_results(objects, hrdir, heart_rates, jobs, ground_truth_cache)
+  if ground_truth_cache is not None and ground_truth_cache.modified:
+    ground_truth_cache.save(gtcache)
+    logger.info("Real heart rates saved to `%s'...", gtcache)
+  valid = ~numpy.isnan(inferred)
+  for obj, v in zip(objects, valid):
+    if not v:
+      logger.warn("Skipping file `%s' (no heart rate available)", obj.path)
+  paths = [obj.path for obj, v in zip(objects, valid) if v]
+  inferred = inferred[valid]
+  ground_truth = ground_truth[valid]
+  for path, hr, gt in zip(paths, inferred, ground_truth):
+    logger.debug("`{0}': computed heart rate = {1}, real heart rate = {2}".format(path, hr, gt))
+
+  # the sets on which statistics are computed: all files, and each subset
+  sets = [('all', numpy.arange(len(paths)))]
+  if breakdown:
+    indices = dict((path, i) for i, path in enumerate(paths))
+    for s in (subset if subset else ['train', 'dev', 'test']):
+      subset_indices = [indices[obj.path] for obj in configuration.database.objects(protocol, s) if obj.path in indices]
+      if len(subset_indices) < 2:
+        logger.warn("No statistics for subset `%s' (not enough heart rates)", s)
+        continue
+      sets.append((s, numpy.array(subset_indices)))
+
+  # compute the statistics (and their confidence intervals) on each set
+  lines = []
+  results = {}
+  names = ('rmse', 'mean_error_percentage', 'pearson')
+  for name, set_indices in sets:
+    statistics = compute_statistics(inferred[set_indices], ground_truth[set_indices])
+    set_lines = get_statistics_text(*statistics)
+    results[name] = dict(zip(names + ('pearson_significance',), [float(v) for v in statistics]))
+    results[name]['files'] = len(set_indices)
+    if bootstrap > 0:
+      logger.info("Computing confidence intervals with {0} resamples...".format(bootstrap))
+      resampled = compute_bootstrap_statistics(inferred[set_indices], ground_truth[set_indices], bootstrap, chunk_size)
+      intervals = get_confidence_intervals(resampled, confidence)
+      set_lines.extend(get_confidence_intervals_text(intervals, confidence))
+      results[name]['confidence'] = confidence
+      results[name]['resamples'] = bootstrap
+      results[name]['confidence_intervals'] = dict(zip(names, intervals.tolist()))
+
+    if name == 'all':
+      logger.info("==================")
+      logger.info("=== STATISTICS ===")
+    else:
+      lines.append("")
+      lines.append("Subset {0} ({1} files)".format(name, len(set_indices)))
+      logger.info("=== {0} ===".format(name))
+    for line in set_lines:
+      logger.info(line)
+    lines.extend(set_lines)
 
   # statistics in a text file
   stats_filename = os.path.join(resultdir, 'stats.txt')
   stats_file = open(stats_filename, 'w')
-  stats_file.write(rmse_text + "\n")
-  stats_file.write(mean_err_percent_text + "\n")
-  stats_file.write(pearson_text + "\n")
+  for line in lines:
+    stats_file.write(line + "\n")
   stats_file.close()
 
-  # scatter plot
-  from matplotlib import pyplot
-  f = pyplot.figure()
-  ax = f.add_subplot(1,1,1)
-  ax.scatter(ground_truth, inferred)
-  ax.plot([40, 110], [40, 110], 'r--', lw=2)
-  pyplot.xlabel('Ground truth [bpm]')
-  pyplot.ylabel('Estimated heart-rate [bpm]')
-  ax.set_title('Scatter plot')
-  scatter_file = os.path.join(resultdir, 'scatter.png')
-  pyplot.savefig(scatter_file)
-
-  # histogram of error
-  f2 = pyplot.figure()
-  ax2 = f2.add_subplot(1,1,1)
-  ax2.hist(errors, bins=50, )
-  ax2.set_title('Distribution of the error')
-  distribution_file = os.path.join(resultdir, 'error_distribution.png')
-  pyplot.savefig(distribution_file)
-
-  # distribution of HR
-  f3 = pyplot.figure()
-  ax3 = f3.add_subplot(1,1,1)
-  histoargs = {'bins': 50, 'alpha': 0.5, 'histtype': 'bar', 'range': (30, 120)} 
-  pyplot.hist(ground_truth, label='Real HR', color='g', **histoargs)
-  pyplot.hist(inferred, label='Estimated HR', color='b', **histoargs)
-  pyplot.ylabel("Test set")
-
-  if plot:
-    pyplot.show()
+  # and in a JSON file
+  import json
+  with open(os.path.join(resultdir, 'stats.json'), 'w') as f:
+    json.dump(results, f, indent=2, sort_keys=True)
+
+  # the heart rates, to render the figures later on
+  save_results(resultdir, inferred, ground_truth)
+  logger.info("Heart rates saved to `%s'...", get_results_file(resultdir))
+
+  # figures
+  if report or plot:
+    from ..report_utils import save_report
+    save_report(resultdir, inferred, ground_truth, plot=plot)
+    logger.info("Figures saved to `%s'...", resultdir)
   
   return 0
@@ -8,7 +8,9 @@ Usage:
            [--protocol=<string>] [--subset=<string> ...]  
            [--verbose ...] [--plot] [--pulsedir=<path>] [--hrdir=<path>] 
            [--framerate=<int>] [--nsegments=<int>] [--nfft=<int>] 
-           [--overwrite] 
+           [--resolution=<float>] [--batch]
+           [--window=<float>] [--hop=<float>] [--interpolation=<string>]
+           [--store] [--overwrite] 
 
   %(prog)s (--help | -h)
   %(prog)s (--version | -V)
@@ -33,7 +35,36 @@ Options:
   -f, --framerate=<int>     Frame-rate of the video sequence [default: 61]
   --nsegments=<int>         Number of overlapping segments in Welch procedure
                             [default: 12].
-  --nfft=<int>              Number of points to compute the FFT [default: 8192].
+  --nfft=<int>              Number of points to compute the FFT. If set to zero,
+                            the smallest power of two not smaller than the
+                            segment length is used [default: 8192].
+  --resolution=<float>      Resolution of the spectrum, in beats per minute. If
+                            set, the spectrum is only computed in the band of
+                            plausible heart-rates (and nfft is not used)
+                            [default: 0.0].
+  --batch                   Process all the signals at once: signals of the
+                            same length are analyzed together, and all the
+                            heart-rates are stored in a single table 
+                            (heart_rates.txt in the output directory).
+  --window=<float>          Length of a sliding window, in seconds. If set, the
+                            heart-rate is also computed on each window, and the
+                            resulting trace (time and heart-rate of each window)
+                            is stored alongside the heart-rate of the whole
+                            signal, in a file with a '-trace.hdf5' extension
+                            [default: 0.0].
+  --hop=<float>             Step of the sliding window, in seconds. The spectrum
+                            of a window is the average of the spectra of the
+                            segments starting every hop inside it, so that each
+                            new window only needs the spectrum of one new
+                            segment [default: 1.0].
+  --interpolation=<string>  Interpolation of the peak of the spectrum between
+                            frequency bins: none, parabolic or gaussian. With
+                            gaussian, a small FFT (--nfft=0) is enough to get
+                            an accurate heart-rate [default: none].
+  --store                   Store the heart-rates of all objects in a single
+                            file (signals.hdf5 in the output directory) instead
+                            of one file per object. Pulse signals are read from
+                            such a file if it exists.
 
 Examples:
 
@@ -57,6 +88,20 @@ from docopt import docopt
 
 from bob.extension.config import load
 from ..utils import get_parameter
+from ..frequency_utils import get_segment_length
+from ..frequency_utils import get_band_frequencies
+from ..frequency_utils import welch
+from ..frequency_utils import find_peak_frequency
+from ..frequency_utils import get_nfft
+from ..frequency_utils import compute_heart_rate_trace
+from ..frequency_utils import get_heart_rates_file
+from ..frequency_utils import save_heart_rates
+from ..frequency_utils import load_heart_rates
+from ..store_utils import get_parameters_hash
+from ..store_utils import is_up_to_date
+from ..store_utils import load_signal
+from ..store_utils import save_signal
+from ..store_utils import close_stores
 
 version = pkg_resources.require('bob.rppg.base')[0].version
 
@@ -86,6 +131,12 @@ def main(user_input=None):
   framerate = get_parameter(args, configuration, 'framerate', 61)
   nsegments = get_parameter(args, configuration, 'nsegments', 12)
   nfft = get_parameter(args, configuration, 'nfft', 8192)
+  resolution = get_parameter(args, configuration, 'resolution', 0.0)
+  batch = get_parameter(args, configuration, 'batch', False)
+  window = get_parameter(args, configuration, 'window', 0.0)
+  hop = get_parameter(args, configuration, 'hop', 1.0)
+  interpolation = get_parameter(args, configuration, 'interpolation', 'none')
+  store = get_parameter(args, configuration, 'store', False)
   overwrite = get_parameter(args, configuration, 'overwrite', False)
   plot = get_parameter(args, configuration, 'plot', False)
   verbosity_level = get_parameter(args, configuration, 'verbose', 0)
@@ -101,28 +152,61 @@ def main(user_input=None):
     logger.error("Please provide a database in your configuration file !")
     sys.exit()
 
+  # the frequencies where the spectrum is computed (if only the band of interest is needed)
+  frequencies = None
+  if resolution > 0:
+    frequencies = get_band_frequencies(resolution)
+
+  # the sliding window and its step, in samples
+  window_length = int(round(window * framerate))
+  hop_length = max(1, int(round(hop * framerate)))
+
+  # what the heart-rates are computed from
+  parameters = dict(framerate=framerate, nsegments=nsegments, nfft=nfft, resolution=resolution, interpolation=interpolation)
+
+  if batch:
+    return batch_analysis(objects, pulsedir, hrdir, framerate, nsegments, nfft, frequencies, overwrite, interpolation, parameters)
+
+  # the heart-rate on the sliding window needs enough points for its FFT
+  if window_length > 0:
+    window_segment_length = get_segment_length(window_length, nsegments)
+    window_nfft = nfft if nfft > 0 else get_nfft(window_segment_length)
+    if frequencies is None and window_nfft < window_segment_length:
+      logger.warn("No heart-rate traces (nfft < nperseg on the window)")
+      window_length = 0
+
   ################
   ### LET'S GO ###
   ################
   for obj in objects:
 
-    # expected output file
-    output = obj.make_path(hrdir, '.hdf5')
+    # expected outputs: the heart-rate, and its trace on the sliding window,
+    # with what they are computed from
+    hashes = {'': get_parameters_hash(parameters, obj, [pulsedir])}
+    if window_length > 0:
+      hashes['-trace'] = get_parameters_hash(dict(parameters, window=window, hop=hop), obj, [pulsedir])
 
-    # if output exists and not overwriting, skip this file
-    if os.path.exists(output) and not overwrite:
-      logger.info("Skipping output file `%s': already exists, use --overwrite to force an overwrite", output)
+    # if output exists (and is up-to-date) and not overwriting, skip this file
+    if all([is_up_to_date(obj, hrdir, h, suffix) for suffix, h in hashes.items()]) and not overwrite:
+      logger.info("Skipping output `%s': already exists, use --overwrite to force an overwrite", obj.path)
       continue
 
     # load the filtered color signals of shape (3, nb_frames)
     logger.info("Frequency analysis of color signals from `%s'...", obj.path)
-    filtered_file = obj.make_path(pulsedir, '.hdf5')
     try:
-      signal = bob.io.base.load(filtered_file)
+      signal = load_signal(obj, pulsedir)
     except (IOError, RuntimeError) as e:
       logger.warn("Skipping file `%s' (no color signals file available)", obj.path)
       continue
 
+    # a signal shorter than the window has no trace: only its heart-rate is expected
+    if window_length > signal.shape[0]:
+      logger.warn("No heart-rate trace for `%s' (signal shorter than the window)", obj.path)
+      del hashes['-trace']
+      if is_up_to_date(obj, hrdir, hashes['']) and not overwrite:
+        logger.info("Skipping output `%s': already exists, use --overwrite to force an overwrite", obj.path)
+        continue
+
     if plot:
       from matplotlib import pyplot
       pyplot.plot(range(signal.shape[0]), signal, 'g')
@@ -130,24 +214,18 @@ def main(user_input=None):
       pyplot.show()
 
     # find the segment length, such that we have 8 50% overlapping segments (Matlab's default)
-    segment_length = (2*signal.shape[0]) // (nsegments + 1) 
+    segment_length = get_segment_length(signal.shape[0], nsegments)
+    segment_nfft = nfft if nfft > 0 else get_nfft(segment_length)
 
     # the number of points for FFT should be larger than the segment length ...
-    if nfft < segment_length:
+    if frequencies is None and segment_nfft < segment_length:
       logger.warn("Skipping file `%s' (nfft < nperseg)", obj.path)
       continue
 
-    from scipy.signal import welch
-    green_f, green_psd = welch(signal, framerate, nperseg=segment_length, nfft=nfft)
+    green_f, green_psd = welch(signal, framerate, segment_length, nfft=segment_nfft, frequencies=frequencies)
 
     # find the max of the frequency spectrum in the range of interest
-    first = numpy.where(green_f > 0.7)[0]
-    last = numpy.where(green_f < 4)[0]
-    first_index = first[0]
-    last_index = last[-1]
-    range_of_interest = range(first_index, last_index + 1, 1)
-    max_idx = numpy.argmax(green_psd[range_of_interest])
-    f_max = green_f[range_of_interest[max_idx]]
+    f_max = find_peak_frequency(green_f, green_psd, interpolation=interpolation)
     hr = f_max*60.0
     logger.info("Heart rate = {0}".format(hr))
 
@@ -155,16 +233,101 @@ def main(user_input=None):
       from matplotlib import pyplot
       pyplot.semilogy(green_f, green_psd, 'g')
       xmax, xmin, ymax, ymin = pyplot.axis()
-      pyplot.vlines(green_f[range_of_interest[max_idx]], ymin, ymax, color='red')
+      pyplot.vlines(f_max, ymin, ymax, color='red')
       pyplot.title('Power spectrum of the green signal (HR = {0:.1f})'.format(hr))
       pyplot.show()
 
     output_data = numpy.array([hr], dtype='float64')
 
-    # saves the data into an HDF5 file with a '.hdf5' extension
-    outdir = os.path.dirname(output)
-    if not os.path.exists(outdir): bob.io.base.create_directories_safe(outdir)
-    bob.io.base.save(output_data, output)
-    logger.info("Output file saved to `%s'...", output)
+    # saves the data into an HDF5 file with a '.hdf5' extension (or into the store)
+    output = save_signal(output_data, obj, hrdir, store=store, parameters=hashes[''])
+    logger.info("Output saved to `%s'...", output)
+
+    # the heart-rate on the sliding window
+    if '-trace' in hashes:
+      times, heart_rates = compute_heart_rate_trace(signal, framerate, window_length, hop_length,
+          window_segment_length, nfft=window_nfft, frequencies=frequencies, interpolation=interpolation)
+      logger.info("Heart rate on {0} windows: {1:.1f} +/- {2:.1f}".format(times.shape[0], numpy.mean(heart_rates), numpy.std(heart_rates)))
+
+      if plot:
+        from matplotlib import pyplot
+        pyplot.plot(times, heart_rates, 'g')
+        pyplot.xlabel('time [s]')
+        pyplot.ylabel('heart-rate [bpm]')
+        pyplot.title('Heart-rate on a sliding window of {0} s'.format(window))
+        pyplot.show()
+
+      # the trace is an array of shape (nb_windows, 2): time, heart-rate
+      output = save_signal(numpy.vstack([times, heart_rates]).T.copy(), obj, hrdir, '-trace', store=store, parameters=hashes['-trace'])
+      logger.info("Output saved to `%s'...", output)
+
+  close_stores()
+  return 0
+
+
+def batch_analysis(objects, pulsedir, hrdir, framerate, nsegments, nfft, frequencies, overwrite, interpolation='none', parameters=None):
+  """computes the heart-rates of all objects at once.
+
+  Signals are grouped by length (and hence by segment length), and 
+  the spectra and their peaks are computed for each group at once.
+  All the heart-rates are saved in a single table, with the hash of
+  what they are computed from: only the objects which are not in the
+  table, or whose row is not up-to-date, are processed, and their rows 
+  are merged into the table.
+
+  """
+  output = get_heart_rates_file(hrdir)
+  table = load_heart_rates(hrdir, with_hashes=True) or {}
+  if parameters is None:
+    parameters = dict(framerate=framerate, nsegments=nsegments, nfft=nfft, interpolation=interpolation)
+
+  # the objects whose row is missing or not up-to-date
+  remaining = []
+  hashes = {}
+  for obj in objects:
+    hashes[obj.path] = get_parameters_hash(parameters, obj, [pulsedir])
+    if obj.path in table and table[obj.path][1] == hashes[obj.path] and not overwrite:
+      logger.debug("Skipping output `%s': already in `%s', use --overwrite to force an overwrite", obj.path, output)
+      continue
+    remaining.append(obj)
+  if not remaining:
+    logger.info("Skipping output file `%s': already up-to-date, use --overwrite to force an overwrite", output)
+    return 0
+  objects = remaining
+
+  # load all the signals, and group them by length
+  paths = []
+  groups = {}
+  for obj in objects:
+    try:
+      signal = load_signal(obj, pulsedir)
+    except (IOError, RuntimeError) as e:
+      logger.warn("Skipping file `%s' (no color signals file available)", obj.path)
+      continue
+    paths.append(obj.path)
+    groups.setdefault(signal.shape[0], []).append((len(paths) - 1, signal))
+
+  heart_rates = numpy.zeros(len(paths), dtype='float64')
+  valid = numpy.ones(len(paths), dtype=bool)
+  for length, group in groups.items():
+    indices = [index for index, __ in group]
+    segment_length = get_segment_length(length, nsegments)
+    segment_nfft = nfft if nfft > 0 else get_nfft(segment_length)
+
+    # the number of points for FFT should be larger than the segment length ...
+    if frequencies is None and segment_nfft < segment_length:
+      logger.warn("Skipping {0} files of length {1} (nfft < nperseg)".format(len(indices), length))
+      valid[indices] = False
+      continue
+
+    logger.info("Frequency analysis of {0} signals of length {1}...".format(len(indices), length))
+    signals = numpy.vstack([signal for __, signal in group])
+    green_f, green_psd = welch(signals, framerate, segment_length, nfft=segment_nfft, frequencies=frequencies)
+    heart_rates[indices] = find_peak_frequency(green_f, green_psd, interpolation=interpolation) * 60.0
+
+  paths = [path for path, v in zip(paths, valid) if v]
+  save_heart_rates(hrdir, paths, heart_rates[valid], [hashes[path] for path in paths])
+  logger.info("Heart rates of {0} files saved to `{1}'...".format(len(paths), output))
 
+  close_stores()
   return 0
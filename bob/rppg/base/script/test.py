@@ -20,6 +20,29 @@
 
 import os, sys
 import numpy
+import nose.tools
+import shutil
+import tempfile
+import contextlib
+
+class _Object(object):
+  """a fake object of the database"""
+  def __init__(self, path, gt=None):
+    self.path = path
+    self.gt = gt
+  def make_path(self, directory, extension):
+    return os.path.join(directory, self.path + extension)
+  def load_heart_rate_in_bpm(self):
+    return self.gt
+
+@contextlib.contextmanager
+def _temporary_directory():
+  """creates a temporary directory, removed with its content at the end"""
+  tmpdir = tempfile.mkdtemp()
+  try:
+    yield tmpdir
+  finally:
+    shutil.rmtree(tmpdir)
 
 def test_scale_image():
   """
@@ -44,3 +67,649 @@ def test_crop_face():
   cropped = crop_face(image, bbox, 48)
   assert cropped.shape == (3, 48, 48)
 
+def test_crop_face_buffers():
+  """
+  Test the cropping of a face in provided buffers
+  """
+  image = numpy.random.randint(0, 256, size=(3, 100, 100)).astype('uint8')
+
+  from bob.ip.facedetect import BoundingBox
+  bbox = BoundingBox((20, 20), (50, 50))
+
+  from bob.rppg.base.utils import crop_face, get_face_shape, FaceCropper
+  assert get_face_shape(bbox, 48) == (3, 48, 48)
+  reference = crop_face(image, bbox, 48)
+
+  # uint8 and float32 faces, written in caller-owned arrays
+  face = numpy.zeros((3, 48, 48), dtype='uint8')
+  scaled = numpy.zeros((3, 48, 48), dtype='float64')
+  cropped = crop_face(image, bbox, 48, face, scaled)
+  assert cropped is face
+  assert numpy.array_equal(cropped, reference)
+  face32 = numpy.zeros((3, 48, 48), dtype='float32')
+  cropped = crop_face(image, bbox, 48, face32, scaled)
+  assert cropped.dtype == numpy.float32
+  assert numpy.array_equal(cropped, scaled.astype('float32'))
+
+  # the cropper re-uses its buffer as long as the size does not change
+  cropper = FaceCropper()
+  first = cropper(image, bbox, 48)
+  second = cropper(image, bbox, 48)
+  assert first is second
+  assert numpy.array_equal(second, reference)
+  third = cropper(image, bbox, 24)
+  assert third.shape == (3, 24, 24)
+
+def test_skin_color_lut():
+  """
+  Test the lookup table skin classifier against the skin color filter
+  """
+  from bob.io.base.test_utils import datafile
+  from bob.io.base import load
+  face = load(datafile('001.jpg', 'bob.rppg.base'))
+
+  from bob.ip.skincolorfilter import SkinColorFilter
+  skin_filter = SkinColorFilter()
+  skin_filter.estimate_gaussian_parameters(face)
+
+  from bob.rppg.base.skin_utils import compute_skin_probability, SkinColorLUT
+  probability = compute_skin_probability(face, skin_filter.mean, skin_filter.covariance_inverse)
+  reference = skin_filter.get_skin_mask(face, 0.5)
+  assert numpy.mean((probability > 0.5) == reference) > 0.999
+
+  # with 8 bits per channel, masks are the same
+  lut = SkinColorLUT(skin_filter, 0.5, 8)
+  assert numpy.array_equal(lut.get_skin_mask(face), probability > 0.5)
+
+  # with less bits, masks differ on dark pixels
+  assert SkinColorLUT(skin_filter).bits == 8
+  lut = SkinColorLUT(skin_filter, 0.5, 6)
+  agreement = numpy.mean(lut.get_skin_mask(face) == reference)
+  assert agreement > 0.85 and agreement < 1
+  assert not lut.is_outdated()
+
+  # the table is rebuilt when the model changes
+  skin_filter.estimate_gaussian_parameters(face[:, :50, :50])
+  assert lut.is_outdated()
+  lut.get_skin_mask(face, 0.3)
+  assert not lut.is_outdated()
+  assert lut.threshold == 0.3
+
+def test_online_skin_color_model():
+  """
+  Test the online estimation of the skin color model
+  """
+  from bob.io.base.test_utils import datafile
+  from bob.io.base import load
+  face = load(datafile('001.jpg', 'bob.rppg.base'))
+
+  from bob.ip.skincolorfilter import SkinColorFilter
+  skin_filter = SkinColorFilter()
+
+  from bob.rppg.base.skin_utils import OnlineSkinColorModel
+  model = OnlineSkinColorModel(skin_filter, alpha=0.1)
+
+  # the first update fully estimates the model
+  assert model.update(face)
+  assert model.estimations == 1
+  mean = numpy.copy(skin_filter.mean)
+
+  # same skin color -> no re-estimation, and almost the same model
+  for i in range(5):
+    assert not model.update(face)
+  assert model.estimations == 1
+  assert numpy.allclose(model.mean, mean, atol=1e-2)
+
+  # very different skin color -> re-estimation
+  bluish = numpy.copy(face)
+  bluish[2] = 255 
+  assert model.update(bluish)
+  assert model.estimations == 2
+
+def test_online_skin_color_model_singular():
+  """
+  Test the online estimation of the skin color model on uniform skin
+  """
+  from bob.rppg.base.skin_utils import OnlineSkinColorModel, get_skin_statistics, get_covariance_inverse
+
+  class _SkinFilter(object):
+    def estimate_gaussian_parameters(self, image):
+      count, self.mean, self.covariance = get_skin_statistics(image)
+      self.covariance_inverse = get_covariance_inverse(self.covariance)
+
+  assert numpy.allclose(get_covariance_inverse(numpy.diag([2., 4.])), numpy.diag([0.5, 0.25]))
+  assert not numpy.any(get_covariance_inverse(numpy.ones((2, 2))))
+
+  # a face of uniform chromaticity (only its brightness varies) gives a singular covariance
+  numpy.random.seed(0)
+  brightness = numpy.random.randint(1, 5, size=(40, 40))
+  face = (numpy.array([40, 30, 24])[:, numpy.newaxis, numpy.newaxis] * brightness).astype('uint8')
+  skin_filter = _SkinFilter()
+  model = OnlineSkinColorModel(skin_filter, alpha=0.1)
+  assert model.update(face)
+  for i in range(3):
+    assert not model.update(face)
+  assert model.estimations == 1
+  assert not numpy.any(skin_filter.covariance_inverse)
+
+  # textured skin: the model becomes regular again
+  textured = (face + numpy.random.randint(0, 20, size=face.shape)).astype('uint8')
+  for i in range(3):
+    model.update(textured)
+  assert numpy.any(skin_filter.covariance_inverse)
+
+def test_threshold_statistics():
+  """
+  Test the skin color statistics for several thresholds at once
+  """
+  numpy.random.seed(0)
+  image = numpy.random.randint(0, 256, size=(3, 20, 30)).astype('uint8')
+  probability = numpy.random.rand(20, 30)
+  thresholds = [0.7, 0.2, 0.5, 0.99]
+
+  from bob.rppg.base.skin_utils import compute_threshold_statistics
+  counts, sums, products = compute_threshold_statistics(image, probability, thresholds, second_order=True)
+  for k, t in enumerate(thresholds):
+    pixels = image[:, probability > t].astype('float64')
+    assert counts[k] == pixels.shape[1]
+    assert numpy.allclose(sums[k], numpy.sum(pixels, axis=1))
+    assert numpy.allclose(products[k], numpy.dot(pixels, pixels.T))
+
+  # parsing the list of thresholds
+  from bob.rppg.base.utils import get_list
+  assert get_list('0.3,0.5') == [0.3, 0.5]
+  assert get_list([0.3, 0.5]) == [0.3, 0.5]
+  assert get_list('') == []
+
+def test_zero_phase_filter():
+  """
+  Test the zero-phase filtering against scipy's filtfilt
+  """
+  from scipy.signal import filtfilt
+  from bob.rppg.base.utils import build_bandpass_filter, zero_phase_filter
+  b = build_bandpass_filter(30, 64)
+  signals = numpy.random.randn(2, 1000)
+  reference = filtfilt(b, [1], signals[0])
+
+  for method in ['direct', 'fft', 'auto']:
+    filtered = zero_phase_filter(b, signals[0], method=method)
+    assert numpy.allclose(filtered, reference)
+
+  # several signals at once, along the first axis
+  filtered = zero_phase_filter(b, signals.T, axis=0, method='fft')
+  assert filtered.shape == (1000, 2)
+  assert numpy.allclose(filtered[:, 0], reference)
+
+def test_butterworth_bandpass_filter():
+  """
+  Test the Butterworth bandpass filter, as second-order sections
+  """
+  from scipy.signal import sosfiltfilt, sosfreqz
+  from bob.rppg.base.utils import build_bandpass_filter, zero_phase_filter, get_padlen
+  sos = build_bandpass_filter(30, 4, 0.7, 4.0, design='butter')
+  assert sos.shape == (4, 6)
+
+  # the band edges are honored (-3dB at the cutoff frequencies)
+  w, h = sosfreqz(sos, worN=[0.7, 4.0], fs=30)
+  assert numpy.allclose(numpy.abs(h), numpy.sqrt(0.5))
+
+  # short signals can be filtered
+  b = build_bandpass_filter(30, 128)
+  assert get_padlen(sos) < 100 < get_padlen(b)
+  signal = numpy.random.randn(100)
+  filtered = zero_phase_filter(sos, signal)
+  assert numpy.allclose(filtered, sosfiltfilt(sos, signal))
+
+def test_filter_bank():
+  """
+  Test the memoization of the bandpass filters
+  """
+  from bob.rppg.base.utils import FilterBank, build_bandpass_filter
+  bank = FilterBank()
+  b = bank(30, 64)
+  assert bank.modified
+  assert numpy.array_equal(b, build_bandpass_filter(30, 64))
+
+  # the same design is not built again
+  assert bank(30.0, 64) is b
+  assert len(bank) == 1
+  bank(25, 64)
+  bank(30, 4, design='butter')
+  assert len(bank) == 3
+
+  # save and load the designs
+  with _temporary_directory() as tmpdir:
+    filename = os.path.join(tmpdir, 'filters.hdf5')
+    bank.save(filename)
+    assert not bank.modified
+    loaded = FilterBank(filename)
+    assert len(loaded) == 3
+    assert not loaded.modified
+    assert numpy.array_equal(loaded(30, 4, design='butter'), bank(30, 4, design='butter'))
+    assert not loaded.modified
+
+    # the designs saved by another job are kept
+    other = FilterBank()
+    other(61, 128)
+    other.save(filename)
+    assert len(FilterBank(filename)) == 4
+    assert os.listdir(tmpdir) == ['filters.hdf5']
+
+    # an unreadable file is ignored
+    with open(filename, 'w') as f:
+      f.write('truncated')
+    broken = FilterBank()
+    assert not broken.load(filename)
+    assert len(broken) == 0
+
+def test_welch():
+  """
+  Test the Welch spectrum, on the whole spectrum and in the heart-rate band only
+  """
+  from scipy.signal import welch as scipy_welch
+  from bob.rppg.base.frequency_utils import get_segment_length, get_band_frequencies
+  from bob.rppg.base.frequency_utils import welch, find_peak_frequency
+
+  fs = 61
+  t = numpy.arange(1500) / float(fs)
+  signal = numpy.sin(2 * numpy.pi * 1.25 * t) + 0.5 * numpy.random.randn(1500)
+  nperseg = get_segment_length(1500, 12)
+
+  # same as scipy
+  f, psd = welch(signal, fs, nperseg, nfft=8192)
+  reference_f, reference_psd = scipy_welch(signal, fs, nperseg=nperseg, nfft=8192)
+  assert numpy.allclose(f, reference_f)
+  assert numpy.allclose(psd, reference_psd)
+  hr = find_peak_frequency(f, psd) * 60
+
+  # in the band only, at a resolution of 0.25 bpm
+  frequencies = get_band_frequencies(0.25)
+  assert numpy.all((frequencies > 0.7) & (frequencies < 4.0))
+  f, psd = welch(signal, fs, nperseg, frequencies=frequencies)
+  assert abs(find_peak_frequency(f, psd) * 60 - hr) < 0.5
+  assert abs(find_peak_frequency(f, psd) * 60 - 75) < 1
+
+def test_batch_heart_rates():
+  """
+  Test the heart-rate estimation on several signals at once, and the table of heart-rates
+  """
+  from bob.rppg.base.frequency_utils import welch, find_peak_frequency
+  fs = 61
+  t = numpy.arange(1000) / float(fs)
+  heart_rates = [60., 75., 120.]
+  signals = numpy.vstack([numpy.sin(2 * numpy.pi * (hr / 60.) * t) for hr in heart_rates])
+
+  f, psd = welch(signals, fs, 256, nfft=8192)
+  estimated = find_peak_frequency(f, psd) * 60
+  assert estimated.shape == (3,)
+  for i in range(3):
+    f, psd = welch(signals[i], fs, 256, nfft=8192)
+    assert estimated[i] == find_peak_frequency(f, psd) * 60
+    assert abs(estimated[i] - heart_rates[i]) < 0.5
+
+  from bob.rppg.base.frequency_utils import save_heart_rates, load_heart_rates
+  with _temporary_directory() as tmpdir:
+    assert load_heart_rates(tmpdir) is None
+    paths = ['client01/video01', 'client01/video02', 'client02/video01']
+    save_heart_rates(tmpdir, paths, estimated)
+    loaded = load_heart_rates(tmpdir)
+    assert sorted(loaded.keys()) == paths
+    for path, hr in zip(paths, estimated):
+      assert loaded[path] == hr
+
+    # rows are merged by path, with their hash
+    hashes = ['0' * 40, 'f' * 40]
+    save_heart_rates(tmpdir, ['client01/video02', 'client03/video01'], [80., 90.], hashes)
+    loaded = load_heart_rates(tmpdir, with_hashes=True)
+    assert sorted(loaded.keys()) == sorted(paths + ['client03/video01'])
+    assert loaded['client01/video01'] == (estimated[0], None)
+    assert loaded['client01/video02'] == (80., hashes[0])
+    assert loaded['client03/video01'] == (90., hashes[1])
+    assert load_heart_rates(tmpdir)['client03/video01'] == 90.
+    assert [f for f in os.listdir(tmpdir)] == ['heart_rates.txt']
+
+def test_heart_rate_trace():
+  """
+  Test the heart-rate on a sliding window against Welch's method on each window
+  """
+  from bob.rppg.base.frequency_utils import compute_heart_rate_trace, compute_periodograms, find_peak_frequency
+  fs = 61
+  t = numpy.arange(2000) / float(fs)
+  # the heart-rate goes from 60 to 90 bpm
+  signal = numpy.sin(2 * numpy.pi * numpy.cumsum(1.0 + 0.5 * t / t[-1]) / fs)
+  window, hop, nperseg = 610, 61, 122
+  times, heart_rates = compute_heart_rate_trace(signal, fs, window, hop, nperseg, nfft=4096)
+  assert times.shape == heart_rates.shape == ((2000 - window) // hop + 1,)
+  assert numpy.allclose(times, (numpy.arange(times.shape[0]) * hop + window / 2.) / fs)
+  for k in range(times.shape[0]):
+    segments = numpy.vstack([signal[i:i+nperseg] for i in range(k*hop, k*hop + window - nperseg + 1, hop)])
+    f, p = compute_periodograms(segments, fs, nfft=4096)
+    assert heart_rates[k] == find_peak_frequency(f, numpy.mean(p, axis=0)) * 60
+  assert heart_rates[0] < 70 and heart_rates[-1] > 80
+
+  # the signal is shorter than the window
+  times, heart_rates = compute_heart_rate_trace(signal[:500], fs, window, hop, nperseg)
+  assert times.shape == heart_rates.shape == (0,)
+
+def test_peak_interpolation():
+  """
+  Test the interpolation of the peak of the spectrum between frequency bins
+  """
+  from bob.rppg.base.frequency_utils import get_nfft, welch, find_peak_frequency
+  assert get_nfft(256) == 256
+  assert get_nfft(257) == 512
+  fs = 61
+  t = numpy.arange(1800) / float(fs)
+  heart_rates = numpy.array([52.3, 71.7, 98.1, 143.9])
+  signals = numpy.vstack([numpy.sin(2 * numpy.pi * (hr / 60.) * t) for hr in heart_rates])
+  f, psd = welch(signals, fs, 276, nfft=get_nfft(276))
+  step = (f[1] - f[0]) * 60
+  errors = {}
+  for interpolation in ['none', 'parabolic', 'gaussian']:
+    estimated = find_peak_frequency(f, psd, interpolation=interpolation) * 60
+    errors[interpolation] = numpy.max(numpy.abs(estimated - heart_rates))
+    for i in range(4):
+      assert estimated[i] == find_peak_frequency(f, psd[i], interpolation=interpolation) * 60
+  assert errors['none'] <= step / 2
+  assert errors['parabolic'] < errors['none']
+  assert errors['gaussian'] < 0.1
+  nose.tools.assert_raises(ValueError, find_peak_frequency, f, psd, interpolation='cubic')
+
+def test_load_results():
+  """
+  Test the concurrent loading of heart-rates, and the performance measures
+  """
+  from bob.rppg.base.performance_utils import load_results, compute_statistics
+
+  ground_truth = numpy.linspace(50, 100, 20)
+  objects = [_Object('video{0:02d}'.format(i), gt) for i, gt in enumerate(ground_truth)]
+  heart_rates = dict((obj.path, obj.gt + (-1)**i * i) for i, obj in enumerate(objects) if i != 3)
+
+  serial = load_results(objects, 'hr', heart_rates)
+  parallel = load_results(objects, 'hr', heart_rates, jobs=4)
+  for a, b in zip(serial, parallel):
+    assert numpy.array_equal(numpy.isnan(a), numpy.isnan(b))
+    assert numpy.allclose(a[~numpy.isnan(a)], b[~numpy.isnan(b)])
+  inferred, gt = parallel
+  assert numpy.isnan(inferred[3]) and numpy.isnan(gt[3])
+
+  valid = ~numpy.isnan(inferred)
+  rmse, mean_error_percentage, correlation, p = compute_statistics(inferred[valid], gt[valid])
+  errors = [heart_rates[obj.path] - obj.gt for obj in objects if obj.path in heart_rates]
+  assert numpy.isclose(rmse, numpy.sqrt(numpy.mean(numpy.square(errors))))
+  assert numpy.isclose(mean_error_percentage, numpy.mean(numpy.abs(errors) / ground_truth[valid]))
+  assert numpy.isclose(correlation, numpy.corrcoef(inferred[valid], gt[valid])[0, 1])
+
+def test_ground_truth_cache():
+  """
+  Test the cache of real heart-rates
+  """
+  from bob.rppg.base.performance_utils import GroundTruthCache
+
+  class _CountingObject(_Object):
+    calls = 0
+    def load_heart_rate_in_bpm(self):
+      _CountingObject.calls += 1
+      return self.gt
+
+  objects = [_CountingObject('client{0}/video'.format(i), 60. + i / 3.) for i in range(5)]
+  with _temporary_directory() as tmpdir:
+    filename = os.path.join(tmpdir, 'cache', 'gt.txt')
+    cache = GroundTruthCache(filename, 'db-1.0')
+    assert [cache(obj) for obj in objects] == [obj.gt for obj in objects]
+    assert cache(objects[0]) == objects[0].gt
+    assert _CountingObject.calls == 5 and cache.modified
+    cache.save(filename)
+    assert not cache.modified
+
+    cache = GroundTruthCache(filename, 'db-1.0')
+    assert len(cache) == 5 and not cache.modified
+    assert [cache(obj) for obj in objects] == [obj.gt for obj in objects]
+    assert _CountingObject.calls == 5
+
+    # another version of the database
+    cache = GroundTruthCache(filename, 'db-2.0')
+    assert len(cache) == 0
+    cache(objects[0])
+    assert _CountingObject.calls == 6
+
+def test_bootstrap_statistics():
+  """
+  Test the bootstrap of the performance measures
+  """
+  from bob.rppg.base.performance_utils import compute_statistics, compute_bootstrap_statistics, get_confidence_intervals
+  rng = numpy.random.RandomState(0)
+  ground_truth = rng.uniform(50, 100, 200)
+  inferred = ground_truth + 5 * rng.randn(200)
+
+  statistics = compute_bootstrap_statistics(inferred, ground_truth, 100)
+  assert statistics.shape == (100, 3)
+  # the resamples do not depend on the chunks
+  assert numpy.allclose(statistics, compute_bootstrap_statistics(inferred, ground_truth, 100, chunk_size=30))
+
+  # same as the measures on each resample
+  indices = numpy.random.RandomState(0).randint(0, 200, size=(100, 200))
+  for i in [0, 42, 99]:
+    assert numpy.allclose(statistics[i], compute_statistics(inferred[indices[i]], ground_truth[indices[i]])[:3])
+
+  intervals = get_confidence_intervals(statistics, 0.9)
+  assert intervals.shape == (3, 2)
+  point = compute_statistics(inferred, ground_truth)[:3]
+  assert numpy.all(intervals[:, 0] < point) and numpy.all(point < intervals[:, 1])
+
+def test_report():
+  """
+  Test the figures rendered from the saved heart-rates
+  """
+  from bob.rppg.base.report_utils import save_results, load_results, save_report
+  rng = numpy.random.RandomState(0)
+  ground_truth = rng.uniform(50, 100, 50)
+  inferred = ground_truth + 5 * rng.randn(50)
+  with _temporary_directory() as tmpdir:
+    save_results(tmpdir, inferred, ground_truth)
+    loaded_inferred, loaded_ground_truth = load_results(tmpdir)
+    assert numpy.array_equal(loaded_inferred, inferred)
+    assert numpy.array_equal(loaded_ground_truth, ground_truth)
+    save_report(tmpdir, loaded_inferred, loaded_ground_truth)
+    for figure in ['scatter.png', 'error_distribution.png', 'hr_distribution.png']:
+      assert os.path.exists(os.path.join(tmpdir, figure))
+
+def test_signal_store():
+  """
+  Test the storage of the signals of all objects in a single file
+  """
+  from bob.rppg.base.store_utils import get_store, get_store_file, close_stores
+  from bob.rppg.base.store_utils import has_signal, load_signal, save_signal
+
+  with _temporary_directory() as tmpdir:
+    objects = [_Object('client01/video01'), _Object('client01/video02'), _Object('client02/video01')]
+    signals = [numpy.random.rand(100 + i) for i in range(3)]
+    for obj in objects:
+      assert not has_signal(obj, tmpdir)
+      nose.tools.assert_raises(IOError, load_signal, obj, tmpdir)
+
+    # the first two signals are in the store, the last one in its own file
+    for obj, signal in zip(objects[:2], signals[:2]):
+      assert save_signal(signal, obj, tmpdir, store=True) == get_store_file(tmpdir)
+    save_signal(signals[2], objects[2], tmpdir)
+    assert save_signal(numpy.array([72.]), objects[0], tmpdir, '-hr', store=True) == get_store_file(tmpdir)
+    close_stores()
+    assert os.path.exists(get_store_file(tmpdir))
+    assert not os.path.exists(objects[0].make_path(tmpdir, '.hdf5'))
+    assert os.path.exists(objects[2].make_path(tmpdir, '.hdf5'))
+
+    for obj, signal in zip(objects, signals):
+      assert has_signal(obj, tmpdir)
+      assert numpy.allclose(load_signal(obj, tmpdir), signal)
+    assert numpy.allclose(load_signal(objects[0], tmpdir, '-hr'), [72.])
+    assert not has_signal(objects[1], tmpdir, '-hr')
+
+    # overwrite a signal in the store
+    save_signal(signals[2], objects[0], tmpdir, store=True)
+    assert numpy.allclose(get_store(tmpdir).read(objects[0].path), signals[2])
+    close_stores()
+
+    # several signals at once
+    from bob.rppg.base.store_utils import save_signals
+    assert save_signals(signals[:2], objects[1:], tmpdir, '-pulse', store=True) == [get_store_file(tmpdir)] * 2
+    assert save_signals(signals[:2], objects[1:], tmpdir, '-pulse') == [obj.make_path(tmpdir, '-pulse.hdf5') for obj in objects[1:]]
+    close_stores()
+    for obj, signal in zip(objects[1:], signals[:2]):
+      assert numpy.allclose(load_signal(obj, tmpdir, '-pulse'), signal)
+
+def test_manifest():
+  """
+  Test the index of the signals saved by a stage
+  """
+  from bob.rppg.base.store_utils import get_manifest, get_manifest_file, get_checksum, close_stores
+  from bob.rppg.base.store_utils import has_signal, load_signal, save_signal
+
+  with _temporary_directory() as tmpdir:
+    objects = [_Object('client01/video01'), _Object('client02/video01')]
+    signals = [numpy.random.rand(50), numpy.random.rand(60)]
+    assert not get_manifest(tmpdir).indexed
+    save_signal(signals[0], objects[0], tmpdir, parameters='abc')
+    save_signal(signals[1], objects[1], tmpdir, store=True)
+    close_stores()
+
+    # the manifest is read again, and now indexes the directory
+    manifest = get_manifest(tmpdir)
+    assert os.path.exists(get_manifest_file(tmpdir))
+    assert manifest.indexed and len(manifest) == 2
+    entry = manifest.get(objects[0].path)
+    assert entry['parameters'] == 'abc'
+    assert entry['size'] == signals[0].nbytes
+    assert entry['checksum'] == get_checksum(signals[0])
+    assert entry['location'] == 'file'
+    assert manifest.get(objects[1].path)['location'] == 'store'
+    for obj, signal in zip(objects, signals):
+      assert has_signal(obj, tmpdir)
+      assert numpy.allclose(load_signal(obj, tmpdir), signal)
+
+    # the manifest was created in an empty directory: it is complete, and 
+    # the signals which are not in it are not looked for in their files
+    assert manifest.complete
+    unlisted = _Object('client01/video02')
+    shutil.copy(objects[0].make_path(tmpdir, '.hdf5'), unlisted.make_path(tmpdir, '.hdf5'))
+    assert not has_signal(unlisted, tmpdir)
+    nose.tools.assert_raises(IOError, load_signal, unlisted, tmpdir)
+    close_stores()
+
+    # lines garbled by concurrent appends are skipped, and the manifest is
+    # then not complete anymore
+    unknown = _Object('client03/video01')
+    with open(get_manifest_file(tmpdir), 'a') as f:
+      f.write('{"path": "client03/vi{"checksum": 1\n')
+    save_signal(signals[1], unknown, tmpdir, parameters='def')
+    close_stores()
+    manifest = get_manifest(tmpdir)
+    assert len(manifest) == 3 and not manifest.complete
+    assert manifest.get(unknown.path)['parameters'] == 'def'
+    assert has_signal(unlisted, tmpdir)
+    close_stores()
+
+  with _temporary_directory() as tmpdir:
+    # signals saved before the directory was indexed are looked for in their files
+    import bob.io.base
+    legacy = _Object('client01/video01')
+    bob.io.base.create_directories_safe(os.path.dirname(legacy.make_path(tmpdir, '.hdf5')))
+    bob.io.base.save(signals[0], legacy.make_path(tmpdir, '.hdf5'))
+    save_signal(signals[1], objects[1], tmpdir)
+    close_stores()
+    manifest = get_manifest(tmpdir)
+    assert len(manifest) == 1 and not manifest.complete
+    assert has_signal(legacy, tmpdir)
+    assert numpy.allclose(load_signal(legacy, tmpdir), signals[0])
+    unknown = _Object('client03/video01')
+    assert not has_signal(unknown, tmpdir)
+    nose.tools.assert_raises(IOError, load_signal, unknown, tmpdir)
+    close_stores()
+
+def test_parameters_hash():
+  """
+  Test the detection of the signals computed with other parameters or inputs
+  """
+  from bob.rppg.base.store_utils import get_parameters_hash, is_up_to_date, save_signal, close_stores
+
+  with _temporary_directory() as tmpdir:
+    indir = os.path.join(tmpdir, 'input')
+    outdir = os.path.join(tmpdir, 'output')
+    obj = _Object('client01/video01')
+    parameters = dict(framerate=61, order=128)
+    assert get_parameters_hash(parameters) == get_parameters_hash(dict(order=128, framerate=61))
+    assert get_parameters_hash(parameters) != get_parameters_hash(dict(framerate=61, order=64))
+
+    save_signal(numpy.random.rand(50), obj, indir, parameters='abc')
+    h = get_parameters_hash(parameters, obj, [indir])
+    assert not is_up_to_date(obj, outdir, h)
+    save_signal(numpy.random.rand(50), obj, outdir, parameters=h)
+    close_stores()
+    assert is_up_to_date(obj, outdir, h)
+    assert not is_up_to_date(obj, outdir, get_parameters_hash(dict(framerate=61, order=64), obj, [indir]))
+
+    # the upstream signal changes: the signal has to be computed again
+    save_signal(numpy.random.rand(50), obj, indir, parameters='abc')
+    assert get_parameters_hash(parameters, obj, [indir]) != h
+    assert not is_up_to_date(obj, outdir, get_parameters_hash(parameters, obj, [indir]))
+    close_stores()
+
+def test_pipeline():
+  """
+  Test the chaining of stages, and the incremental recomputation of their signals
+  """
+  from bob.rppg.base.pipeline_utils import Stage, Pipeline
+  from bob.rppg.base.store_utils import load_signal, save_signal, close_stores
+
+  def _source(obj, offset=0):
+    return numpy.arange(10, dtype='float64') + offset
+  def _scale(obj, x, factor=1):
+    return x * factor
+  def _center(objects, inputs):
+    mean = numpy.mean([y for y, in inputs])
+    return [y - mean for y, in inputs]
+
+  def _get_pipeline(factor):
+    return Pipeline([
+        Stage('center', ['y'], ['z'], _center, all_objects=True),
+        Stage('scale', ['x'], ['y'], _scale, dict(factor=factor)),
+        Stage('source', [], ['x'], _source, dict(offset=1)),
+        ])
+
+  nose.tools.assert_raises(ValueError, Pipeline, [Stage('a', ['y'], ['x'], _scale), Stage('b', ['x'], ['y'], _scale)])
+  pipeline = _get_pipeline(2)
+  assert [stage.name for stage in pipeline.stages] == ['source', 'scale', 'center']
+
+  with _temporary_directory() as tmpdir:
+    objects = [_Object('client01/video01'), _Object('client02/video01')]
+    directories = dict([(name, os.path.join(tmpdir, name)) for name in ['x', 'y', 'z']])
+    nose.tools.assert_raises(ValueError, pipeline.run, objects, directories, ['w'])
+
+    # only the requested signals are saved
+    assert pipeline.run(objects, directories, ['x', 'z']) == {'source': 2, 'scale': 2, 'center': 2}
+    close_stores()
+    assert os.path.exists(objects[0].make_path(directories['x'], '.hdf5'))
+    assert not os.path.exists(objects[0].make_path(directories['y'], '.hdf5'))
+    assert numpy.allclose(load_signal(objects[1], directories['z']), numpy.arange(10) * 2 - 9)
+
+    # everything is up-to-date
+    assert pipeline.run(objects, directories, ['x', 'z']) == {}
+
+    # a new parameter: the saved signals of the first stage are re-used
+    assert _get_pipeline(3).run(objects, directories, ['z']) == {'scale': 2, 'center': 2}
+    close_stores()
+    assert numpy.allclose(load_signal(objects[0], directories['z']), numpy.arange(10) * 3 - 13.5)
+
+    # an input saved again with the same parameters (e.g. by the script of
+    # the first stage) makes the signals depending on it out-of-date
+    pipeline = _get_pipeline(3)
+    hashes = pipeline.get_hashes(objects, directories)
+    assert hashes['z'][0] == hashes['z'][1]
+    save_signal(numpy.arange(10, dtype='float64') + 2, objects[1], directories['x'], parameters=hashes['x'][1])
+    close_stores()
+    new_hashes = pipeline.get_hashes(objects, directories)
+    assert new_hashes['x'] == hashes['x'] and new_hashes['y'][0] == hashes['y'][0]
+    assert new_hashes['y'][1] != hashes['y'][1] and new_hashes['z'][0] != hashes['z'][0]
+    assert pipeline.run(objects, directories, ['z']) == {'scale': 2, 'center': 2}
+    close_stores()
+    assert numpy.allclose(load_signal(objects[0], directories['z']), numpy.arange(10) * 3 - 15)
+    assert pipeline.run(objects, directories, ['z']) == {}
@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import numpy
+
+
+def get_chromaticity(image):
+  """computes the normalized rg chromaticity of an image.
+
+  Black pixels (i.e. for which the sum of the channels is zero) get
+  a zero chromaticity, as in :py:class:`bob.ip.skincolorfilter.SkinColorFilter`.
+
+  Parameters
+  ----------
+  image: numpy.ndarray
+    The RGB image (or any array of RGB values, the first dimension being
+    the color channel).
+
+  Returns
+  -------
+  r: numpy.ndarray
+    The normalized red values.
+  g: numpy.ndarray
+    The normalized green values.
+
+  """
+  channel_sum = image[0].astype('float64') + image[1] + image[2]
+  nonzero = channel_sum > 0
+  r = numpy.zeros(channel_sum.shape, dtype='float64')
+  g = numpy.zeros(channel_sum.shape, dtype='float64')
+  numpy.divide(image[0], channel_sum, out=r, where=nonzero)
+  numpy.divide(image[1], channel_sum, out=g, where=nonzero)
+  return r, g
+
+
+def compute_skin_probability(image, mean, covariance_inverse):
+  """computes the skin probability map of an image.
+
+  This is a vectorized version of the probability computed by
+  :py:class:`bob.ip.skincolorfilter.SkinColorFilter`: a (non-normalized)
+  gaussian over the normalized rg chromaticity.
+
+  Parameters
+  ----------
+  image: numpy.ndarray
+    The RGB image (or any array of RGB values, the first dimension being
+    the color channel).
+  mean: numpy.ndarray
+    The mean of the skin color model (in the rg space).
+  covariance_inverse: numpy.ndarray
+    The inverse of the covariance matrix of the skin color model.
+
+  Returns
+  -------
+  probability: numpy.ndarray
+    The skin probability of each pixel.
+
+  """
+  r, g = get_chromaticity(image)
+  r -= mean[0]
+  g -= mean[1]
+  distance = covariance_inverse[0, 0] * r * r
+  distance += (covariance_inverse[0, 1] + covariance_inverse[1, 0]) * r * g
+  distance += covariance_inverse[1, 1] * g * g
+  return numpy.exp(-0.5 * distance)
+
+
+class SkinColorLUT(object):
+  """Lookup table classifier for skin colored pixels.
+
+  The current model of a skin color filter and the threshold on the
+  skin probability are compiled into a table indexed by the quantized RGB
+  values, such that the skin mask of an image is a single lookup. The table
+  is rebuilt only when the parameters of the skin color model (or the
+  threshold) change, i.e. after the model has been re-estimated.
+
+  With 8 bits per channel (the default), the skin masks are the same as
+  the ones given by the skin color filter. With less bits, the probability
+  of each quantization bin is computed at its center, which is a poor
+  estimate for dark pixels (whose chromaticity varies a lot within a bin):
+  on a typical face, the masks agree on about 90% of the pixels with 6
+  bits, and 95% with 7 bits.
+
+  Building the table takes 2^(3 bits) evaluations of the probability,
+  i.e. as many as filtering tens of faces: it only pays off if the model
+  is not re-estimated at each frame.
+
+  Attributes
+  ----------
+  skin_filter: :py:class:`bob.ip.skincolorfilter.SkinColorFilter`
+    The skin color filter holding the model.
+  threshold: float
+    The threshold on the skin probability.
+  bits: int
+    The number of bits per color channel of the table.
+  table: numpy.ndarray
+    The boolean table, flattened.
+
+  """
+
+  def __init__(self, skin_filter, threshold=0.5, bits=8):
+    """init function
+
+    Parameters
+    ----------
+    skin_filter: :py:class:`bob.ip.skincolorfilter.SkinColorFilter`
+      The skin color filter holding the model.
+    threshold: float
+      The threshold on the skin probability.
+    bits: int
+      The number of bits per color channel (between 1 and 8).
+
+    """
+    assert bits > 0 and bits <= 8, "The number of bits per channel should be between 1 and 8"
+    self.skin_filter = skin_filter
+    self.threshold = threshold
+    self.bits = bits
+    self.table = None
+    self._mean = None
+    self._covariance_inverse = None
+
+  def is_outdated(self):
+    """tells if the model of the skin color filter has changed since the table was built.
+
+    Returns
+    -------
+    outdated: bool
+      True if the table has to be rebuilt.
+
+    """
+    if self.table is None:
+      return True
+    return not (numpy.array_equal(self._mean, self.skin_filter.mean) and
+        numpy.array_equal(self._covariance_inverse, self.skin_filter.covariance_inverse))
+
+  def build(self):
+    """builds the table from the current model of the skin color filter.
+
+    The table is filled one red level at a time, to bound the
+    size of the temporary arrays.
+    """
+    self._mean = numpy.copy(self.skin_filter.mean)
+    self._covariance_inverse = numpy.copy(self.skin_filter.covariance_inverse)
+
+    levels = 2**self.bits
+    shift = 8 - self.bits
+    centers = numpy.arange(levels, dtype='float64') * (2**shift) + ((2**shift) - 1) / 2.0
+
+    slab = numpy.zeros((3, levels, levels), dtype='float64')
+    slab[1], slab[2] = numpy.meshgrid(centers, centers, indexing='ij')
+    table = numpy.zeros((levels, levels, levels), dtype='bool')
+    for k in range(levels):
+      slab[0] = centers[k]
+      table[k] = compute_skin_probability(slab, self._mean, self._covariance_inverse) > self.threshold
+    self.table = table.ravel()
+
+  def get_skin_mask(self, image, threshold=None):
+    """gets the skin mask of an image.
+
+    Parameters
+    ----------
+    image: numpy.ndarray
+      The (uint8) RGB image.
+    threshold: float
+      The threshold on the skin probability. If not provided, the
+      threshold given at construction is used.
+
+    Returns
+    -------
+    mask: numpy.ndarray
+      A boolean array of the size of the image, where skin pixels are True.
+
+    """
+    if threshold is not None and threshold != self.threshold:
+      self.threshold = threshold
+      self.table = None
+    if self.is_outdated():
+      self.build()
+
+    shift = 8 - self.bits
+    index = (image[0] >> shift).astype(numpy.intp)
+    index <<= self.bits
+    index |= image[1] >> shift
+    index <<= self.bits
+    index |= image[2] >> shift
+    return self.table[index]
+
+
+def get_skin_statistics(image, radius_ratio=0.4):
+  """computes the statistics of the skin color in a face image.
+
+  As when estimating the model of a :py:class:`bob.ip.skincolorfilter.SkinColorFilter`,
+  the pixels considered are the ones inside a centered disc (of radius
+  ``radius_ratio`` times the face width), whose luma lies in
+  [m - 1.5s, m + s], where m and s are the mean and the standard
+  deviation of the luma inside the disc.
+
+  Parameters
+  ----------
+  image: numpy.ndarray
+    The face image.
+  radius_ratio: float
+    The radius of the disc, relative to the width of the image.
+
+  Returns
+  -------
+  count: int
+    The number of considered pixels.
+  mean: numpy.ndarray
+    The mean of the rg chromaticity of the considered pixels.
+  covariance: numpy.ndarray
+    The (unbiased) covariance matrix of the rg chromaticity.
+
+  """
+  height = image.shape[1]
+  width = image.shape[2]
+  y, x = numpy.ogrid[:height, :width]
+  radius = radius_ratio * width
+  circular_mask = ((y - height / 2.0)**2 + (x - width / 2.0)**2) < radius**2
+
+  luma = 0.299 * image[0] + 0.587 * image[1] + 0.114 * image[2]
+  m = numpy.mean(luma[circular_mask])
+  s = numpy.std(luma[circular_mask])
+  mask = circular_mask & (luma > (m - 1.5*s)) & (luma < (m + s))
+
+  r, g = get_chromaticity(image[:, mask])
+  count = r.shape[0]
+  if count < 2:
+    return count, None, None
+  samples = numpy.vstack((r, g))
+  return count, numpy.mean(samples, axis=1), numpy.cov(samples)
+
+
+def get_covariance_inverse(covariance):
+  """inverts the covariance matrix of a skin color model.
+
+  As in :py:class:`bob.ip.skincolorfilter.SkinColorFilter`, a singular
+  covariance matrix (e.g. estimated on saturated or uniform skin) has
+  a zero inverse.
+
+  Parameters
+  ----------
+  covariance: numpy.ndarray
+    The covariance matrix.
+
+  Returns
+  -------
+  covariance_inverse: numpy.ndarray
+    The inverse of the covariance matrix (zero if it is singular).
+
+  """
+  covariance = numpy.asarray(covariance, dtype='float64')
+  if numpy.linalg.det(covariance) != 0:
+    try:
+      return numpy.linalg.inv(covariance)
+    except numpy.linalg.LinAlgError as e:
+      pass
+  return numpy.zeros_like(covariance)
+
+
+class OnlineSkinColorModel(object):
+  """Online estimation of the model of a skin color filter.
+
+  Instead of estimating the skin color model from scratch at each frame,
+  the mean and the second order moment of the rg chromaticity are updated
+  with exponentially decaying weights, using the statistics of the current
+  frame only. A full re-estimation (using the skin color filter) is
+  triggered when the mean skin color of the frame drifts too far away
+  from the model, i.e. when the Mahalanobis distance between both is
+  larger than ``drift``. There is no drift detection while the covariance
+  of the model is singular.
+
+  The parameters of the skin color filter are updated only when the model
+  has moved by more than ``tolerance`` (Mahalanobis distance between the
+  current and the previously published means, or relative change of the
+  covariance), such that a :py:class:`SkinColorLUT` built on the filter
+  is not rebuilt at each frame.
+
+  Attributes
+  ----------
+  skin_filter: :py:class:`bob.ip.skincolorfilter.SkinColorFilter`
+    The skin color filter whose model is estimated.
+  alpha: float
+    The weight of the current frame in the update.
+  drift: float
+    The distance triggering a full re-estimation.
+  tolerance: float
+    The change in the model triggering an update of the skin color filter.
+  mean: numpy.ndarray
+    The current mean of the model.
+  covariance: numpy.ndarray
+    The current covariance matrix of the model.
+  estimations: int
+    The number of full estimations made so far.
+
+  """
+
+  def __init__(self, skin_filter, alpha=0.1, drift=1.0, tolerance=0.1):
+    """init function
+
+    Parameters
+    ----------
+    skin_filter: :py:class:`bob.ip.skincolorfilter.SkinColorFilter`
+      The skin color filter whose model is estimated.
+    alpha: float
+      The weight of the current frame in the update (between 0 and 1).
+    drift: float
+      The distance triggering a full re-estimation.
+    tolerance: float
+      The change in the model triggering an update of the skin color filter.
+
+    """
+    self.skin_filter = skin_filter
+    self.alpha = alpha
+    self.drift = drift
+    self.tolerance = tolerance
+    self.mean = None
+    self.covariance = None
+    self.estimations = 0
+
+  def estimate(self, image):
+    """fully estimates the model with the skin color filter.
+
+    Parameters
+    ----------
+    image: numpy.ndarray
+      The face image.
+
+    """
+    self.skin_filter.estimate_gaussian_parameters(image)
+    self.mean = numpy.array(self.skin_filter.mean, dtype='float64')
+    self.covariance = numpy.array(self.skin_filter.covariance, dtype='float64')
+    self._inverse = get_covariance_inverse(self.covariance)
+    self._moment = self.covariance + numpy.outer(self.mean, self.mean)
+    self._published_mean = numpy.copy(self.mean)
+    self._published_covariance = numpy.copy(self.covariance)
+    self.estimations += 1
+
+  def _publish(self):
+    """sets the current model as the model of the skin color filter."""
+    self.skin_filter.mean = numpy.copy(self.mean)
+    self.skin_filter.covariance = numpy.copy(self.covariance)
+    self.skin_filter.covariance_inverse = numpy.copy(self._inverse)
+    self._published_mean = numpy.copy(self.mean)
+    self._published_covariance = numpy.copy(self.covariance)
+
+  def update(self, image):
+    """updates the model with a new face image.
+
+    The model is fully estimated at the first call, or if the skin
+    color has drifted.
+
+    Parameters
+    ----------
+    image: numpy.ndarray
+      The face image.
+
+    Returns
+    -------
+    estimated: bool
+      True if the model has been fully (re-)estimated.
+
+    """
+    if self.mean is None:
+      self.estimate(image)
+      return True
+
+    count, mean, covariance = get_skin_statistics(image)
+    if count < 2:
+      return False
+
+    # drift detection (not possible with a singular covariance)
+    if numpy.any(self._inverse):
+      difference = mean - self.mean
+      distance = numpy.sqrt(numpy.dot(difference, numpy.dot(self._inverse, difference)))
+      if distance > self.drift:
+        self.estimate(image)
+        return True
+
+    # exponentially weighted update of the first and second order moments
+    self.mean = (1.0 - self.alpha) * self.mean + self.alpha * mean
+    self._moment = (1.0 - self.alpha) * self._moment + self.alpha * (covariance + numpy.outer(mean, mean))
+    self.covariance = self._moment - numpy.outer(self.mean, self.mean)
+    self._inverse = get_covariance_inverse(self.covariance)
+
+    # update the skin color filter if the model has changed enough
+    difference = self.mean - self._published_mean
+    mean_change = numpy.sqrt(numpy.dot(difference, numpy.dot(self.skin_filter.covariance_inverse, difference)))
+    covariance_change = numpy.linalg.norm(self.covariance - self._published_covariance)
+    if mean_change > self.tolerance or covariance_change > self.tolerance * numpy.linalg.norm(self._published_covariance):
+      self._publish()
+    return False
+
+
+def compute_threshold_statistics(image, probability, thresholds, second_order=False):
+  """computes the color statistics of skin pixels for several thresholds at once.
+
+  The pixels are first binned according to the thresholds below their
+  skin probability, and the statistics of each bin are accumulated. The
+  statistics of the pixels above a given threshold are then obtained by
+  summing the bins above it. This costs a single pass on the image,
+  whatever the number of thresholds.
+
+  Parameters
+  ----------
+  image: numpy.ndarray
+    The RGB image.
+  probability: numpy.ndarray
+    The skin probability of each pixel (see :py:func:`compute_skin_probability`).
+  thresholds: list of float
+    The thresholds on the skin probability: a pixel is considered as
+    skin if its probability is strictly higher than the threshold.
+  second_order: bool
+    If set, the sums of the products of the color channels are also computed.
+
+  Returns
+  -------
+  counts: numpy.ndarray
+    The number of skin pixels, for each threshold.
+  sums: numpy.ndarray
+    The sum of the R, G and B values of skin pixels, for each
+    threshold (shape (n_thresholds, 3)).
+  products: numpy.ndarray
+    The sums of the outer products of the RGB values of skin pixels, for
+    each threshold (shape (n_thresholds, 3, 3)). Only returned if
+    ``second_order`` is set.
+
+  """
+  thresholds = numpy.asarray(thresholds, dtype='float64')
+  order = numpy.argsort(thresholds)
+  n_bins = thresholds.shape[0] + 1
+
+  # the bin of a pixel is the number of thresholds below its probability
+  bins = numpy.searchsorted(thresholds[order], probability.ravel(), side='left')
+  pixels = image.reshape((3, -1)).astype('float64')
+
+  def above(weights=None):
+    # sum of the weights of the pixels above each (sorted) threshold
+    per_bin = numpy.bincount(bins, weights=weights, minlength=n_bins)
+    tail = numpy.cumsum(per_bin[::-1])[::-1]
+    result = numpy.zeros(thresholds.shape[0], dtype='float64')
+    result[order] = tail[1:]
+    return result
+
+  counts = above()
+  sums = numpy.vstack([above(pixels[c]) for c in range(3)]).T
+  if not second_order:
+    return counts, sums
+
+  products = numpy.zeros((thresholds.shape[0], 3, 3), dtype='float64')
+  for c1 in range(3):
+    for c2 in range(c1, 3):
+      products[:, c1, c2] = above(pixels[c1] * pixels[c2])
+      products[:, c2, c1] = products[:, c1, c2]
+  return counts, sums, products
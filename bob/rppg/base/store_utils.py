@@ -0,0 +1,594 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+import os
+import json
+import time
+import zlib
+import hashlib
+import numpy
+import threading
+import logging
+logger = logging.getLogger("bob.rppg.base")
+
+class SignalStore(object):
+  """stores the signals of all the objects of a stage in a single HDF5 file.
+
+  Each signal is a dataset, named after the path of its object. The
+  file is only opened when needed, for reading or for writing. It can
+  be accessed from several threads.
+
+  Attributes
+  ----------
+  filename: str
+    The HDF5 file.
+
+  """
+
+  def __init__(self, filename):
+    """Constructor
+
+    Parameters
+    ----------
+    filename: str
+      The HDF5 file.
+
+    """
+    self.filename = filename
+    self._file = None
+    self._writable = False
+    self._lock = threading.RLock()
+
+  def _get_file(self, write=False):
+    """opens the file, if not already opened (with the right mode)."""
+    import bob.io.base
+    if self._file is None or (write and not self._writable):
+      self.close()
+      if write:
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.exists(dirname): bob.io.base.create_directories_safe(dirname)
+        self._file = bob.io.base.HDF5File(self.filename, 'a')
+        self._writable = True
+      else:
+        self._file = bob.io.base.HDF5File(self.filename, 'r')
+    return self._file
+
+  def _get_key(self, path):
+    return '/' + path.strip('/')
+
+  def __contains__(self, path):
+    with self._lock:
+      if self._file is None and not os.path.exists(self.filename):
+        return False
+      return self._get_file().has_dataset(self._get_key(path))
+
+  def read(self, path):
+    """reads a signal.
+
+    Parameters
+    ----------
+    path: str
+      The path of the object.
+
+    Returns
+    -------
+    signal: numpy.ndarray
+      The signal.
+
+    """
+    with self._lock:
+      return self._get_file().read(self._get_key(path))
+
+  def write(self, path, signal):
+    """writes a signal, replacing the one already stored (if any).
+
+    Parameters
+    ----------
+    path: str
+      The path of the object.
+    signal: numpy.ndarray
+      The signal.
+
+    """
+    self.write_all([path], [signal])
+
+  def write_all(self, paths, signals):
+    """writes several signals at once, replacing the ones already stored (if any).
+
+    Parameters
+    ----------
+    paths: list of str
+      The paths of the objects.
+    signals: list of numpy.ndarray
+      The signals.
+
+    """
+    with self._lock:
+      f = self._get_file(write=True)
+      for path, signal in zip(paths, signals):
+        key = self._get_key(path)
+        if f.has_dataset(key):
+          f.unlink(key)
+        # create the groups leading to the dataset
+        group = ''
+        for name in key.split('/')[1:-1]:
+          group += '/' + name
+          if not f.has_group(group):
+            f.create_group(group)
+        f.set(key, numpy.ascontiguousarray(signal))
+
+  def close(self):
+    """closes the file (if opened)."""
+    with self._lock:
+      if self._file is not None:
+        self._file.close()
+        self._file = None
+        self._writable = False
+
+
+def get_store_file(directory):
+  """gets the file of the signal store of a directory.
+
+  Parameters
+  ----------
+  directory: str
+    The directory of a stage.
+
+  Returns
+  -------
+  filename: str
+    The HDF5 file storing all the signals of the stage.
+
+  """
+  return os.path.join(directory, 'signals.hdf5')
+
+def get_checksum(signal):
+  """gets the checksum of a signal.
+
+  Parameters
+  ----------
+  signal: numpy.ndarray
+    The signal.
+
+  Returns
+  -------
+  checksum: int
+    The CRC-32 checksum of the data of the signal.
+
+  """
+  return zlib.crc32(numpy.ascontiguousarray(signal).tobytes()) & 0xffffffff
+
+
+class Manifest(object):
+  """indexes the signals saved by a stage.
+
+  The manifest of a directory records, for each saved signal, its path,
+  the parameters it was computed with, its size, its checksum, when it
+  was saved, and where (in the store of the directory or in its own 
+  file). It is read once, and the existence of signals is then known
+  without accessing their files. Each new entry is appended to the 
+  manifest file, the last entry of a path being the valid one.
+
+  A manifest created in an empty directory starts with a marker, telling
+  that it lists all the signals of the directory: the signals which are
+  not in it do not exist, and their files are not looked for. In a
+  directory which already contained signals (e.g. saved by previous
+  versions), the signals which are not in the manifest are looked for
+  in their files. Since the manifest of a directory may be appended to
+  by several jobs at once (e.g. on a shared filesystem), lines which 
+  cannot be read are skipped: the manifest is then not complete anymore,
+  and the signals they describe are looked for in their files as well.
+
+  Attributes
+  ----------
+  filename: str
+    The manifest file.
+  indexed: bool
+    If the directory was indexed (i.e. the manifest file existed when read).
+  complete: bool
+    If the manifest lists all the signals of the directory.
+  entries: dict
+    The entries, indexed by the paths of the signals.
+
+  """
+
+  def __init__(self, filename):
+    """Constructor
+
+    Parameters
+    ----------
+    filename: str
+      The manifest file.
+
+    """
+    self.filename = filename
+    self.entries = {}
+    self.indexed = os.path.exists(filename)
+    self.complete = False
+    self._lock = threading.Lock()
+    if self.indexed:
+      unreadable = False
+      with open(filename, 'r') as f:
+        for line in f:
+          if not line.strip():
+            continue
+          try:
+            entry = json.loads(line)
+            if entry.get('complete') is True and 'path' not in entry:
+              self.complete = True
+            else:
+              self.entries[entry['path']] = entry
+          except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logger.warn("Skipping unreadable entry in `%s'", filename)
+            unreadable = True
+      self.complete = self.complete and not unreadable
+
+  def create(self):
+    """creates the manifest file, before the first signal is saved.
+
+    If the directory does not contain any file yet, the manifest starts
+    with a marker telling that it is complete.
+    """
+    with self._lock:
+      if self.indexed or os.path.exists(self.filename):
+        return
+      dirname = os.path.dirname(self.filename) or '.'
+      empty = True
+      for __, __, filenames in os.walk(dirname):
+        if filenames:
+          empty = False
+          break
+      if not os.path.exists(dirname):
+        import bob.io.base
+        bob.io.base.create_directories_safe(dirname)
+      with open(self.filename, 'a') as f:
+        if empty:
+          f.write(json.dumps({'complete': True}) + "\n")
+      self.indexed = True
+      self.complete = empty
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, path):
+    return path in self.entries
+
+  def get(self, path):
+    """gets the entry of a signal (None if there is none)."""
+    return self.entries.get(path)
+
+  def add(self, path, signal, parameters='', location='file'):
+    """adds the entry of a saved signal.
+
+    Parameters
+    ----------
+    path: str
+      The path of the signal.
+    signal: numpy.ndarray
+      The signal.
+    parameters: str
+      The hash of the parameters the signal was computed with.
+    location: str
+      Where the signal was saved: 'file' or 'store'.
+
+    """
+    self.add_all([path], [signal], [parameters], location)
+
+  def add_all(self, paths, signals, parameters, location='file'):
+    """adds the entries of several saved signals at once.
+
+    Parameters
+    ----------
+    paths: list of str
+      The paths of the signals.
+    signals: list of numpy.ndarray
+      The signals.
+    parameters: list of str
+      The hash of the parameters of each signal.
+    location: str
+      Where the signals were saved: 'file' or 'store'.
+
+    """
+    entries = []
+    for path, signal, p in zip(paths, signals, parameters):
+      signal = numpy.asarray(signal)
+      entries.append({'path': path, 'parameters': p, 'size': int(signal.nbytes),
+          'checksum': get_checksum(signal), 'time': time.time(), 'location': location})
+    with self._lock:
+      dirname = os.path.dirname(self.filename)
+      if dirname and not os.path.exists(dirname):
+        import bob.io.base
+        bob.io.base.create_directories_safe(dirname)
+      with open(self.filename, 'a') as f:
+        f.write(''.join([json.dumps(entry, sort_keys=True) + "\n" for entry in entries]))
+      for entry in entries:
+        self.entries[entry['path']] = entry
+
+
+def get_manifest_file(directory):
+  """gets the manifest file of a directory.
+
+  Parameters
+  ----------
+  directory: str
+    The directory of a stage.
+
+  Returns
+  -------
+  filename: str
+    The manifest file, indexing the signals of the stage.
+
+  """
+  return os.path.join(directory, 'manifest.jsonl')
+
+# signal stores and manifests opened in this process, indexed by directory
+_stores = {}
+_manifests = {}
+_stores_lock = threading.Lock()
+
+def get_store(directory):
+  """gets the signal store of a directory.
+
+  Parameters
+  ----------
+  directory: str
+    The directory of a stage.
+
+  Returns
+  -------
+  store: :py:class:`SignalStore`
+    The signal store.
+
+  """
+  directory = os.path.normpath(directory)
+  with _stores_lock:
+    if directory not in _stores:
+      _stores[directory] = SignalStore(get_store_file(directory))
+    return _stores[directory]
+
+def get_manifest(directory):
+  """gets the manifest of a directory.
+
+  The manifest is read the first time it is requested.
+
+  Parameters
+  ----------
+  directory: str
+    The directory of a stage.
+
+  Returns
+  -------
+  manifest: :py:class:`Manifest`
+    The manifest.
+
+  """
+  directory = os.path.normpath(directory)
+  with _stores_lock:
+    if directory not in _manifests:
+      _manifests[directory] = Manifest(get_manifest_file(directory))
+    return _manifests[directory]
+
+def close_stores():
+  """closes all the signal stores opened in this process.
+
+  The manifests are also forgotten: they will be read again if needed.
+
+  """
+  with _stores_lock:
+    for store in _stores.values():
+      store.close()
+    _manifests.clear()
+
+def has_signal(obj, directory, suffix=''):
+  """tells if the signal of an object exists.
+
+  If the signal is in the manifest of the directory, or if the manifest
+  is complete, the answer is given by the manifest. Otherwise, the signal
+  is looked for in the store of the directory, and in the file of the 
+  object.
+
+  Parameters
+  ----------
+  obj: object
+    The object of the database.
+  directory: str
+    The directory of a stage.
+  suffix: str
+    The suffix of the signal, added to the path of the object.
+
+  Returns
+  -------
+  exists: bool
+    If the signal exists.
+
+  """
+  manifest = get_manifest(directory)
+  if (obj.path + suffix) in manifest:
+    return True
+  if manifest.complete:
+    return False
+  return (obj.path + suffix) in get_store(directory) or os.path.exists(obj.make_path(directory, suffix + '.hdf5'))
+
+def get_parameters_hash(parameters, obj=None, inputs=()):
+  """computes the hash of what the signal of an object is computed from.
+
+  This covers the parameters of the stage and, for each input directory,
+  the entry of the input signal of the object in the manifest of the 
+  directory (i.e. its parameters and its checksum). The hash hence 
+  changes when a parameter or an upstream signal changes.
+
+  Parameters
+  ----------
+  parameters: dict
+    The parameters of the stage.
+  obj: object
+    The object of the database.
+  inputs: list of str
+    The directories of the input signals of the stage.
+
+  Returns
+  -------
+  parameters_hash: str
+    The hash.
+
+  """
+  h = hashlib.sha1(json.dumps(parameters, sort_keys=True).encode('utf-8'))
+  for directory in inputs:
+    entry = get_manifest(directory).get(obj.path)
+    if entry is None:
+      h.update(b'-')
+    else:
+      h.update('{0}:{1}'.format(entry['parameters'], entry['checksum']).encode('utf-8'))
+  return h.hexdigest()
+
+def is_up_to_date(obj, directory, parameters, suffix=''):
+  """tells if the signal of an object exists and is up-to-date.
+
+  The signal is up-to-date if it was computed from the same parameters
+  and inputs (see :py:func:`get_parameters_hash`). For a signal which is
+  not in the manifest of the directory, there is no way to know it: only
+  the existence of the signal is checked (see :py:func:`has_signal`).
+
+  Parameters
+  ----------
+  obj: object
+    The object of the database.
+  directory: str
+    The directory of a stage.
+  parameters: str
+    The hash of the parameters and inputs of the signal.
+  suffix: str
+    The suffix of the signal, added to the path of the object.
+
+  Returns
+  -------
+  up_to_date: bool
+    If the signal exists and is up-to-date.
+
+  """
+  entry = get_manifest(directory).get(obj.path + suffix)
+  if entry is not None:
+    return entry['parameters'] == parameters
+  return has_signal(obj, directory, suffix)
+
+def load_signal(obj, directory, suffix=''):
+  """loads the signal of an object.
+
+  The signal is read from where the manifest of the directory says it
+  is. If it is not in the manifest (and the manifest is not complete),
+  it is read from the store of the directory if it is there, and from
+  the file of the object otherwise.
+
+  Parameters
+  ----------
+  obj: object
+    The object of the database.
+  directory: str
+    The directory of a stage.
+  suffix: str
+    The suffix of the signal, added to the path of the object.
+
+  Returns
+  -------
+  signal: numpy.ndarray
+    The signal.
+
+  Raises
+  ------
+  IOError
+    If there is no signal for this object.
+
+  """
+  manifest = get_manifest(directory)
+  entry = manifest.get(obj.path + suffix)
+  store = get_store(directory)
+  filename = obj.make_path(directory, suffix + '.hdf5')
+  if entry is not None:
+    if entry['location'] == 'store':
+      return store.read(obj.path + suffix)
+  elif manifest.complete:
+    raise IOError("No signal for `{0}' in `{1}'".format(obj.path, directory))
+  elif (obj.path + suffix) in store:
+    return store.read(obj.path + suffix)
+  elif not os.path.exists(filename):
+    raise IOError("No signal for `{0}' in `{1}'".format(obj.path, directory))
+  import bob.io.base
+  return bob.io.base.load(filename)
+
+def save_signal(signal, obj, directory, suffix='', store=False, parameters=''):
+  """saves the signal of an object.
+
+  The signal is also added to the manifest of the directory.
+
+  Parameters
+  ----------
+  signal: numpy.ndarray
+    The signal.
+  obj: object
+    The object of the database.
+  directory: str
+    The directory of a stage.
+  suffix: str
+    The suffix of the signal, added to the path of the object.
+  store: bool
+    If the signal is saved in the store of the directory (instead
+    of the file of the object).
+  parameters: str
+    The hash of the parameters the signal was computed with.
+
+  Returns
+  -------
+  location: str
+    Where the signal was saved (file or store).
+
+  """
+  return save_signals([signal], [obj], directory, suffix, store, [parameters])[0]
+
+def save_signals(signals, objects, directory, suffix='', store=False, parameters=''):
+  """saves the signals of several objects at once.
+
+  In the store of the directory, all the signals are written in a single
+  operation. They are also added to the manifest of the directory at once.
+
+  Parameters
+  ----------
+  signals: list of numpy.ndarray
+    The signals.
+  objects: list
+    The objects of the database.
+  directory: str
+    The directory of a stage.
+  suffix: str
+    The suffix of the signals, added to the paths of the objects.
+  store: bool
+    If the signals are saved in the store of the directory (instead
+    of the files of the objects).
+  parameters: str or list of str
+    The hash of the parameters the signals were computed with (one per 
+    signal, or the same for all).
+
+  Returns
+  -------
+  locations: list of str
+    Where each signal was saved (file or store).
+
+  """
+  paths = [obj.path + suffix for obj in objects]
+  if isinstance(parameters, str):
+    parameters = [parameters] * len(paths)
+  manifest = get_manifest(directory)
+  manifest.create()
+  if store:
+    get_store(directory).write_all(paths, signals)
+    locations = [get_store_file(directory)] * len(paths)
+  else:
+    import bob.io.base
+    locations = []
+    for signal, obj in zip(signals, objects):
+      filename = obj.make_path(directory, suffix + '.hdf5')
+      outdir = os.path.dirname(filename)
+      if not os.path.exists(outdir): bob.io.base.create_directories_safe(outdir)
+      bob.io.base.save(signal, filename)
+      locations.append(filename)
+  manifest.add_all(paths, signals, parameters, 'store' if store else 'file')
+  return locations
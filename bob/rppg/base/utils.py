@@ -8,7 +8,7 @@ import collections
 import bob.ip.base
 import bob.ip.facedetect
 
-def scale_image(image, width, height):
+def scale_image(image, width, height, result=None):
   """scales an image.
 
   Parameters
@@ -19,6 +19,9 @@ def scale_image(image, width, height):
     The new image width.
   height: int
     The new image height
+  result: numpy.ndarray
+    A (caller-owned) float64 array of shape (3, width, height) where
+    the scaled image is written. If not provided, a new array is allocated.
 
   Returns
   -------
@@ -27,13 +30,42 @@ def scale_image(image, width, height):
   
   """
   assert len(image.shape) == 3, "This is meant to work with color images (3 channels)"
-  result = numpy.zeros((3, width, height))
+  if result is None:
+    result = numpy.zeros((3, width, height))
+  else:
+    assert result.shape == (3, width, height), "The provided array does not have the size of the scaled image"
   bob.ip.base.scale(image, result)
   return result
 
 
-def crop_face(image, bbx, facewidth):
+def get_face_shape(bbx, facewidth):
+  """returns the shape of a face cropped with :py:func:`crop_face`.
+
+  Parameters
+  ----------
+  bbx: :py:class:`bob.ip.facedetect.BoundingBox`
+    The bounding box of the face.
+  facewidth: int
+    The width of the face after cropping.
+
+  Returns
+  -------
+  shape: tuple
+    The shape (3, height, width) of the cropped face.
+
+  """
+  aspect_ratio = bbx.size_f[0] / bbx.size_f[1] # height/width
+  faceheight = int(facewidth * aspect_ratio)
+  return (3, faceheight, facewidth)
+
+
+def crop_face(image, bbx, facewidth, face=None, scaled=None):
   """crops a face from an image.
+
+  The output arrays can be provided by the caller, such that they
+  can be re-used from one frame to the next. The type of the cropped
+  face is given by the type of the provided ``face`` array (uint8,
+  float32 or float64). Without any array, a new uint8 face is returned.
   
   Parameters
   ----------
@@ -43,22 +75,96 @@ def crop_face(image, bbx, facewidth):
     The bounding box of the face.
   facewidth: int
     The width of the face after cropping.
+  face: numpy.ndarray
+    The array where the face is written, its shape should be the
+    one given by :py:func:`get_face_shape`.
+  scaled: numpy.ndarray
+    A float64 work array of the same shape, holding the rescaled
+    face before its conversion to the type of ``face``.
 
   Returns
   -------
   face: numpy.ndarray
     The face image.
   """
-  face = image[:, bbx.topleft[0]:(bbx.topleft[0] + bbx.size[0]), bbx.topleft[1]:(bbx.topleft[1] + bbx.size[1])]
-  aspect_ratio = bbx.size_f[0] / bbx.size_f[1] # height/width
-  faceheight = int(facewidth * aspect_ratio)
-  face = scale_image(face, faceheight, facewidth)
-  face = face.astype('uint8')
+  region = image[:, bbx.topleft[0]:(bbx.topleft[0] + bbx.size[0]), bbx.topleft[1]:(bbx.topleft[1] + bbx.size[1])]
+  shape = get_face_shape(bbx, facewidth)
+
+  # bob.ip.base.scale outputs float64, no conversion needed
+  if face is not None and face.dtype == numpy.float64:
+    return scale_image(region, shape[1], shape[2], face)
+
+  scaled = scale_image(region, shape[1], shape[2], scaled)
+  if face is None:
+    return scaled.astype('uint8')
+  assert face.shape == shape, "The provided array does not have the size of the cropped face"
+  numpy.copyto(face, scaled, casting='unsafe')
   return face
 
 
-def build_bandpass_filter(fs, order, min_freq=0.7, max_freq=4.0, plot=False):
-  """builds a butterworth bandpass filter.
+class FaceCropper(object):
+  """crops faces in re-used buffers.
+
+  The buffers are allocated at the first call, and again only when
+  the size of the cropped face changes. Note that the returned face
+  is overwritten at the next call: keep a copy, or use another
+  cropper, if you need it afterwards.
+
+  Attributes
+  ----------
+  dtype: numpy.dtype
+    The type of the cropped faces.
+  face: numpy.ndarray
+    The last cropped face.
+  scaled: numpy.ndarray
+    The float64 work array used for rescaling.
+
+  """
+
+  def __init__(self, dtype='uint8'):
+    """init function
+
+    Parameters
+    ----------
+    dtype: str or numpy.dtype
+      The type of the cropped faces (uint8, float32 or float64).
+
+    """
+    self.dtype = numpy.dtype(dtype)
+    self.face = None
+    self.scaled = None
+
+  def __call__(self, image, bbx, facewidth):
+    """crops a face from an image.
+
+    Parameters
+    ----------
+    image: numpy.ndarray
+      The image to be scaled.
+    bbx: :py:class:`bob.ip.facedetect.BoundingBox`
+      The bounding box of the face.
+    facewidth: int
+      The width of the face after cropping.
+
+    Returns
+    -------
+    face: numpy.ndarray
+      The face image (i.e. the internal buffer).
+
+    """
+    shape = get_face_shape(bbx, facewidth)
+    if self.face is None or self.face.shape != shape:
+      self.face = numpy.zeros(shape, dtype=self.dtype)
+      if self.dtype != numpy.float64:
+        self.scaled = numpy.zeros(shape, dtype='float64')
+    return crop_face(image, bbx, facewidth, self.face, self.scaled)
+
+
+def build_bandpass_filter(fs, order, min_freq=0.7, max_freq=4.0, plot=False, design='fir'):
+  """builds a bandpass filter.
+
+  The default frequency range, in Hertz, corresponds to plausible 
+  heart-rate values, i.e. [42-240] beats per minute.
   
   Parameters
   ----------
@@ -66,33 +172,45 @@ def build_bandpass_filter(fs, order, min_freq=0.7, max_freq=4.0, plot=False):
     sampling frequency of the signal (i.e. framerate).
   order: int
     The order of the filter (the higher, the sharper).
-  min_freq: int
-    The order of the filter (the higher, the sharper).
-  order: int
-    The order of the filter (the higher, the sharper).
+  min_freq: float
+    The lower cutoff frequency, in Hertz.
+  max_freq: float
+    The upper cutoff frequency, in Hertz.
   plot: bool
     Plots the frequency response of the filter.
+  design: str
+    The design of the filter: 'fir' for a windowed FIR filter 
+    (with order + 1 taps), or 'butter' for a Butterworth IIR filter,
+    as second-order sections. The latter needs a much lower order
+    (e.g. 4) and can be applied to much shorter signals.
   
   Returns
   -------
   b: numpy.ndarray
-    The coefficients of the FIR filter.
+    The coefficients of the FIR filter, or the second-order sections 
+    of the Butterworth filter (of shape (n_sections, 6)).
   
   """
-  # frequency range in Hertz, corresponds to plausible heart-rate values, i.e. [42-240] beats per minute
-  min_freq = 0.7 
-  max_freq = 4.0 
-
-  from scipy.signal import firwin 
   nyq = fs / 2.0
-  numtaps = order + 1
-  b = firwin(numtaps, [min_freq/nyq, max_freq/nyq], pass_zero=False)
+  if design == 'fir':
+    from scipy.signal import firwin 
+    numtaps = order + 1
+    b = firwin(numtaps, [min_freq/nyq, max_freq/nyq], pass_zero=False)
+  elif design == 'butter':
+    from scipy.signal import butter
+    b = butter(order, [min_freq/nyq, max_freq/nyq], btype='bandpass', output='sos')
+  else:
+    raise ValueError("Unknown filter design `{0}'".format(design))
 
   # show the frequency response of the filter
   if plot:
     from matplotlib import pyplot
-    from scipy.signal import freqz
-    w, h = freqz(b)
+    if design == 'fir':
+      from scipy.signal import freqz
+      w, h = freqz(b)
+    else:
+      from scipy.signal import sosfreqz
+      w, h = sosfreqz(b)
     fig = pyplot.figure()
     pyplot.title('Bandpass filter frequency response')
     pyplot.plot(w * fs / (2 * numpy.pi), 20 * numpy.log10(abs(h)), 'b')
@@ -105,6 +223,232 @@ def build_bandpass_filter(fs, order, min_freq=0.7, max_freq=4.0, plot=False):
   return b
 
 
+def get_padlen(b):
+  """gets the length of the padding used by the zero-phase filtering.
+
+  Signals have to be longer than this to be filtered (see
+  :py:func:`zero_phase_filter`).
+
+  Parameters
+  ----------
+  b: numpy.ndarray
+    The coefficients of the FIR filter, or the second-order sections
+    of an IIR filter.
+
+  Returns
+  -------
+  padlen: int
+    The number of samples added on each side of the signal.
+
+  """
+  b = numpy.asarray(b)
+  if b.ndim == 2:
+    # same as scipy.signal.sosfiltfilt
+    zeros = min((b[:, 2] == 0).sum(), (b[:, 5] == 0).sum())
+    return int(3 * (2 * b.shape[0] + 1 - zeros))
+  return 3 * b.shape[0]
+
+
+def zero_phase_filter(b, signal, axis=-1, method='auto'):
+  """applies a FIR filter forward and backward (zero-phase filtering).
+
+  This is equivalent to ``scipy.signal.filtfilt(b, [1], signal)``: 
+  the signal is extended by odd reflection on both sides (on 3 times
+  the number of taps), and the initial conditions of each pass are the 
+  steady-state of the filter for the first sample. The convolutions are
+  either done directly (with filtfilt) or using the FFT, which is much
+  cheaper for long signals and filters with many taps.
+
+  IIR filters given as second-order sections are applied with 
+  :py:func:`scipy.signal.sosfiltfilt`.
+
+  Parameters
+  ----------
+  b: numpy.ndarray
+    The coefficients of the FIR filter, or the second-order sections
+    of an IIR filter.
+  signal: numpy.ndarray
+    The signal to filter. It may contain several signals.
+  axis: int
+    The axis along which the signals are filtered.
+  method: str
+    How the convolutions are done: 'direct', 'fft', or 'auto' to
+    choose the fastest one given the length of the signals and the
+    number of taps (see :py:func:`scipy.signal.choose_conv_method`).
+
+  Returns
+  -------
+  filtered_signal: numpy.ndarray
+    The filtered signal.
+
+  """
+  from scipy.signal import filtfilt, sosfiltfilt, fftconvolve, choose_conv_method
+  b = numpy.asarray(b, dtype='float64')
+  signal = numpy.moveaxis(numpy.asarray(signal, dtype='float64'), axis, -1)
+  padlen = get_padlen(b)
+  if signal.shape[-1] <= padlen:
+    raise ValueError("The length of the signal ({0}) must be greater than {1}".format(signal.shape[-1], padlen))
+
+  if b.ndim == 2:
+    return numpy.moveaxis(sosfiltfilt(b, signal, axis=-1), -1, axis)
+
+  ntaps = b.shape[0]
+  if method == 'auto':
+    method = choose_conv_method(numpy.zeros(signal.shape[-1] + 2*padlen), b)
+  if method == 'direct':
+    return numpy.moveaxis(filtfilt(b, [1.0], signal, axis=-1), -1, axis)
+  if method != 'fft':
+    raise ValueError("Unknown filtering method `{0}'".format(method))
+
+  # odd extension of the signal on both sides
+  left = 2 * signal[..., :1] - signal[..., padlen:0:-1]
+  right = 2 * signal[..., -1:] - signal[..., -2:-(padlen+2):-1]
+  extended = numpy.concatenate([left, signal, right], axis=-1)
+
+  taps = b.reshape((1,) * (signal.ndim - 1) + (ntaps,))
+  def forward(x):
+    # steady-state initial conditions: as if the signal was 
+    # preceded by its first value
+    prefix = numpy.repeat(x[..., :1], ntaps - 1, axis=-1)
+    return fftconvolve(numpy.concatenate([prefix, x], axis=-1), taps, mode='valid', axes=-1)
+
+  filtered_signal = forward(forward(extended)[..., ::-1])[..., ::-1]
+  return numpy.moveaxis(filtered_signal[..., padlen:-padlen], -1, axis)
+
+
+class FilterBank(object):
+  """memoizes bandpass filter designs.
+
+  A filter is designed (see :py:func:`build_bandpass_filter`) the 
+  first time it is requested for a given sampling frequency, order,
+  band and design, and re-used afterwards. The designs can be saved 
+  to, and loaded from, an HDF5 file.
+
+  Attributes
+  ----------
+  filters: dict
+    The filter coefficients, indexed by (fs, order, min_freq, max_freq, design).
+  modified: bool
+    If new filters have been designed since the last save (or load).
+
+  """
+
+  def __init__(self, filename=None):
+    """Constructor
+
+    Parameters
+    ----------
+    filename: str
+      The HDF5 file to load the filters from, if it exists.
+
+    """
+    self.filters = {}
+    self.modified = False
+    if filename and os.path.exists(filename):
+      self.load(filename)
+
+  def __len__(self):
+    return len(self.filters)
+
+  def __call__(self, fs, order, min_freq=0.7, max_freq=4.0, design='fir', plot=False):
+    """gets a bandpass filter, designing it if not already done.
+
+    Parameters are the ones of :py:func:`build_bandpass_filter`.
+
+    Returns
+    -------
+    b: numpy.ndarray
+      The (read-only) coefficients of the filter.
+
+    """
+    key = (float(fs), int(order), float(min_freq), float(max_freq), str(design))
+    if key not in self.filters:
+      b = build_bandpass_filter(fs, order, min_freq, max_freq, plot=plot, design=design)
+      b.flags.writeable = False
+      self.filters[key] = b
+      self.modified = True
+    return self.filters[key]
+
+  def save(self, filename):
+    """saves all the filters into an HDF5 file.
+
+    The filters already in the file (e.g. saved by another job sharing
+    it) are kept. The file is written under a temporary name, and then
+    renamed, such that it is never read while being written.
+
+    Parameters
+    ----------
+    filename: str
+      The HDF5 file.
+
+    """
+    import bob.io.base
+    import tempfile
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname): bob.io.base.create_directories_safe(dirname)
+    if os.path.exists(filename):
+      self.load(filename)
+    fd, tmpname = tempfile.mkstemp(suffix='.hdf5', prefix='.filters-', dir=dirname or '.')
+    os.close(fd)
+    try:
+      f = bob.io.base.HDF5File(tmpname, 'w')
+      for i, key in enumerate(sorted(self.filters.keys())):
+        group = 'filter_{0}'.format(i)
+        f.create_group(group)
+        f.cd(group)
+        f.set('coefficients', numpy.array(self.filters[key]))
+        for name, value in zip(('fs', 'order', 'min_freq', 'max_freq', 'design'), key):
+          f.set_attribute(name, value)
+        f.cd('..')
+      del f
+      os.rename(tmpname, filename)
+    except Exception:
+      if os.path.exists(tmpname): os.remove(tmpname)
+      raise
+    self.modified = False
+
+  def load(self, filename):
+    """loads filters from an HDF5 file.
+
+    The loaded filters are added to the ones already in the bank. If the
+    file cannot be read, no filter is loaded.
+
+    Parameters
+    ----------
+    filename: str
+      The HDF5 file.
+
+    Returns
+    -------
+    loaded: bool
+      If the file could be read.
+
+    """
+    import bob.io.base
+    filters = {}
+    try:
+      f = bob.io.base.HDF5File(filename, 'r')
+      for group in f.sub_groups(relative=True, recursive=False):
+        f.cd(group)
+        key = (float(f.get_attribute('fs')), int(f.get_attribute('order')),
+               float(f.get_attribute('min_freq')), float(f.get_attribute('max_freq')),
+               str(f.get_attribute('design')))
+        b = f.read('coefficients')
+        b.flags.writeable = False
+        filters[key] = b
+        f.cd('..')
+      del f
+    except (IOError, RuntimeError, ValueError, KeyError) as e:
+      return False
+    self.filters.update(filters)
+    self.modified = False
+    return True
+
+
+# filters designed in this process, shared by all scripts
+filter_bank = FilterBank()
+
+
 def get_parameter(args, configuration, keyword, default):
   """ Get the right value for a parameter
 
@@ -167,3 +511,30 @@ def get_parameter(args, configuration, keyword, default):
     else:
       return arg_command
 
+
+
+def get_list(value, _type=float):
+  """ Get a list of values from a parameter
+
+  Lists are given as comma-separated values on the command-line
+  (e.g. --thresholds=0.3,0.5,0.7), and either as a string with
+  the same format or as a list in the configuration file.
+
+  Parameters
+  ----------
+  value: string or list
+    The value of the parameter, as returned by :py:func:`get_parameter`.
+  _type: type
+    The type of the elements of the list.
+
+  Returns
+  -------
+  values: list
+    The list of values (empty if no value was given).
+
+  """
+  if value is None:
+    return []
+  if isinstance(value, str):
+    value = [v for v in value.split(',') if v.strip()]
+  return [_type(v) for v in value]
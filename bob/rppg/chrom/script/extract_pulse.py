@@ -8,8 +8,10 @@ Usage:
            [--protocol=<string>] [--subset=<string> ...]
            [--pulsedir=<path>]
            [--start=<int>] [--end=<int>] [--motion=<float>]
-           [--threshold=<float>] [--skininit]
-           [--framerate=<int>] [--order=<int>]
+           [--threshold=<float>] [--skininit] [--skin-alpha=<float>]
+           [--lut-bits=<int>] [--thresholds=<list>] [--store]
+           [--framerate=<int>] [--order=<int>] [--design=<string>]
+           [--filters=<path>]
            [--window=<int>] [--gridcount]
            [--overwrite] [--verbose ...] [--plot]
 
@@ -32,8 +34,36 @@ Options:
   --threshold=<float>       Threshold on the skin color probability [default: 0.5].
   --skininit                If you want to reinit the skin color distribution
                             at each frame.
-  --framerate=<int>         Framerate of the video sequence [default: 61]
+  --lut-bits=<int>          Number of bits per color channel of the lookup table
+                            used to get the skin masks. Zero means that no lookup
+                            table is used. With 8 bits, the masks are the same as
+                            the ones of the skin color filter; with less bits,
+                            they differ on dark pixels. Not used when the skin 
+                            model is re-estimated from scratch at each frame
+                            [default: 0].
+  --skin-alpha=<float>      With --skininit, the weight of the current frame in
+                            the online update of the skin model. Zero means that
+                            the model is re-estimated from scratch at each frame
+                            [default: 0.0].
+  --thresholds=<list>       Comma-separated list of thresholds on the skin color
+                            probability (e.g. 0.3,0.5,0.7). If given, the pulse
+                            signals for all thresholds are computed in a single
+                            pass on the video, and stored in the
+                            threshold_<value> sub-directories of the output
+                            directory [default: ].
+  --store                   Store the signals of all objects in a single file
+                            (signals.hdf5 in the output directories) instead of
+                            one file per object.
+  --framerate=<int>         Framerate of the video sequence. If zero, the
+                            framerate of each video is used [default: 61]
   --order=<int>             Order of the bandpass filter [default: 128]
+  --design=<string>         Design of the bandpass filter: 'fir' or 'butter'. The
+                            Butterworth filter should be used with a much lower
+                            order (e.g. 4), and allows to filter shorter signals
+                            [default: fir].
+  --filters=<path>          HDF5 file where the designed bandpass filters are
+                            cached: they are loaded from it, and new designs are
+                            saved to it [default: ].
   --window=<int>            Window size in the overlap-add procedure. A window
                             of zero means no procedure applied [default: 0].
   --gridcount               Tells the number of objects that will be processed.
@@ -67,6 +97,11 @@ from docopt import docopt
 
 from bob.extension.config import load
 from ...base.utils import get_parameter
+from ...base.utils import get_list
+from ...base.store_utils import get_parameters_hash
+from ...base.store_utils import is_up_to_date
+from ...base.store_utils import save_signal
+from ...base.store_utils import close_stores
 
 version = pkg_resources.require('bob.rppg.base')[0].version
 
@@ -75,8 +110,13 @@ import bob.io.base
 import bob.ip.facedetect
 import bob.ip.skincolorfilter
 
-from ...base.utils import crop_face
-from ...base.utils import build_bandpass_filter 
+from ...base.utils import FaceCropper
+from ...base.utils import filter_bank
+from ...base.utils import zero_phase_filter
+from ...base.skin_utils import SkinColorLUT
+from ...base.skin_utils import OnlineSkinColorModel
+from ...base.skin_utils import compute_skin_probability
+from ...base.skin_utils import compute_threshold_statistics
 
 from ..extract_utils import compute_mean_rgb
 from ..extract_utils import project_chrominance
@@ -107,8 +147,14 @@ def main(user_input=None):
   motion = get_parameter(args, configuration, 'motion', 0.0)
   threshold = get_parameter(args, configuration, 'threshold', 0.5)
   skininit = get_parameter(args, configuration, 'skininit', False)
+  skin_alpha = get_parameter(args, configuration, 'skin_alpha', 0.0)
+  lut_bits = get_parameter(args, configuration, 'lut_bits', 0)
+  thresholds = get_list(get_parameter(args, configuration, 'thresholds', ''))
+  store = get_parameter(args, configuration, 'store', False)
   framerate = get_parameter(args, configuration, 'framerate', 61)
   order = get_parameter(args, configuration, 'order', 128)
+  design = get_parameter(args, configuration, 'design', 'fir')
+  filters = get_parameter(args, configuration, 'filters', '')
   window = get_parameter(args, configuration, 'window', 0)
   overwrite = get_parameter(args, configuration, 'overwrite', False)
   plot = get_parameter(args, configuration, 'plot', False)
@@ -132,6 +178,11 @@ def main(user_input=None):
   except AttributeError:
     sge = 'SGE_TASK_ID' in os.environ # python3
     
+  # all grid tasks would write the same signal store at once, corrupting it
+  if sge and store:
+    logger.error("The signals cannot be stored in a single file by several grid jobs, please remove --store !")
+    sys.exit()
+
   if sge:
     pos = int(os.environ['SGE_TASK_ID']) - 1
     if pos >= len(objects):
@@ -142,25 +193,45 @@ def main(user_input=None):
     print(len(objects))
     sys.exit()
 
-  # build the bandpass filter one and for all
-  bandpass_filter = build_bandpass_filter(framerate, order, plot)
+  # the bandpass filters are designed once and for all (for each framerate)
+  if filters and os.path.exists(filters) and not filter_bank.load(filters):
+    logger.warn("Ignoring the filter cache `%s' (it cannot be read)", filters)
+
+  # a lookup table would be rebuilt at each frame if the skin model is
+  # re-estimated from scratch at each frame: the faces are filtered directly
+  if lut_bits > 0 and skininit and skin_alpha == 0:
+    logger.warn("Not using a lookup table for the skin masks (the skin model is re-estimated at each frame)")
+    lut_bits = 0
+
+  # what the signals are computed from, for each threshold
+  hashes = [get_parameters_hash(dict(threshold=t, start=start, end=end, motion=motion, skininit=skininit, skin_alpha=skin_alpha, lut_bits=lut_bits,
+      framerate=framerate, order=order, design=design, window=window)) for t in (thresholds if thresholds else [threshold])]
 
   # does the actual work - for every video in the available dataset, 
   # extract the signals and dumps the results to the corresponding directory
   for obj in objects:
 
-    # expected output file
-    output = obj.make_path(pulsedir, '.hdf5')
+    # output directories: one per threshold if several are given
+    if thresholds:
+      outdirs = [os.path.join(pulsedir, 'threshold_{0}'.format(t)) for t in thresholds]
+    else:
+      outdirs = [pulsedir]
 
-    # if output exists and not overwriting, skip this file
-    if os.path.exists(output) and not overwrite:
-      logger.info("Skipping output file `%s': already exists, use --overwrite to force an overwrite", output)
+    # if output exists (and is up-to-date) and not overwriting, skip this file
+    if all([is_up_to_date(obj, outdir, h) for outdir, h in zip(outdirs, hashes)]) and not overwrite:
+      logger.info("Skipping output `%s': already exists, use --overwrite to force an overwrite", obj.path)
       continue
     
     # load video
     video = obj.load_video(configuration.dbdir)
     logger.info("Processing input video from `%s'...", video.filename)
 
+    # get the bandpass filter for the framerate of this video
+    fs = framerate
+    if fs == 0:
+      fs = video.frame_rate
+    bandpass_filter = filter_bank(fs, order, design=design, plot=plot)
+
     # indices where to start and to end the processing
     logger.debug("Sequence length = {0}".format(len(video)))
     start_index = start
@@ -185,10 +256,19 @@ def main(user_input=None):
 
     # skin color filter
     skin_filter = bob.ip.skincolorfilter.SkinColorFilter()
+    skin_masker = skin_filter
+    if lut_bits > 0:
+      skin_masker = SkinColorLUT(skin_filter, threshold, lut_bits)
+    skin_model = None
+    if skininit and skin_alpha > 0:
+      skin_model = OnlineSkinColorModel(skin_filter, skin_alpha)
 
-    # output data
-    output_data = numpy.zeros(nb_frames, dtype='float64')
-    chrom = numpy.zeros((nb_frames, 2), dtype='float64')
+    # the faces are cropped alternatively in two buffers, such that
+    # the face of the previous frame is kept (for the motion difference)
+    croppers = [FaceCropper(), FaceCropper()]
+
+    # output data (chrominance signals for each threshold)
+    chroms = numpy.zeros((len(outdirs), nb_frames, 2), dtype='float64')
 
     # loop on video frames
     counter = 0
@@ -202,12 +282,12 @@ def main(user_input=None):
         except NameError:
           bbox, quality = bob.ip.facedetect.detect_single_face(frame)
 
+        face = croppers[counter % 2](frame, bbox, bbox.size[1])
+
         # motion difference (if asked for)
         if motion > 0 and (i < (len(video) - 1)) and (counter > 0):
-          current = crop_face(frame, bbox, bbox.size[1])
-          diff_motion[counter-1] = compute_gray_diff(face, current)
-        
-        face = crop_face(frame, bbox, bbox.size[1])
+          previous_face = croppers[(counter - 1) % 2].face
+          diff_motion[counter-1] = compute_gray_diff(previous_face, face)
 
         if plot and verbosity_level >= 2:
           from matplotlib import pyplot
@@ -215,103 +295,120 @@ def main(user_input=None):
           pyplot.show()
 
         # skin filter
-        if counter == 0 or skininit:
+        if skin_model is not None:
+          skin_model.update(face)
+        elif counter == 0 or skininit:
           skin_filter.estimate_gaussian_parameters(face)
           logger.debug("Skin color parameters:\nmean\n{0}\ncovariance\n{1}".format(skin_filter.mean, skin_filter.covariance))
-        skin_mask = skin_filter.get_skin_mask(face, threshold)
 
-        if plot and verbosity_level >= 2:
-          from matplotlib import pyplot
-          skin_mask_image = numpy.copy(face)
-          skin_mask_image[:, skin_mask] = 255
-          pyplot.imshow(numpy.rollaxis(numpy.rollaxis(skin_mask_image, 2),2))
-          pyplot.show()
+        # threshold sweep: the skin probability map is computed once, and the
+        # mean colors of the skin pixels are obtained for all thresholds at once
+        if thresholds:
+          probability = compute_skin_probability(face, skin_filter.mean, skin_filter.covariance_inverse)
+          counts, sums = compute_threshold_statistics(face, probability, thresholds)
+          mean_colors = sums / numpy.maximum(counts, 1)[:, numpy.newaxis]
+        else:
+          skin_mask = skin_masker.get_skin_mask(face, threshold)
+          counts = [numpy.count_nonzero(skin_mask)]
+          if counts[0] != 0:
+            # compute the mean rgb values of the skin pixels
+            mean_colors = [compute_mean_rgb(face, skin_mask)]
 
-        # sometimes skin is not detected !
-        if numpy.count_nonzero(skin_mask) != 0:
+          if plot and verbosity_level >= 2:
+            from matplotlib import pyplot
+            skin_mask_image = numpy.copy(face)
+            skin_mask_image[:, skin_mask] = 255
+            pyplot.imshow(numpy.rollaxis(numpy.rollaxis(skin_mask_image, 2),2))
+            pyplot.show()
 
-          # compute the mean rgb values of the skin pixels
-          r,g,b = compute_mean_rgb(face, skin_mask)
-          logger.debug("Mean color -> R = {0}, G = {1}, B = {2}".format(r,g,b))
+        for k, chrom in enumerate(chroms):
 
-          # project onto the chrominance colorspace
-          chrom[counter] = project_chrominance(r, g, b)
-          logger.debug("Chrominance -> X = {0}, Y = {1}".format(chrom[counter][0], chrom[counter][1]))
+          # sometimes skin is not detected !
+          if counts[k] != 0:
+
+            r,g,b = mean_colors[k]
+            logger.debug("Mean color -> R = {0}, G = {1}, B = {2}".format(r,g,b))
+
+            # project onto the chrominance colorspace
+            chrom[counter] = project_chrominance(r, g, b)
+            logger.debug("Chrominance -> X = {0}, Y = {1}".format(chrom[counter][0], chrom[counter][1]))
 
-        else:
-          logger.warn("No skin pixels detected in frame {0}, using previous value".format(i))
-          # very unlikely, but it could happened and messed up all experiments (averaging of scores ...)
-          if counter == 0:
-            chrom[counter] = project_chrominance(128., 128., 128.)
           else:
-            chrom[counter] = chrom[counter-1]
+            logger.warn("No skin pixels detected in frame {0}, using previous value".format(i))
+            # very unlikely, but it could happened and messed up all experiments (averaging of scores ...)
+            if counter == 0:
+              chrom[counter] = project_chrominance(128., 128., 128.)
+            else:
+              chrom[counter] = chrom[counter-1]
 
         counter +=1
     
       elif i > end_index :
         break
 
-    # select the most stable number of consecutive frames, if asked for
-    if motion > 0:
-      n_stable_frames_to_keep = int(motion * nb_frames)
-      logger.info("Number of stable frames kept for motion -> {0}".format(n_stable_frames_to_keep))
-      index = select_stable_frames(diff_motion, n_stable_frames_to_keep)
-      logger.info("Stable segment -> {0} - {1}".format(index, index + n_stable_frames_to_keep))
-      chrom = chrom[index:(index + n_stable_frames_to_keep),:]
-
-    if plot:
-      from matplotlib import pyplot
-      f, axarr = pyplot.subplots(2, sharex=True)
-      axarr[0].plot(range(chrom.shape[0]), chrom[:, 0], 'k')
-      axarr[0].set_title("X value in the chrominance subspace")
-      axarr[1].plot(range(chrom.shape[0]), chrom[:, 1], 'k')
-      axarr[1].set_title("Y value in the chrominance subspace")
-      pyplot.show()
-
-    # now that we have the chrominance signals, apply bandpass
-    from scipy.signal import filtfilt
-    x_bandpassed = numpy.zeros(nb_frames, dtype='float64')
-    y_bandpassed = numpy.zeros(nb_frames, dtype='float64')
-    x_bandpassed = filtfilt(bandpass_filter, numpy.array([1]), chrom[:, 0])
-    y_bandpassed = filtfilt(bandpass_filter, numpy.array([1]), chrom[:, 1])
-
-    if plot:
-      from matplotlib import pyplot
-      f, axarr = pyplot.subplots(2, sharex=True)
-      axarr[0].plot(range(x_bandpassed.shape[0]), x_bandpassed, 'k')
-      axarr[0].set_title("X bandpassed")
-      axarr[1].plot(range(y_bandpassed.shape[0]), y_bandpassed, 'k')
-      axarr[1].set_title("Y bandpassed")
-      pyplot.show()
-
-    # build the final pulse signal
-    alpha = numpy.std(x_bandpassed) / numpy.std(y_bandpassed)
-    pulse = x_bandpassed - alpha * y_bandpassed
-
-    # overlap-add if window_size != 0
-    if window > 0:
-      window_size = window
-      window_stride = window_size / 2
-      for w in range(0, (len(pulse)-window_size), window_stride):
-        pulse[w:w+window_size] = 0.0
-        xw = x_bandpassed[w:w+window_size]
-        yw = y_bandpassed[w:w+window_size]
-        alpha = numpy.std(xw) / numpy.std(yw)
-        sw = xw - alpha * yw
-        sw *= numpy.hanning(window_size)
-        pulse[w:w+window_size] += sw
+    for outdir, chrom, parameters in zip(outdirs, chroms, hashes):
+
+      # select the most stable number of consecutive frames, if asked for
+      if motion > 0:
+        n_stable_frames_to_keep = int(motion * nb_frames)
+        logger.info("Number of stable frames kept for motion -> {0}".format(n_stable_frames_to_keep))
+        index = select_stable_frames(diff_motion, n_stable_frames_to_keep)
+        logger.info("Stable segment -> {0} - {1}".format(index, index + n_stable_frames_to_keep))
+        chrom = chrom[index:(index + n_stable_frames_to_keep),:]
+
+      if plot:
+        from matplotlib import pyplot
+        f, axarr = pyplot.subplots(2, sharex=True)
+        axarr[0].plot(range(chrom.shape[0]), chrom[:, 0], 'k')
+        axarr[0].set_title("X value in the chrominance subspace")
+        axarr[1].plot(range(chrom.shape[0]), chrom[:, 1], 'k')
+        axarr[1].set_title("Y value in the chrominance subspace")
+        pyplot.show()
+
+      # now that we have the chrominance signals, apply bandpass
+      x_bandpassed, y_bandpassed = zero_phase_filter(bandpass_filter, chrom, axis=0).T
+
+      if plot:
+        from matplotlib import pyplot
+        f, axarr = pyplot.subplots(2, sharex=True)
+        axarr[0].plot(range(x_bandpassed.shape[0]), x_bandpassed, 'k')
+        axarr[0].set_title("X bandpassed")
+        axarr[1].plot(range(y_bandpassed.shape[0]), y_bandpassed, 'k')
+        axarr[1].set_title("Y bandpassed")
+        pyplot.show()
+
+      # build the final pulse signal
+      alpha = numpy.std(x_bandpassed) / numpy.std(y_bandpassed)
+      pulse = x_bandpassed - alpha * y_bandpassed
+
+      # overlap-add if window_size != 0
+      if window > 0:
+        window_size = window
+        window_stride = window_size / 2
+        for w in range(0, (len(pulse)-window_size), window_stride):
+          pulse[w:w+window_size] = 0.0
+          xw = x_bandpassed[w:w+window_size]
+          yw = y_bandpassed[w:w+window_size]
+          alpha = numpy.std(xw) / numpy.std(yw)
+          sw = xw - alpha * yw
+          sw *= numpy.hanning(window_size)
+          pulse[w:w+window_size] += sw
     
-    if plot:
-      from matplotlib import pyplot
-      f, axarr = pyplot.subplots(1)
-      pyplot.plot(range(pulse.shape[0]), pulse, 'k')
-      pyplot.title("Pulse signal")
-      pyplot.show()
-
-    output_data = pulse
-
-    # saves the data into an HDF5 file with a '.hdf5' extension
-    outdir = os.path.dirname(output)
-    if not os.path.exists(outdir): bob.io.base.create_directories_safe(outdir)
-    bob.io.base.save(output_data, output)
-    logger.info("Output file saved to `%s'...", output)
+      if plot:
+        from matplotlib import pyplot
+        f, axarr = pyplot.subplots(1)
+        pyplot.plot(range(pulse.shape[0]), pulse, 'k')
+        pyplot.title("Pulse signal")
+        pyplot.show()
+
+      output_data = pulse
+
+      # saves the data into an HDF5 file with a '.hdf5' extension (or into the store)
+      output = save_signal(output_data, obj, outdir, store=store, parameters=parameters)
+      logger.info("Output saved to `%s'...", output)
+
+  # keep the new filter designs for the next runs
+  if filters and filter_bank.modified:
+    filter_bank.save(filters)
+
+  close_stores()
@@ -8,7 +8,8 @@ Usage:
            [--protocol=<string>] [--subset=<string> ...]
            [--pulsedir=<path>] 
            [--npoints=<int>] [--indent=<int>] [--quality=<float>] [--distance=<int>]
-           [--framerate=<int>] [--order=<int>] [--window=<int>] 
+           [--framerate=<int>] [--order=<int>] [--window=<int>] [--design=<string>]
+           [--filters=<path>] [--store]
            [--overwrite] [--verbose ...] [--plot] [--gridcount]
 
   %(prog)s (--help | -h)
@@ -30,8 +31,19 @@ Options:
                             [default: 0.01]
   -e, --distance=<int>      Minimum distance between detected good features to
                             track [default: 10]
-  --framerate=<int>         Framerate of the video sequence [default: 61]
+  --framerate=<int>         Framerate of the video sequence. If zero, the
+                            framerate of each video is used [default: 61]
   --order=<int>             Order of the bandpass filter [default: 128]
+  --design=<string>         Design of the bandpass filter: 'fir' or 'butter'. The
+                            Butterworth filter should be used with a much lower
+                            order (e.g. 4), and allows to filter shorter signals
+                            [default: fir].
+  --filters=<path>          HDF5 file where the designed bandpass filters are
+                            cached: they are loaded from it, and new designs are
+                            saved to it [default: ].
+  --store                   Store the signals of all objects in a single file
+                            (signals.hdf5 in the output directory) instead of
+                            one file per object.
   --window=<int>            Window size in the overlap-add procedure. A window
                             of zero means no procedure applied [default: 0].
   -O, --overwrite           By default, we don't overwrite existing files. The
@@ -72,8 +84,13 @@ import numpy
 import bob.io.base
 import bob.ip.facedetect
 
-from ...base.utils import crop_face
-from ...base.utils import build_bandpass_filter
+from ...base.utils import FaceCropper
+from ...base.utils import filter_bank
+from ...base.utils import zero_phase_filter
+from ...base.store_utils import get_parameters_hash
+from ...base.store_utils import is_up_to_date
+from ...base.store_utils import save_signal
+from ...base.store_utils import close_stores
 
 from ...cvpr14.extract_utils import kp66_to_mask
 from ...cvpr14.extract_utils import get_good_features_to_track
@@ -112,6 +129,9 @@ def main(user_input=None):
   distance = get_parameter(args, configuration, 'distance', 10)
   framerate = get_parameter(args, configuration, 'framerate', 61)
   order = get_parameter(args, configuration, 'order', 128)
+  design = get_parameter(args, configuration, 'design', 'fir')
+  filters = get_parameter(args, configuration, 'filters', '')
+  store = get_parameter(args, configuration, 'store', False)
   window = get_parameter(args, configuration, 'window', 0)
   overwrite = get_parameter(args, configuration, 'overwrite', False)
   plot = get_parameter(args, configuration, 'plot', False)
@@ -135,6 +155,11 @@ def main(user_input=None):
   except AttributeError:
     sge = 'SGE_TASK_ID' in os.environ # python3
     
+  # all grid tasks would write the same signal store at once, corrupting it
+  if sge and store:
+    logger.error("The signals cannot be stored in a single file by several grid jobs, please remove --store !")
+    sys.exit()
+
   if sge:
     pos = int(os.environ['SGE_TASK_ID']) - 1
     if pos >= len(objects):
@@ -145,25 +170,32 @@ def main(user_input=None):
     print(len(objects))
     sys.exit()
 
-  # build the bandpass filter one and for all
-  bandpass_filter = build_bandpass_filter(framerate, order, plot)
+  # the bandpass filters are designed once and for all (for each framerate)
+  if filters and os.path.exists(filters) and not filter_bank.load(filters):
+    logger.warn("Ignoring the filter cache `%s' (it cannot be read)", filters)
+
+  # what the signals are computed from
+  parameters = get_parameters_hash(dict(npoints=npoints, indent=indent, quality=quality, distance=distance, framerate=framerate, order=order, design=design, window=window))
 
   # does the actual work - for every video in the available dataset, 
   # extract the signals and dumps the results to the corresponding directory
   for obj in objects:
 
-    # expected output file
-    output = obj.make_path(pulsedir, '.hdf5')
-
-    # if output exists and not overwriting, skip this file
-    if (os.path.exists(output)) and not overwrite:
-      logger.info("Skipping output file `%s': already exists, use --overwrite to force an overwrite", output)
+    # if output exists (and is up-to-date) and not overwriting, skip this file
+    if is_up_to_date(obj, pulsedir, parameters) and not overwrite:
+      logger.info("Skipping output `%s': already exists, use --overwrite to force an overwrite", obj.path)
       continue
     
     # load video
     video = obj.load_video(configuration.dbdir)
     logger.info("Processing input video from `%s'...", video.filename)
 
+    # get the bandpass filter for the framerate of this video
+    fs = framerate
+    if fs == 0:
+      fs = video.frame_rate
+    bandpass_filter = filter_bank(fs, order, design=design, plot=plot)
+
     # number of frames
     nb_frames = len(video)
     
@@ -174,6 +206,11 @@ def main(user_input=None):
     output_data = numpy.zeros(nb_frames, dtype='float64')
     chrom = numpy.zeros((nb_frames, 2), dtype='float64')
 
+    # the faces in the current and previous frames are cropped in
+    # their own buffers, re-used for the whole sequence
+    face_cropper = FaceCropper()
+    prev_face_cropper = FaceCropper()
+
     # loop on video frames
     for i, frame in enumerate(video):
       logger.debug("Processing frame %d/%d...", i+1, len(video))
@@ -194,7 +231,7 @@ def main(user_input=None):
         
         # define the face width for the whole sequence
         facewidth = bbox.size[1]
-        face = crop_face(frame, bbox, facewidth)
+        face = face_cropper(frame, bbox, facewidth)
         good_features = get_good_features_to_track(face,npoints, quality, distance, plot)
       else:
         # subsequent frames:
@@ -204,7 +241,7 @@ def main(user_input=None):
         # -> find the (affine) transformation relating previous corners with
         #    current corners
         # -> apply this transformation to the mask
-        face = crop_face(frame, prev_bb, facewidth)
+        face = face_cropper(frame, prev_bb, facewidth)
         good_features = track_features(prev_face, face, prev_features, plot)
         project = find_transformation(prev_features, good_features)
         if project is None: 
@@ -224,7 +261,7 @@ def main(user_input=None):
         bb, quality = bob.ip.facedetect.detect_single_face(frame)
         prev_bb = bb
       
-      prev_face = crop_face(frame, prev_bb, facewidth)
+      prev_face = prev_face_cropper(frame, prev_bb, facewidth)
       prev_features = get_good_features_to_track(face, npoints, quality, distance, plot)
       if prev_features is None:
         logger.warn("Sequence {0}, frame {1} No features to track"  
@@ -249,11 +286,7 @@ def main(user_input=None):
 
 
     # now that we have the chrominance signals, apply bandpass
-    from scipy.signal import filtfilt
-    x_bandpassed = numpy.zeros(nb_frames, dtype='float64')
-    y_bandpassed = numpy.zeros(nb_frames, dtype='float64')
-    x_bandpassed = filtfilt(bandpass_filter, numpy.array([1]), chrom[:, 0])
-    y_bandpassed = filtfilt(bandpass_filter, numpy.array([1]), chrom[:, 1])
+    x_bandpassed, y_bandpassed = zero_phase_filter(bandpass_filter, chrom, axis=0).T
 
     if plot:
       from matplotlib import pyplot
@@ -290,8 +323,12 @@ def main(user_input=None):
 
     output_data = pulse
 
-    # saves the data into an HDF5 file with a '.hdf5' extension
-    out_pulsedir = os.path.dirname(output)
-    if not os.path.exists(out_pulsedir): bob.io.base.create_directories_safe(out_pulsedir)
-    bob.io.base.save(output_data, output)
-    logger.info("Output file saved to `%s'...", output)
+    # saves the data into an HDF5 file with a '.hdf5' extension (or into the store)
+    output = save_signal(output_data, obj, pulsedir, store=store, parameters=parameters)
+    logger.info("Output saved to `%s'...", output)
+
+  # keep the new filter designs for the next runs
+  if filters and filter_bank.modified:
+    filter_bank.save(filters)
+
+  close_stores()
@@ -3,6 +3,8 @@
 
 import os, sys
 import numpy
+import logging
+logger = logging.getLogger("bob.rppg.base")
 
 import bob.ip.draw
 import bob.ip.color
@@ -321,3 +323,175 @@ def compute_average_colors_wholeface(image, plot=False):
 
   green = image[1, :]
   return numpy.mean(green)
+
+
+def compute_average_colors_bbox(image, bbx, plot=False):
+  """computes the average green color within a bounding box.
+
+  This is a faster alternative to cropping (and rescaling) the face
+  before calling :py:func:`compute_average_colors_wholeface`: the mean
+  is directly computed on the bounding box area of the original image,
+  without copying it.
+
+  Note that the result slightly differs from the one obtained on the
+  cropped face, since the latter has been rescaled (bilinear interpolation)
+  and converted back to uint8 (truncation). When the face is cropped at 
+  the width of its bounding box, as in the extraction script, both values 
+  differ by less than one gray level on smooth images such as faces.
+
+  Parameters
+  ----------
+  image: numpy.ndarray 
+    The image containing the face.
+  bbx: :py:class:`bob.ip.facedetect.BoundingBox`
+    The bounding box of the face.
+  plot: bool
+    Plot the face area used to compute the mean.
+  
+  Returns
+  -------
+  color: :obj:`float`
+    The average green color inside the bounding box
+  
+  """
+  face = image[:, bbx.topleft[0]:(bbx.topleft[0] + bbx.size[0]), bbx.topleft[1]:(bbx.topleft[1] + bbx.size[1])]
+  if plot:
+    from matplotlib import pyplot
+    pyplot.imshow(numpy.rollaxis(numpy.rollaxis(face, 2),2))
+    pyplot.title('Face area used to compute the mean green value')
+    pyplot.show()
+
+  return numpy.mean(face[1], dtype='float64')
+
+
+def extract_face_and_bg_signals(video, bounding_boxes, keypoints=None, npoints=40, indent=10,
+    quality=0.01, distance=10, wholeface=False, plot=False, path=''):
+  """extracts the average green color of the face and of the background in a video.
+
+  The mask on the lower part of the face is built from the keypoints in
+  the first frame (see :py:func:`kp66_to_mask`), and is then tracked
+  across the sequence: good features to track are detected in the face of
+  the previous frame, and the mask is moved by the transformation relating
+  them to their projection in the current frame. The background is the
+  top-left corner (100x100 pixels) of the frames.
+
+  Parameters
+  ----------
+  video: iterable of numpy.ndarray
+    The frames of the video (its length must be known).
+  bounding_boxes: list of :py:class:`bob.ip.facedetect.BoundingBox`
+    The bounding box of the face in each frame. If None, the face is
+    detected in each frame.
+  keypoints: numpy.ndarray
+    The keypoints in the first frame (not needed with wholeface).
+  npoints: int
+    The number of good features to track.
+  indent: int
+    The indent (in percent of the face width) applied to keypoints to get the mask.
+  quality: float
+    The quality level of the good features to track.
+  distance: int
+    The minimum distance between detected good features to track.
+  wholeface: bool
+    If the whole face (i.e. its bounding box) is used instead of the mask.
+  plot: bool
+    If set to True, plots the intermediate results.
+  path: str
+    The path of the video, to identify it in messages.
+
+  Returns
+  -------
+  face_color: numpy.ndarray
+    The average green color in the mask (or the face), for each frame.
+  bg_color: numpy.ndarray
+    The average green color in the background, for each frame.
+
+  """
+  def _get_bbox(frame, i):
+    if bounding_boxes is not None:
+      return bounding_boxes[i]
+    import bob.ip.facedetect
+    bbox, __ = bob.ip.facedetect.detect_single_face(frame)
+    return bbox
+
+  from ..base.utils import FaceCropper
+
+  # average green color in the mask area  
+  face_color = numpy.zeros(len(video), dtype='float64')
+  # average green color in the background area
+  bg_color = numpy.zeros(len(video), dtype='float64')
+
+  # the faces in the current and previous frames are cropped in
+  # their own buffers, re-used for the whole sequence
+  face_cropper = FaceCropper()
+  prev_face_cropper = FaceCropper()
+
+  # loop on video frames
+  for i, frame in enumerate(video):
+    logger.debug("Processing frame %d/%d...", i+1, len(video))
+
+    if i == 0:
+      # first frame:
+      # -> infer the mask from the keypoints
+      # -> get "good features" inside the face
+      if not wholeface:
+        mask_points, mask = kp66_to_mask(frame, keypoints, indent, plot)
+
+      bbox = _get_bbox(frame, i)
+
+      # define the face width for the whole sequence
+      facewidth = bbox.size[1]
+      face_bbox = bbox
+
+      if not wholeface:
+        face = face_cropper(frame, bbox, facewidth)
+        good_features = get_good_features_to_track(face, npoints, quality, distance, plot)
+    else:
+      # subsequent frames:
+      # -> crop the face with the bounding_boxes of the previous frame (so
+      #    that faces are of the same size)
+      # -> get the projection of the corners detected in the previous frame
+      # -> find the (affine) transformation relating previous corners with
+      #    current corners
+      # -> apply this transformation to the mask
+      face_bbox = prev_bb
+      if not wholeface:
+        face = face_cropper(frame, prev_bb, facewidth)
+        good_features = track_features(prev_face, face, prev_features, plot)
+        project = find_transformation(prev_features, good_features)
+        if project is None: 
+          logger.warn("Sequence {0}, frame {1} : No projection was found"
+              " between previous and current frame, mask from previous frame will be used"
+              .format(path, i))
+        else:
+          mask_points = get_current_mask_points(mask_points, project)
+
+    # update stuff for the next frame:
+    # -> the previous face is the face in this frame, with its bbox (and not
+    #    with the previous one)
+    # -> the features to be tracked on the next frame are re-detected
+    prev_bb = _get_bbox(frame, i)
+
+    if not wholeface:
+      prev_face = prev_face_cropper(frame, prev_bb, facewidth)
+      prev_features = get_good_features_to_track(face, npoints, quality, distance, plot)
+      if prev_features is None:
+        logger.warn("Sequence {0}, frame {1} No features to track"  
+            " detected in the current frame, using the previous ones"
+            .format(path, i))
+        prev_features = good_features
+
+      # get the bottom face region average colors
+      face_mask = get_mask(frame, mask_points)
+      # original algorithm: green only
+      face_color[i] = compute_average_colors_mask(frame, face_mask, plot)[1]
+    else:
+      # no need to crop and rescale the face to get its mean green value
+      face_color[i] = compute_average_colors_bbox(frame, face_bbox, plot)
+
+    # get the background region average colors
+    bg_mask = numpy.zeros((frame.shape[1], frame.shape[2]), dtype=bool)
+    bg_mask[:100, :100] = True
+    bg_color[i] = compute_average_colors_mask(frame, bg_mask, plot)[1]
+
+  return face_color, bg_color
@@ -37,15 +37,22 @@ def detrend(signal, Lambda):
   filtered_signal = numpy.dot((H - numpy.linalg.inv(H + (Lambda**2) * numpy.dot(D.T, D))), signal)
   return filtered_signal
 
-def average(signal, window_size):
+def average(signal, window_size, axis=-1):
   """Moving average filter.
 
+  The average is causal: each sample is the mean of the
+  window_size last samples of the signal (the first samples
+  are averaged with zeros, as with :py:func:`scipy.signal.lfilter`).
+  It is computed with a running sum, whatever the size of the window.
+
   Parameters
   ----------
   signal: numpy.ndarray
-    The signal to filter.
+    The signal to filter. It may contain several signals.
   window_size: int
     The size of the window to compute the average.
+  axis: int
+    The axis along which the signals are averaged.
 
   Returns
   ------- 
@@ -53,9 +60,184 @@ def average(signal, window_size):
     The averaged signal.
   
   """
-  from scipy.signal import lfilter
-  a = 1.0 
-  b = numpy.zeros(window_size)
-  b += (1.0 / float(window_size))
-  filtered_signal = lfilter(b, a, signal)
-  return filtered_signal
+  signal = numpy.moveaxis(numpy.asarray(signal, dtype='float64'), axis, -1)
+  if window_size == 1:
+    return numpy.moveaxis(signal.copy(), -1, axis)
+
+  cumulative = numpy.cumsum(signal, axis=-1)
+  filtered_signal = numpy.copy(cumulative)
+  filtered_signal[..., window_size:] -= cumulative[..., :-window_size]
+  filtered_signal /= float(window_size)
+  return numpy.moveaxis(filtered_signal, -1, axis)
+
+
+class FilterPipeline(object):
+  """detrends, averages and bandpass filters a set of signals.
+
+  This applies the same processing as :py:func:`detrend`, 
+  :py:func:`average` and a zero-phase bandpass filter, but on all
+  the signals of the same length at once. The detrending system is 
+  banded, and its (Cholesky) factorization is computed once per 
+  signal length and re-used.
+
+  Attributes
+  ----------
+  Lambda: int
+    The smoothing parameter of the detrending.
+  window: int
+    The size of the window of the moving average.
+  b: numpy.ndarray
+    The coefficients of the bandpass filter (see 
+    :py:func:`bob.rppg.base.utils.zero_phase_filter`).
+
+  """
+
+  def __init__(self, Lambda, window, b):
+    """Constructor
+
+    Parameters
+    ----------
+    Lambda: int
+      The smoothing parameter of the detrending.
+    window: int
+      The size of the window of the moving average.
+    b: numpy.ndarray
+      The coefficients of the bandpass filter.
+
+    """
+    self.Lambda = Lambda
+    self.window = window
+    self.b = b
+    self._factors = {}
+
+  def _get_factor(self, length):
+    """gets the Cholesky factor of the detrending system (I + Lambda^2 D'D).
+
+    The system is pentadiagonal, and stored in the upper banded form
+    of :py:func:`scipy.linalg.cholesky_banded`. The diagonals of D'D,
+    D being the second-order difference matrix, are sums of shifted 
+    products of the coefficients (1, -2, 1).
+
+    """
+    if length not in self._factors:
+      from scipy.linalg import cholesky_banded
+      system = numpy.zeros((3, length), dtype='float64')
+      # main diagonal: 1, 5, 6, ..., 6, 5, 1
+      system[2, :-2] += 1.0
+      system[2, 1:-1] += 4.0
+      system[2, 2:] += 1.0
+      # first upper diagonal: -2, -4, ..., -4, -2
+      system[1, 1:-1] -= 2.0
+      system[1, 2:] -= 2.0
+      # second upper diagonal: 1, ..., 1
+      system[0, 2:] = 1.0
+      system *= self.Lambda**2
+      system[2] += 1.0
+      self._factors[length] = cholesky_banded(system)
+    return self._factors[length]
+
+  def detrend(self, signals, out=None):
+    """detrends signals of the same length.
+
+    Parameters
+    ----------
+    signals: numpy.ndarray
+      The signals, one per row.
+    out: numpy.ndarray
+      The array where the detrended signals are written (a new one if None).
+
+    Returns
+    -------
+    detrended: numpy.ndarray
+      The detrended signals.
+
+    """
+    from scipy.linalg import cho_solve_banded
+    signals = numpy.asarray(signals, dtype='float64')
+    trends = cho_solve_banded((self._get_factor(signals.shape[1]), False), signals.T).T
+    # the trends are replaced by the detrended signals, if no output is given
+    return numpy.subtract(signals, trends, out=trends if out is None else out)
+
+  def process(self, signals):
+    """applies the whole processing on signals of the same length.
+
+    Parameters
+    ----------
+    signals: numpy.ndarray
+      The signals, one per row.
+
+    Returns
+    -------
+    detrended: numpy.ndarray
+      The detrended signals.
+    averaged: numpy.ndarray
+      The detrended and averaged signals.
+    filtered: numpy.ndarray
+      The final (bandpassed) signals.
+
+    """
+    from ..base.utils import zero_phase_filter
+    detrended = self.detrend(signals)
+    averaged = average(detrended, self.window, axis=1)
+    filtered = zero_phase_filter(self.b, averaged, axis=1)
+    return detrended, averaged, filtered
+
+  def filter(self, signals):
+    """applies the whole processing on signals of the same length.
+
+    Unlike :py:meth:`process`, the intermediate signals are not kept:
+    the detrending and the averaging are done in place, in two work
+    buffers of the size of the signals.
+
+    Parameters
+    ----------
+    signals: numpy.ndarray
+      The signals, one per row.
+
+    Returns
+    -------
+    filtered: numpy.ndarray
+      The final (bandpassed) signals.
+
+    """
+    from ..base.utils import zero_phase_filter
+    work = numpy.array(signals, dtype='float64')
+    detrended = self.detrend(work)
+    if self.window > 1:
+      # same moving average as average(), using the signals buffer 
+      # for the cumulative sums
+      numpy.cumsum(detrended, axis=1, out=work)
+      numpy.subtract(work[:, self.window:], work[:, :-self.window], out=detrended[:, self.window:])
+      detrended[:, :self.window] = work[:, :self.window]
+      detrended /= float(self.window)
+    return zero_phase_filter(self.b, detrended, axis=1)
+
+  def __call__(self, signals):
+    """filters a list of signals.
+
+    Signals are grouped by length, and each group is processed 
+    at once (see :py:meth:`filter`).
+
+    Parameters
+    ----------
+    signals: list of numpy.ndarray
+      The signals to filter.
+
+    Returns
+    -------
+    filtered: list of numpy.ndarray
+      The filtered signals (in the same order). They are contiguous rows
+      of the arrays of their groups, and can be saved as they are.
+
+    """
+    groups = {}
+    for i, signal in enumerate(signals):
+      groups.setdefault(len(signal), []).append(i)
+
+    filtered = [None] * len(signals)
+    for length, indices in groups.items():
+      # the FFT filtering gives a reversed view
+      result = numpy.ascontiguousarray(self.filter([signals[i] for i in indices]))
+      for i, row in zip(indices, result):
+        filtered[i] = row
+    return filtered
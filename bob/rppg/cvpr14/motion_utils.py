@@ -31,7 +31,61 @@ def build_segments(signal, length):
   segments = numpy.reshape(signal[:end_index], (number_of_segments, length))
   return segments, end_index
 
-def prune_segments(segments, threshold):
+def get_threshold(stds, cutoff):
+  """finds the threshold on the standard deviation of segments.
+
+  The threshold is chosen such that the given proportion of
+  segments having the largest standard deviations are above it. 
+  It is the same value as the one obtained by sorting all the 
+  standard deviations in decreasing order, but a partial sort
+  is used instead.
+
+  Parameters
+  ----------
+  stds: numpy.ndarray
+    The standard deviations of all the segments.
+  cutoff: float
+    The proportion of segments to be discarded.
+
+  Returns
+  -------
+  threshold: float
+    Threshold on the standard deviation.
+
+  """
+  return get_thresholds(stds, [cutoff])[0]
+
+def get_thresholds(stds, cutoffs):
+  """finds the thresholds on the standard deviation of segments for several cutoffs.
+
+  All thresholds are obtained from a single partial sort of
+  the standard deviations (see :py:func:`get_threshold`).
+
+  Parameters
+  ----------
+  stds: numpy.ndarray
+    The standard deviations of all the segments.
+  cutoffs: list of float
+    The proportions of segments to be discarded.
+
+  Returns
+  -------
+  thresholds: list of float
+    Threshold on the standard deviation, for each cutoff.
+
+  """
+  stds = numpy.asarray(stds, dtype='float64').ravel()
+  indices = []
+  for cutoff in cutoffs:
+    cut_index = int(cutoff * stds.shape[0]) + 1
+    if cut_index >= stds.shape[0]:
+      raise ValueError("Cannot discard {0} percent of {1} segments".format(100*cutoff, stds.shape[0]))
+    # index of the threshold in the standard deviations sorted in increasing order
+    indices.append(stds.shape[0] - 1 - cut_index)
+  partitioned = numpy.partition(stds, indices)
+  return [float(partitioned[index]) for index in indices]
+
+def prune_segments(segments, threshold, stds=None):
   """remove segments.
 
   Segments are removed if their standard deviation is higher than
@@ -43,6 +97,9 @@ def prune_segments(segments, threshold):
     The set of segments.
   threshold: float
     Threshold on the standard deviation.
+  stds: numpy.ndarray
+    The standard deviations of the segments, if they 
+    have already been computed.
 
   Returns
   -------
@@ -56,25 +113,22 @@ def prune_segments(segments, threshold):
     Used for plotting purposes.
   
   """
-  final_segments = []
-  gaps = [] # the first kept segment could not have a gap
-  cut_index = [] 
-  for i in range(segments.shape[0]):
-    # if this segment is below the threshold, keep it
-    if numpy.std(segments[i], ddof=1) <= threshold:
-      final_segments.append(segments[i])
-      # if this is the first segment, no need to take care of the gap
-      if len(final_segments) == 1:
-        gaps.append(False)
-      # if this is not the first segment, and that previous one was discarded, gap
-      elif numpy.std(segments[i-1], ddof=1) > threshold :
-        gaps.append(True)
-      # this is not the first, but the previous one has not been discarded
-      else:
-        gaps.append(False)
-    else:
-      cut_index.append(((i*segments.shape[1]), ((i+1)*segments.shape[1])))
-  return numpy.array(final_segments), gaps, cut_index
+  if stds is None:
+    stds = numpy.std(segments, axis=1, ddof=1)
+  kept = stds <= threshold
+
+  # a kept segment has a gap if the previous one was discarded,
+  # except if it is the first kept segment
+  gaps = numpy.zeros(segments.shape[0], dtype=bool)
+  gaps[1:] = stds[:-1] > threshold
+  gaps &= kept
+  first = numpy.flatnonzero(kept)
+  if first.size > 0:
+    gaps[first[0]] = False
+
+  length = segments.shape[1]
+  cut_index = [(int(i*length), int((i+1)*length)) for i in numpy.flatnonzero(~kept)]
+  return segments[kept], gaps[kept].tolist(), cut_index
 
 def build_final_signal(segments, gaps):
   """builds the final signal with remaining segments.
@@ -93,20 +147,15 @@ def build_final_signal(segments, gaps):
     The final signal.
   
   """
-  signal_length = segments.shape[0] * segments.shape[1]
-  final_signal = numpy.zeros(signal_length)
-  gap = 0
-  for i in range(segments.shape[0]):
-    final_signal[i*segments.shape[1]: (i+1)*segments.shape[1]] = segments[i]
-    # fill the vertical gap
-    if gaps[i]:
-      # compute the gap between this segment and the previous one
-      gap = segments[i, 0] - segments[i-1, -1]
-      # correct all of the following segments (they will be shifted)
-      segments[i:, :] -= gap
-      # build the final signal using the shifted segment
-      final_signal[i*segments.shape[1]:(i+1)*segments.shape[1]] = segments[i]
-  return final_signal
+  # each segment is shifted by the sum of the gaps up to it: since the
+  # previous segment was shifted as much as the current one, the gap is
+  # the same in the original segments
+  segments = numpy.asarray(segments, dtype='float64')
+  indices = numpy.flatnonzero(numpy.asarray(gaps, dtype=bool))
+  gap_values = numpy.zeros(segments.shape[0], dtype='float64')
+  gap_values[indices] = segments[indices, 0] - segments[indices - 1, -1]
+  offsets = numpy.cumsum(gap_values)
+  return (segments - offsets[:, numpy.newaxis]).ravel()
 
 def build_final_signal_cvpr14(segments, gaps):
   """builds the final signal with remaining segments.
@@ -133,21 +182,15 @@ def build_final_signal_cvpr14(segments, gaps):
     The final signal.
   
   """
-  signal_length = segments.shape[0] * segments.shape[1]
-  final_signal = numpy.zeros(signal_length)
-  gap = 0
-  original_segments = numpy.copy(segments)
-  for i in range(segments.shape[0]):
-    final_signal[i*segments.shape[1]: (i+1)*segments.shape[1]] = segments[i]
-    # fill the vertical gap
-    if gaps[i]:
-      # compute the gap between this segment and the previous one
-      # XXX the bug is here: gap is computed using the original signal
-      # XXX instead of the corrected one (if there was one or more previous gaps)
-      gap = segments[i, 0] - original_segments[i-1, -1]
-      # correct all of the following segments (they will be shifted)
-      segments[i:, :] -= gap
-      # build the final signal using the shifted segment
-      final_signal[i*segments.shape[1]:(i+1)*segments.shape[1]] = segments[i]
-  return final_signal
-
+  segments = numpy.asarray(segments, dtype='float64')
+  indices = numpy.flatnonzero(numpy.asarray(gaps, dtype=bool))
+  # XXX the bug is here: the gap is computed using the original signal
+  # XXX instead of the corrected one (if there was one or more previous gaps),
+  # XXX such that each segment is only shifted by the last gap before it
+  last_gap = numpy.full(segments.shape[0], -1, dtype=numpy.intp)
+  last_gap[indices] = indices
+  last_gap = numpy.maximum.accumulate(last_gap)
+  offsets = numpy.zeros(segments.shape[0], dtype='float64')
+  shifted = last_gap >= 0
+  offsets[shifted] = segments[last_gap[shifted], 0] - segments[last_gap[shifted] - 1, -1]
+  return (segments - offsets[:, numpy.newaxis]).ravel()
@@ -8,7 +8,7 @@ Usage:
            [--protocol=<string>] [--subset=<string> ...]
            [--facedir=<path>] [--bgdir=<path>] 
            [--npoints=<int>] [--indent=<int>] [--quality=<float>] [--distance=<int>]
-           [--wholeface] [--overwrite] [--verbose ...] [--plot] [--gridcount]
+           [--wholeface] [--store] [--overwrite] [--verbose ...] [--plot] [--gridcount]
 
   %(prog)s (--help | -h)
   %(prog)s (--version | -V)
@@ -23,7 +23,7 @@ Options:
   -f, --facedir=<path>      The path to the directory where signal extracted 
                             from the face area will be stored [default: face]
   -b, --bgdir=<path>        The path to the directory where signal extracted 
-                            from the background area will be stored [default: background]
+                            from the background area will be stored [default: bg]
   -n, --npoints=<int>       Number of good features to track [default: 40]
   -i, --indent=<int>        Indent (in percent of the face width) to apply to 
                             keypoints to get the mask [default: 10]
@@ -39,6 +39,9 @@ Options:
                             execution graphically. We'll plot some interactions.
   -g, --gridcount           Prints the number of objects to process and exits.
   -w, --wholeface           Consider the whole face region instead of the mask.
+  --store                   Store the signals of all objects in a single file
+                            (signals.hdf5 in the output directories) instead of
+                            one file per object.
 
 
 Example:
@@ -69,18 +72,13 @@ version = pkg_resources.require('bob.rppg.base')[0].version
 
 import numpy
 import bob.io.base
-import bob.ip.facedetect
 
-from ...base.utils import crop_face
+from ...base.store_utils import get_parameters_hash
+from ...base.store_utils import is_up_to_date
+from ...base.store_utils import save_signal
+from ...base.store_utils import close_stores
 
-from ..extract_utils import kp66_to_mask
-from ..extract_utils import get_good_features_to_track
-from ..extract_utils import track_features
-from ..extract_utils import find_transformation
-from ..extract_utils import get_current_mask_points
-from ..extract_utils import get_mask 
-from ..extract_utils import compute_average_colors_mask
-from ..extract_utils import compute_average_colors_wholeface
+from ..extract_utils import extract_face_and_bg_signals
 
 def main(user_input=None):
 
@@ -110,6 +108,7 @@ def main(user_input=None):
   plot = get_parameter(args, configuration, 'plot', False)
   gridcount = get_parameter(args, configuration, 'gridcount', False)
   wholeface = get_parameter(args, configuration, 'wholeface', False)
+  store = get_parameter(args, configuration, 'store', False)
   verbosity_level = get_parameter(args, configuration, 'verbose', 0)
 
   # if the user wants more verbosity, lowers the logging level
@@ -130,6 +129,11 @@ def main(user_input=None):
   except AttributeError:
     sge = 'SGE_TASK_ID' in os.environ # python3
     
+  # all grid tasks would write the same signal store at once, corrupting it
+  if sge and store:
+    logger.error("The signals cannot be stored in a single file by several grid jobs, please remove --store !")
+    sys.exit()
+
   if sge:
     pos = int(os.environ['SGE_TASK_ID']) - 1
     if pos >= len(objects):
@@ -140,17 +144,16 @@ def main(user_input=None):
     print(len(objects))
     sys.exit()
 
+  # what the signals are computed from
+  parameters = get_parameters_hash(dict(npoints=npoints, indent=indent, quality=quality, distance=distance, wholeface=wholeface))
+
   # does the actual work - for every video in the available dataset, 
   # extract the signals and dumps the results to the corresponding directory
   for obj in objects:
 
-    # expected output file
-    output_face = obj.make_path(facedir, '.hdf5')
-    output_bg = obj.make_path(bgdir, '.hdf5')
-
-    # if output exists and not overwriting, skip this file
-    if (os.path.exists(output_face) and os.path.exists(output_bg)) and not overwrite:
-      logger.info("Skipping output file `%s': already exists, use --overwrite to force an overwrite", output_face)
+    # if output exists (and is up-to-date) and not overwriting, skip this file
+    if (is_up_to_date(obj, facedir, parameters) and is_up_to_date(obj, bgdir, parameters)) and not overwrite:
+      logger.info("Skipping output `%s': already exists, use --overwrite to force an overwrite", obj.path)
       continue
     
     # load video
@@ -160,94 +163,20 @@ def main(user_input=None):
     # load the result of face detection
     bounding_boxes = obj.load_face_detection() 
 
-    # average green color in the mask area  
-    face_color = numpy.zeros(len(video), dtype='float64')
-    # average green color in the background area
-    bg_color = numpy.zeros(len(video), dtype='float64')
-
-    # loop on video frames
-    for i, frame in enumerate(video):
-      logger.debug("Processing frame %d/%d...", i+1, len(video))
-
-      if i == 0:
-        # first frame:
-        # -> load the keypoints detected by DMRF
-        # -> infer the mask from the keypoints
-        # -> detect the face
-        # -> get "good features" inside the face
-        if not wholeface:
-          kpts = obj.load_drmf_keypoints()
-          mask_points, mask = kp66_to_mask(frame, kpts, indent, plot)
-
-        try: 
-          bbox = bounding_boxes[i]
-        except NameError:
-          bbox, quality = bob.ip.facedetect.detect_single_face(frame)
-        
-        # define the face width for the whole sequence
-        facewidth = bbox.size[1]
-        face = crop_face(frame, bbox, facewidth)
-        
-        if not wholeface:
-          good_features = get_good_features_to_track(face, npoints, quality, distance, plot)
-      else:
-        # subsequent frames:
-        # -> crop the face with the bounding_boxes of the previous frame (so
-        #    that faces are of the same size)
-        # -> get the projection of the corners detected in the previous frame
-        # -> find the (affine) transformation relating previous corners with
-        #    current corners
-        # -> apply this transformation to the mask
-        face = crop_face(frame, prev_bb, facewidth)
-        if not wholeface:
-          good_features = track_features(prev_face, face, prev_features, plot)
-          project = find_transformation(prev_features, good_features)
-          if project is None: 
-            logger.warn("Sequence {0}, frame {1} : No projection was found"
-                " between previous and current frame, mask from previous frame will be used"
-                .format(obj.path, i))
-          else:
-            mask_points = get_current_mask_points(mask_points, project)
-
-      # update stuff for the next frame:
-      # -> the previous face is the face in this frame, with its bbox (and not
-      #    with the previous one)
-      # -> the features to be tracked on the next frame are re-detected
-      try: 
-        prev_bb = bounding_boxes[i]
-      except NameError:
-        bb, quality = bob.ip.facedetect.detect_single_face(frame)
-        prev_bb = bb
-
-      
-      if not wholeface:
-        prev_face = crop_face(frame, prev_bb, facewidth)
-        prev_features = get_good_features_to_track(face, npoints, quality, distance, plot)
-        if prev_features is None:
-          logger.warn("Sequence {0}, frame {1} No features to track"  
-              " detected in the current frame, using the previous ones"
-              .format(obj.path, i))
-          prev_features = good_features
-
-        # get the bottom face region average colors
-        face_mask = get_mask(frame, mask_points)
-        # original algorithm: green only
-        face_color[i] = compute_average_colors_mask(frame, face_mask, plot)[1]
-      else:
-        face_color[i] = compute_average_colors_wholeface(face, plot)
-
-      # get the background region average colors
-      bg_mask = numpy.zeros((frame.shape[1], frame.shape[2]), dtype=bool)
-      bg_mask[:100, :100] = True
-      bg_color[i] = compute_average_colors_mask(frame, bg_mask, plot)[1]
-
-    # saves the data into an HDF5 file with a '.hdf5' extension
-    out_facedir = os.path.dirname(output_face)
-    if not os.path.exists(out_facedir): bob.io.base.create_directories_safe(out_facedir)
-    bob.io.base.save(face_color, output_face)
-    logger.info("Output file saved to `%s'...", output_face)
-
-    out_bgdir = os.path.dirname(output_bg)
-    if not os.path.exists(out_bgdir): bob.io.base.create_directories_safe(out_bgdir)
-    bob.io.base.save(bg_color, output_bg)
-    logger.info("Output file saved to `%s'...", output_bg)
+    # the keypoints detected by DRMF, to infer the mask in the first frame
+    keypoints = None
+    if not wholeface:
+      keypoints = obj.load_drmf_keypoints()
+
+    # track the mask, and get the average colors in the mask and in the background
+    face_color, bg_color = extract_face_and_bg_signals(video, bounding_boxes, keypoints,
+        npoints, indent, quality, distance, wholeface, plot, obj.path)
+
+    # saves the data into an HDF5 file with a '.hdf5' extension (or into the store)
+    output_face = save_signal(face_color, obj, facedir, store=store, parameters=parameters)
+    logger.info("Output saved to `%s'...", output_face)
+
+    output_bg = save_signal(bg_color, obj, bgdir, store=store, parameters=parameters)
+    logger.info("Output saved to `%s'...", output_bg)
+
+  close_stores()
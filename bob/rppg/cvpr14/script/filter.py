@@ -7,7 +7,8 @@ Usage:
   %(prog)s <configuration>
            [--protocol=<string>] [--subset=<string> ...]  
            [--verbose ...] [--plot] [--motiondir=<path>] [--pulsedir=<path>]
-           [--Lambda=<int>] [--window=<int>] [--framerate=<int>] [--order=<int>]
+           [--Lambda=<int>] [--window=<int>] [--framerate=<int>] [--order=<int>] [--design=<string>]
+           [--filters=<path>] [--store]
            [--overwrite] [--gridcount]
 
   %(prog)s (--help | -h)
@@ -31,6 +32,17 @@ Options:
   --window=<int>            Moving window length [default: 23]
   -f, --framerate=<int>     Frame-rate of the video sequence [default: 61]
   --order=<int>             Bandpass filter order [default: 128]
+  --design=<string>         Design of the bandpass filter: 'fir' or 'butter'. The
+                            Butterworth filter should be used with a much lower
+                            order (e.g. 4), and allows to filter shorter signals
+                            [default: fir].
+  --filters=<path>          HDF5 file where the designed bandpass filters are
+                            cached: they are loaded from it, and new designs are
+                            saved to it [default: ].
+  --store                   Store the signals of all objects in a single file
+                            (signals.hdf5 in the output directory) instead of
+                            one file per object. Input signals are read from
+                            such a file if it exists.
   -O, --overwrite           By default, we don't overwrite existing files. The
                             processing will skip those so as to go faster. If you
                             still would like me to overwrite them, set this flag.
@@ -71,10 +83,15 @@ version = pkg_resources.require('bob.rppg.base')[0].version
 import numpy
 import bob.io.base
 
-from ..filter_utils import detrend
-from ..filter_utils import average 
-from ...base.utils import build_bandpass_filter 
+from ..filter_utils import FilterPipeline
+from ...base.utils import filter_bank
+from ...base.utils import get_padlen
 from ...base.utils import get_parameter
+from ...base.store_utils import get_parameters_hash
+from ...base.store_utils import is_up_to_date
+from ...base.store_utils import load_signal
+from ...base.store_utils import save_signals
+from ...base.store_utils import close_stores
 
 def main(user_input=None):
 
@@ -100,6 +117,9 @@ def main(user_input=None):
   window = get_parameter(args, configuration, 'window', 23)
   framerate = get_parameter(args, configuration, 'framerate', 61)
   order = get_parameter(args, configuration, 'order', 128)
+  design = get_parameter(args, configuration, 'design', 'fir')
+  filters = get_parameter(args, configuration, 'filters', '')
+  store = get_parameter(args, configuration, 'store', False)
   overwrite = get_parameter(args, configuration, 'overwrite', False)
   plot = get_parameter(args, configuration, 'plot', False)
   gridcount = get_parameter(args, configuration, 'gridcount', False)
@@ -123,6 +143,11 @@ def main(user_input=None):
   except AttributeError:
     sge = 'SGE_TASK_ID' in os.environ # python3
     
+  # all grid tasks would write the same signal store at once, corrupting it
+  if sge and store:
+    logger.error("The signals cannot be stored in a single file by several grid jobs, please remove --store !")
+    sys.exit()
+
   if sge:
     pos = int(os.environ['SGE_TASK_ID']) - 1
     if pos >= len(objects):
@@ -134,64 +159,72 @@ def main(user_input=None):
     sys.exit()
 
   # build the bandpass filter one and for all
-  b = build_bandpass_filter(framerate, order, plot)
+  if filters and os.path.exists(filters) and not filter_bank.load(filters):
+    logger.warn("Ignoring the filter cache `%s' (it cannot be read)", filters)
+  b = filter_bank(framerate, order, design=design, plot=plot)
+
+  # the whole processing, applied to all signals of the same length at once
+  pipeline = FilterPipeline(Lambda, window, b)
 
   ################
   ### LET'S GO ###
   ################
+  filtered_objects = []
+  signals = []
+  hashes = []
   for obj in objects:
 
-    # expected output file
-    output = obj.make_path(pulsedir, '.hdf5')
-
-    # if output exists and not overwriting, skip this file
-    if os.path.exists(output) and not overwrite:
-      logger.info("Skipping output file `%s': already exists, use --overwrite to force an overwrite", output)
+    # if output exists (and is up-to-date) and not overwriting, skip this file
+    parameters = get_parameters_hash(dict(Lambda=Lambda, window=window, framerate=framerate, order=order, design=design), obj, [motiondir])
+    if is_up_to_date(obj, pulsedir, parameters) and not overwrite:
+      logger.info("Skipping output `%s': already exists, use --overwrite to force an overwrite", obj.path)
       continue
 
     # load the corrected color signals of shape (3, nb_frames)
     logger.info("Filtering in signal from `%s'...", obj.path)
-    motion_file = obj.make_path(motiondir, '.hdf5')
     try:
-      motion_corrected_signal = bob.io.base.load(motion_file)
+      motion_corrected_signal = load_signal(obj, motiondir)
     except (IOError, RuntimeError) as e:
       logger.warn("Skipping file `%s' (no motion corrected signal file available)", obj.path)
       continue
 
     # check whether the signal is long enough to be filtered with the bandpass of this order
-    padlen = 3 * len(b)
-    if motion_corrected_signal.shape[0] < padlen:
+    padlen = get_padlen(b)
+    if motion_corrected_signal.shape[0] <= padlen:
       logger.warn("Skipping file {0} (unable to bandpass filter it, the signal is probably not long enough)".format(obj.path))
       continue
 
-    # detrend
-    green_detrend = detrend(motion_corrected_signal, Lambda)
-    # average
-    green_averaged = average(green_detrend, window)
-    # bandpass
-    from scipy.signal import filtfilt
-    green_bandpassed = filtfilt(b, numpy.array([1]), green_averaged)
-
-    # plot the result
-    if plot:
-      from matplotlib import pyplot
+    filtered_objects.append(obj)
+    signals.append(motion_corrected_signal)
+    hashes.append(parameters)
+
+  # detrend, average and bandpass all signals
+  filtered_signals = pipeline(signals)
+
+  # plot the results
+  if plot:
+    from matplotlib import pyplot
+    for motion_corrected_signal, green_bandpassed in zip(signals, filtered_signals):
+      green_detrend, green_averaged, __ = pipeline.process(motion_corrected_signal[numpy.newaxis, :])
       f, ax = pyplot.subplots(4, sharex=True)
       ax[0].plot(range(motion_corrected_signal.shape[0]), motion_corrected_signal, 'g')
       ax[0].set_title('Original signal')
-      ax[1].plot(range(motion_corrected_signal.shape[0]), green_detrend, 'g')
+      ax[1].plot(range(motion_corrected_signal.shape[0]), green_detrend[0], 'g')
       ax[1].set_title('After detrending')
-      ax[2].plot(range(motion_corrected_signal.shape[0]), green_averaged, 'g')
+      ax[2].plot(range(motion_corrected_signal.shape[0]), green_averaged[0], 'g')
       ax[2].set_title('After averaging')
       ax[3].plot(range(motion_corrected_signal.shape[0]), green_bandpassed, 'g')
       ax[3].set_title('Bandpassed signal')
       pyplot.show()
 
-    output_data = numpy.copy(green_bandpassed)
+  # saves all the data at once into HDF5 files with a '.hdf5' extension (or into the store)
+  outputs = save_signals(filtered_signals, filtered_objects, pulsedir, store=store, parameters=hashes)
+  for output in sorted(set(outputs)):
+    logger.info("Output saved to `%s'...", output)
 
-    # saves the data into an HDF5 file with a '.hdf5' extension
-    pulse_outdir = os.path.dirname(output)
-    if not os.path.exists(pulse_outdir): bob.io.base.create_directories_safe(pulse_outdir)
-    bob.io.base.save(output_data, output)
-    logger.info("Output file saved to `%s'...", output)
-  
+  # keep the new filter designs for the next runs
+  if filters and filter_bank.modified:
+    filter_bank.save(filters)
+
+  close_stores()
   return 0
@@ -8,7 +8,7 @@ Usage:
            [--protocol=<string>] [--subset=<string> ...] 
            [--facedir=<path>][--bgdir=<path>] [--illumdir=<path>] 
            [--start=<int>] [--end=<int>] [--step=<float>] 
-           [--length=<int>] [--overwrite] [--gridcount]
+           [--length=<int>] [--store] [--overwrite] [--gridcount]
            [--verbose ...] [--plot]
 
   %(prog)s (--help | -h)
@@ -27,7 +27,7 @@ Options:
   -f, --facedir=<path>      The path to the directory containing the average
                             green color on the face region [default: face].
   -b, --bgdir=<path>        The path to the directory containing the average
-                            green color on the background [default: background]
+                            green color on the background [default: bg]
   -o, --illumdir=<path>       The path to the output directory where the resulting
                             corrected signal will be stored [default: illumination]
   -s, --start=<int>         Index of the starting frame [default: 0].
@@ -35,6 +35,10 @@ Options:
                             processing will be done to the last frame [default: 0].
   --step=<float>            Adaptation step of the filter weights [default: 0.05].
   --length=<int>            Length of the filter [default: 1].
+  --store                   Store the signals of all objects in a single file
+                            (signals.hdf5 in the output directory) instead of
+                            one file per object. Input signals are read from
+                            such files if they exist.
   -O, --overwrite           By default, we don't overwrite existing files. The
                             processing will skip those so as to go faster. If you
                             still would like me to overwrite them, set this flag.
@@ -70,6 +74,11 @@ import numpy
 import bob.io.base
 
 from ...base.utils import get_parameter
+from ...base.store_utils import get_parameters_hash
+from ...base.store_utils import is_up_to_date
+from ...base.store_utils import load_signal
+from ...base.store_utils import save_signal
+from ...base.store_utils import close_stores
 from ..illum_utils import rectify_illumination
 
 def main(user_input=None):
@@ -97,6 +106,7 @@ def main(user_input=None):
   end = get_parameter(args, configuration, 'end', 0)
   step = get_parameter(args, configuration, 'step', 0.05)
   length = get_parameter(args, configuration, 'length', 1)
+  store = get_parameter(args, configuration, 'store', False)
   overwrite = get_parameter(args, configuration, 'overwrite', False)
   plot = get_parameter(args, configuration, 'plot', False)
   gridcount = get_parameter(args, configuration, 'gridcount', False)
@@ -120,6 +130,11 @@ def main(user_input=None):
   except AttributeError:
     sge = 'SGE_TASK_ID' in os.environ # python3
     
+  # all grid tasks would write the same signal store at once, corrupting it
+  if sge and store:
+    logger.error("The signals cannot be stored in a single file by several grid jobs, please remove --store !")
+    sys.exit()
+
   if sge:
     pos = int(os.environ['SGE_TASK_ID']) - 1
     if pos >= len(objects):
@@ -135,27 +150,22 @@ def main(user_input=None):
   # and then correct face illumination by removing the global illumination
   for obj in objects:
 
-    # expected output file
-    output = obj.make_path(illumdir, '.hdf5')
-    logger.debug("expected output file -> {0}".format(output))
-
-    # if output exists and not overwriting, skip this file
-    if os.path.exists(output) and not overwrite:
-      logger.info("Skipping output file `%s': already exists, use --overwrite to force an overwrite", output)
+    # if output exists (and is up-to-date) and not overwriting, skip this file
+    parameters = get_parameters_hash(dict(start=start, end=end, step=step, length=length), obj, [facedir, bgdir])
+    if is_up_to_date(obj, illumdir, parameters) and not overwrite:
+      logger.info("Skipping output `%s': already exists, use --overwrite to force an overwrite", obj.path)
       continue
 
     # load the color signal of the face
-    face_file = obj.make_path(facedir, '.hdf5')
     try:
-      face = bob.io.base.load(face_file)
+      face = load_signal(obj, facedir)
     except (IOError, RuntimeError) as e:
       logger.warn("Skipping file `%s' (no face file available)", obj.path)
       continue
 
     # load the color signal of the background
-    bg_file = obj.make_path(bgdir, '.hdf5')
     try:
-      bg = bob.io.base.load(bg_file)
+      bg = load_signal(obj, bgdir)
     except (IOError, RuntimeError) as e:
       logger.warn("Skipping file `%s' (no background file available)", obj.path)
       continue
@@ -191,10 +201,9 @@ def main(user_input=None):
       axarr[2].set_title(r"$g_{IR}$: illumination rectified signal")
       pyplot.show()
 
-    # saves the data into an HDF5 file with a '.hdf5' extension
-    outputdir = os.path.dirname(output)
-    if not os.path.exists(outputdir): bob.io.base.create_directories_safe(outputdir)
-    bob.io.base.save(corrected_green, output)
-    logger.info("Output file saved to `%s'...", output)
+    # saves the data into an HDF5 file with a '.hdf5' extension (or into the store)
+    output = save_signal(corrected_green, obj, illumdir, store=store, parameters=parameters)
+    logger.info("Output saved to `%s'...", output)
 
+  close_stores()
   return 0
@@ -8,7 +8,8 @@ Usage:
            [--protocol=<string>] [--subset=<string> ...] 
            [--verbose ...] [--plot] [--illumdir=<path>] [--motiondir=<path>]
            [--seglength=<int>] [--save-threshold=<path>] [--load-threshold=<path>]
-           [--cutoff=<float>] [--cvpr14] [--overwrite]
+           [--cutoff=<float>] [--cutoffs=<list>] [--single-pass] 
+           [--cvpr14] [--store] [--overwrite]
 
   %(prog)s (--help | -h)
   %(prog)s (--version | -V)
@@ -31,8 +32,20 @@ Options:
   -L, --seglength=<int>         The length of the segments [default: 61]
       --cutoff=<float>          Specify the percentage of largest segments to
                                 determine the threshold [default: 0.05].
+      --cutoffs=<list>          Comma-separated list of cutoffs (e.g. 0.05,0.1). If
+                                given, the motion corrected signals are computed for
+                                all cutoffs in a single pass, and stored in the 
+                                cutoff_<value> sub-directories of the output
+                                directory, along with their threshold [default: ].
       --save-threshold=<path>   Save the found threshold to cut segments [default: threshold.txt]. 
       --load-threshold=<path>   Load the threshold to cut segments [default: None]. 
+      --single-pass             Compute the threshold and cut the segments in
+                                the same run, reading each file only once. The
+                                threshold is still saved (see --save-threshold).
+      --store                   Store the signals of all objects in a single file
+                                (signals.hdf5 in the output directories) instead
+                                of one file per object. Input signals are read
+                                from such a file if it exists.
   -O, --overwrite               By default, we don't overwrite existing files. The
                                 processing will skip those so as to go faster. If you
                                 still would like me to overwrite them, set this flag.
@@ -70,7 +83,14 @@ import numpy
 import bob.io.base
 
 from ...base.utils import get_parameter
+from ...base.utils import get_list
+from ...base.store_utils import get_parameters_hash
+from ...base.store_utils import is_up_to_date
+from ...base.store_utils import load_signal
+from ...base.store_utils import save_signal
+from ...base.store_utils import close_stores
 from ..motion_utils import build_segments
+from ..motion_utils import get_thresholds
 from ..motion_utils import prune_segments 
 from ..motion_utils import build_final_signal 
 from ..motion_utils import build_final_signal_cvpr14
@@ -99,7 +119,10 @@ def main(user_input=None):
   cutoff = get_parameter(args, configuration, 'cutoff', 0.05)
   save_threshold = get_parameter(args, configuration, 'save-threshold', 'threshold.txt')
   load_threshold = get_parameter(args, configuration, 'load-threshold', '')
+  cutoffs = get_list(get_parameter(args, configuration, 'cutoffs', ''))
+  single_pass = get_parameter(args, configuration, 'single_pass', False)
   cvpr14 = get_parameter(args, configuration, 'cvpr14', False)
+  store = get_parameter(args, configuration, 'store', False)
   overwrite = get_parameter(args, configuration, 'overwrite', False)
   plot = get_parameter(args, configuration, 'plot', False)
   verbosity_level = get_parameter(args, configuration, 'verbose', 0)
@@ -116,17 +139,33 @@ def main(user_input=None):
     logger.error("Please provide a database in your configuration file !")
     sys.exit()
 
+  # the signals for the different cutoffs are stored in their own directories, 
+  # with their threshold, and are all computed in a single pass
+  if cutoffs:
+    if load_threshold != 'None':
+      logger.error("A threshold cannot be loaded when several cutoffs are given !")
+      sys.exit()
+    single_pass = True
+    motiondirs = [os.path.join(motiondir, 'cutoff_{0}'.format(c)) for c in cutoffs]
+    save_thresholds = [os.path.join(d, os.path.basename(save_threshold)) for d in motiondirs]
+  else:
+    cutoffs = [cutoff]
+    motiondirs = [motiondir]
+    save_thresholds = [save_threshold]
+
   # determine the threshold for the standard deviation to be applied to the segments
   # this part is not executed if a threshold is provided
   if load_threshold == 'None':
     all_stds = []
+    # with a single pass, the signals and the standard deviations 
+    # of their segments are kept to cut the segments afterwards
+    signals = {}
     for obj in objects:
 
       # load the llumination corrected signal
       logger.debug("Computing standard deviations in color signals from `%s'...", obj.path)
-      illum_file = obj.make_path(illumdir, '.hdf5')
       try:
-        color = bob.io.base.load(illum_file)
+        color = load_signal(obj, illumdir)
       except (IOError, RuntimeError) as e:
         logger.warn("Skipping file `%s' (no color signals file available)",  obj.path)
         continue
@@ -139,84 +178,104 @@ def main(user_input=None):
       # get the standard deviation in the segments
       green_segments, __ = build_segments(color, seglength)
       std_green = numpy.std(green_segments, 1, ddof=1)
-      all_stds.extend(std_green.tolist())
+      all_stds.append(std_green)
+      if single_pass:
+        signals[obj.path] = (color, std_green)
 
     logger.info("Standard deviations are computed")
 
-    # sort the std and find the 5% at the top to get the threshold
-    sorted_stds = sorted(all_stds, reverse=True)
-    cut_index = int(cutoff * len(all_stds)) + 1
-    threshold = sorted_stds[cut_index]
-    logger.info("The threshold was {0} (removing {1} percent of the largest segments)".format(threshold, 100*cutoff))
+    # find the 5% at the top to get the threshold
+    if all_stds:
+      all_stds = numpy.concatenate(all_stds)
+    thresholds = get_thresholds(all_stds, cutoffs)
+    for threshold, cutoff, threshold_file in zip(thresholds, cutoffs, save_thresholds):
+      logger.info("The threshold was {0} (removing {1} percent of the largest segments)".format(threshold, 100*cutoff))
 
-    # write threshold to file
-    f = open(save_threshold, 'w')
-    f.write(str(threshold))
-    f.close()
+      # write threshold to file
+      threshold_dir = os.path.dirname(threshold_file)
+      if threshold_dir and not os.path.exists(threshold_dir): bob.io.base.create_directories_safe(threshold_dir)
+      f = open(threshold_file, 'w')
+      f.write(str(threshold))
+      f.close()
 
   else:
     # load threshold
     f = open(load_threshold, 'r')
-    threshold = float(f.readline().rstrip())
+    thresholds = [float(f.readline().rstrip())]
+
+  if load_threshold != 'None' or single_pass:
 
     # cut segments where the std is too large
     for obj in objects:
 
-      # expected output file
-      output = obj.make_path(motiondir, '.hdf5')
+      # what the signals are computed from, for each cutoff
+      hashes = [get_parameters_hash(dict(seglength=seglength, threshold=float(threshold), cvpr14=cvpr14), obj, [illumdir])
+          for threshold in thresholds]
 
-      # if output exists and not overwriting, skip this file
-      if os.path.exists(output) and not overwrite:
-        logger.info("Skipping output file `%s': already exists, use --overwrite to force an overwrite", output)
+      # if output exists (one per cutoff, and up-to-date) and not overwriting, skip this file
+      if all([is_up_to_date(obj, d, h) for d, h in zip(motiondirs, hashes)]) and not overwrite:
+        logger.info("Skipping output `%s': already exists, use --overwrite to force an overwrite", obj.path)
         continue
 
-      # load the color signals
+      # load the color signals (if not already done to get the threshold)
       logger.debug("Eliminating motion in color signals from `%s'...", obj.path)
-      illum_file = obj.make_path(illumdir, '.hdf5')
-      try:
-        color = bob.io.base.load(illum_file)
-      except (IOError, RuntimeError) as e:
-        logger.warn("Skipping file `%s' (no color signals file available)",
-            obj.path)
-        continue
+      std_green = None
+      if single_pass and load_threshold == 'None':
+        # files that were skipped when computing the threshold are skipped here too
+        if obj.path not in signals:
+          continue
+        color, std_green = signals[obj.path]
+      else:
+        try:
+          color = load_signal(obj, illumdir)
+        except (IOError, RuntimeError) as e:
+          logger.warn("Skipping file `%s' (no color signals file available)",
+              obj.path)
+          continue
         
-      # skip this file if there are NaN ...
-      if numpy.isnan(numpy.sum(color)):
-        logger.warn("Skipping file `%s' (NaN in file)",  obj.path)
-        continue
+        # skip this file if there are NaN ...
+        if numpy.isnan(numpy.sum(color)):
+          logger.warn("Skipping file `%s' (NaN in file)",  obj.path)
+          continue
 
       # divide the signals into segments
       green_segments, end_index = build_segments(color, seglength)
-      # remove segments with high variability
-      pruned_segments, gaps, cut_index = prune_segments(green_segments, threshold)
+
+      for threshold, d, parameters in zip(thresholds, motiondirs, hashes):
+
+        if is_up_to_date(obj, d, parameters) and not overwrite:
+          logger.info("Skipping output `%s' in `%s': already exists, use --overwrite to force an overwrite", obj.path, d)
+          continue
+
+        # remove segments with high variability
+        pruned_segments, gaps, cut_index = prune_segments(green_segments, threshold, std_green)
       
-      # build final signal - but be sure that there are some segments left !
-      if pruned_segments.shape[0] == 0:
-        logger.warn("All segments have been discared in {0}".format(obj.path))
-        continue
-      if cvpr14:
-        corrected_green = build_final_signal_cvpr14(pruned_segments, gaps)
-      else:
-        corrected_green = build_final_signal(pruned_segments, gaps)
+        # build final signal - but be sure that there are some segments left !
+        if pruned_segments.shape[0] == 0:
+          logger.warn("All segments have been discared in {0}".format(obj.path))
+          continue
+        if cvpr14:
+          corrected_green = build_final_signal_cvpr14(pruned_segments, gaps)
+        else:
+          corrected_green = build_final_signal(pruned_segments, gaps)
      
-      if plot:
-        from matplotlib import pyplot
-        f, axarr = pyplot.subplots(2, sharex=True)
-        axarr[0].plot(range(end_index), color[:end_index], 'g')
-        xmax, xmin, ymax, ymin = axarr[0].axis()
-        for cuts in cut_index:
-          axarr[0].vlines(cuts[0], ymin, ymax, color='black', linewidths='2')
-          axarr[0].vlines(cuts[1], ymin, ymax, color='black', linewidths='2')
-          axarr[0].plot(range(cuts[0],cuts[1]), color[cuts[0]:cuts[1]], 'r')
-        axarr[0].set_title('Original color pulse')
-        axarr[1].plot(range(corrected_green.shape[0]), corrected_green, 'g')
-        axarr[1].set_title('Motion corrected color pulse')
-        pyplot.show()
-
-      # saves the data into an HDF5 file with a '.hdf5' extension
-      outputdir = os.path.dirname(output)
-      if not os.path.exists(outputdir): bob.io.base.create_directories_safe(outputdir)
-      bob.io.base.save(corrected_green, output)
-      logger.info("Output file saved to `%s'...", output)
-
+        if plot:
+          from matplotlib import pyplot
+          f, axarr = pyplot.subplots(2, sharex=True)
+          axarr[0].plot(range(end_index), color[:end_index], 'g')
+          xmax, xmin, ymax, ymin = axarr[0].axis()
+          for cuts in cut_index:
+            axarr[0].vlines(cuts[0], ymin, ymax, color='black', linewidths='2')
+            axarr[0].vlines(cuts[1], ymin, ymax, color='black', linewidths='2')
+            axarr[0].plot(range(cuts[0],cuts[1]), color[cuts[0]:cuts[1]], 'r')
+          axarr[0].set_title('Original color pulse')
+          axarr[1].plot(range(corrected_green.shape[0]), corrected_green, 'g')
+          axarr[1].set_title('Motion corrected color pulse')
+          pyplot.show()
+
+        # saves the data into an HDF5 file with a '.hdf5' extension (or into the store)
+        output = save_signal(corrected_green, obj, d, store=store, parameters=parameters)
+        logger.info("Output saved to `%s'...", output)
+
+  close_stores()
   return 0
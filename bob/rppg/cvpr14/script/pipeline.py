@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Li's CVPR 2014 algorithm, from videos to heart-rates (%(version)s)
+
+Usage:
+  %(prog)s <configuration>
+           [--protocol=<string>] [--subset=<string> ...]
+           [--facedir=<path>] [--bgdir=<path>] [--illumdir=<path>]
+           [--motiondir=<path>] [--pulsedir=<path>] [--hrdir=<path>]
+           [--save=<list>]
+           [--npoints=<int>] [--indent=<int>] [--quality=<float>]
+           [--distance=<int>] [--wholeface]
+           [--start=<int>] [--end=<int>] [--step=<float>] [--length=<int>]
+           [--seglength=<int>] [--cutoff=<float>] [--threshold=<float>] [--cvpr14]
+           [--Lambda=<int>] [--window=<int>] [--framerate=<int>] [--order=<int>]
+           [--design=<string>] [--filters=<path>]
+           [--nsegments=<int>] [--nfft=<int>] [--resolution=<float>]
+           [--interpolation=<string>]
+           [--store] [--overwrite] [--verbose ...]
+
+  %(prog)s (--help | -h)
+  %(prog)s (--version | -V)
+
+
+Options:
+  -h, --help                Show this help message and exit
+  -v, --verbose             Increases the verbosity (may appear multiple times)
+  -V, --version             Show version
+  -p, --protocol=<string>   Protocol [default: all].
+  -s, --subset=<string>     Data subset to load. If nothing is provided
+                            all the data sets will be loaded.
+  --facedir=<path>          The directory of the signals extracted from the
+                            face area [default: face].
+  --bgdir=<path>            The directory of the signals extracted from the
+                            background area [default: bg].
+  --illumdir=<path>         The directory of the illumination corrected signals
+                            [default: illumination].
+  --motiondir=<path>        The directory of the motion corrected signals
+                            [default: motion].
+  --pulsedir=<path>         The directory of the filtered signals
+                            [default: pulse].
+  --hrdir=<path>            The directory of the heart-rates [default: hr].
+  --save=<list>             Comma-separated list of the signals to save: face,
+                            background, illumination, motion, pulse and/or hr.
+                            The other signals are only kept in memory, while
+                            they are needed [default: hr].
+  --npoints=<int>           Number of good features to track [default: 40]
+  --indent=<int>            Indent (in percent of the face width) to apply to
+                            keypoints to get the mask [default: 10]
+  --quality=<float>         Quality level of the good features to track
+                            [default: 0.01]
+  --distance=<int>          Minimum distance between detected good features to
+                            track [default: 10]
+  --wholeface               Consider the whole face region instead of the mask.
+  --start=<int>             Index of the starting frame [default: 0].
+  --end=<int>               Index of the ending frame. If set to zero, the
+                            processing will be done to the last frame [default: 0].
+  --step=<float>            Adaptation step of the filter weights [default: 0.05].
+  --length=<int>            Length of the filter [default: 1].
+  --seglength=<int>         The length of the segments [default: 61]
+  --cutoff=<float>          Specify the percentage of largest segments to
+                            determine the threshold [default: 0.05].
+  --threshold=<float>       The threshold to cut segments. If set to zero, it
+                            is determined on all the objects, using the cutoff
+                            [default: 0.0].
+  --cvpr14                  Original motion elimination, as provided by the
+                            authors of the paper (contains a bug, provided for
+                            reproducibilty purposes).
+  --Lambda=<int>            Lambda parameter for detrending (see article) [default: 300]
+  --window=<int>            Moving window length [default: 23]
+  --framerate=<int>         Frame-rate of the video sequence [default: 61]
+  --order=<int>             Bandpass filter order [default: 128]
+  --design=<string>         Design of the bandpass filter: 'fir' or 'butter'
+                            [default: fir].
+  --filters=<path>          HDF5 file where the designed bandpass filters are
+                            cached [default: ].
+  --nsegments=<int>         Number of overlapping segments in Welch procedure
+                            [default: 12].
+  --nfft=<int>              Number of points to compute the FFT. If set to zero,
+                            the smallest power of two not smaller than the
+                            segment length is used [default: 8192].
+  --resolution=<float>      Resolution of the spectrum, in beats per minute. If
+                            set, the spectrum is only computed in the band of
+                            plausible heart-rates [default: 0.0].
+  --interpolation=<string>  Interpolation of the peak of the spectrum between
+                            frequency bins: none, parabolic or gaussian
+                            [default: none].
+  --store                   Store the signals of all objects in a single file
+                            (signals.hdf5 in the output directories) instead of
+                            one file per object.
+  -O, --overwrite           By default, the signals which are up-to-date are
+                            not computed again. If you would like me to
+                            recompute all of them, set this flag.
+
+Examples:
+
+  To compute the heart-rates, without saving the intermediate signals:
+
+    $ %(prog)s config.py -v
+
+  To also keep the extracted signals, so that changing the parameters of the
+  next steps does not extract them again:
+
+    $ %(prog)s config.py --save face,background,hr -v
+
+
+See '%(prog)s --help' for more information.
+
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import functools
+import pkg_resources
+
+import bob.core
+logger = bob.core.log.setup("bob.rppg.base")
+
+from docopt import docopt
+
+from bob.extension.config import load
+
+version = pkg_resources.require('bob.rppg.base')[0].version
+
+import numpy
+
+from ...base.utils import filter_bank
+from ...base.utils import get_padlen
+from ...base.utils import get_parameter
+from ...base.utils import get_list
+from ...base.frequency_utils import get_segment_length
+from ...base.frequency_utils import get_band_frequencies
+from ...base.frequency_utils import get_nfft
+from ...base.frequency_utils import welch
+from ...base.frequency_utils import find_peak_frequency
+from ...base.pipeline_utils import Stage
+from ...base.pipeline_utils import Pipeline
+from ...base.store_utils import close_stores
+from ..extract_utils import extract_face_and_bg_signals
+from ..illum_utils import rectify_illumination
+from ..motion_utils import build_segments
+from ..motion_utils import get_threshold
+from ..motion_utils import prune_segments
+from ..motion_utils import build_final_signal
+from ..motion_utils import build_final_signal_cvpr14
+from ..filter_utils import FilterPipeline
+
+
+def extract(obj, dbdir='', npoints=40, indent=10, quality=0.01, distance=10, wholeface=False):
+  """extracts the signals of the face and of the background from the video of an object."""
+  video = obj.load_video(dbdir)
+  logger.info("Processing input video from `%s'...", video.filename)
+  keypoints = None
+  if not wholeface:
+    keypoints = obj.load_drmf_keypoints()
+  return extract_face_and_bg_signals(video, obj.load_face_detection(), keypoints,
+      npoints, indent, quality, distance, wholeface, path=obj.path)
+
+def rectify(obj, face, bg, start=0, end=0, step=0.05, length=1):
+  """removes the global illumination from the signal of the face."""
+  end_index = end if end > 0 else face.shape[0]
+  if end_index > face.shape[0]:
+    logger.warn("Skipping Sequence {0} : not long enough ({1})".format(obj.path, face.shape[0]))
+    return None
+  return rectify_illumination(face[start:end_index], bg[start:end_index], step, length)
+
+def eliminate_motion(objects, inputs, seglength=61, cutoff=0.05, threshold=0.0, cvpr14=False):
+  """removes the segments with a large standard deviation from the signals.
+
+  If no threshold is given, it is determined on the segments of all signals.
+
+  """
+  segments = []
+  for obj, (color,) in zip(objects, inputs):
+    if numpy.isnan(numpy.sum(color)):
+      logger.warn("Skipping file `%s' (NaN in file)",  obj.path)
+      segments.append(None)
+      continue
+    green_segments, __ = build_segments(color, seglength)
+    segments.append((green_segments, numpy.std(green_segments, 1, ddof=1)))
+
+  valid = [s for s in segments if s is not None]
+  if not valid:
+    return segments
+  if threshold <= 0:
+    threshold = get_threshold(numpy.concatenate([std for __, std in valid]), cutoff)
+    logger.info("The threshold was {0} (removing {1} percent of the largest segments)".format(threshold, 100*cutoff))
+
+  results = []
+  for obj, s in zip(objects, segments):
+    if s is None:
+      results.append(None)
+      continue
+    pruned_segments, gaps, __ = prune_segments(s[0], threshold, s[1])
+    if pruned_segments.shape[0] == 0:
+      logger.warn("All segments have been discared in {0}".format(obj.path))
+      results.append(None)
+    elif cvpr14:
+      results.append(build_final_signal_cvpr14(pruned_segments, gaps))
+    else:
+      results.append(build_final_signal(pruned_segments, gaps))
+  return results
+
+def filter_signals(objects, inputs, Lambda=300, window=23, framerate=61, order=128, design='fir'):
+  """detrends, averages and bandpass filters all signals at once."""
+  b = filter_bank(framerate, order, design=design)
+  padlen = get_padlen(b)
+  indices = []
+  for i, (obj, (signal,)) in enumerate(zip(objects, inputs)):
+    if signal.shape[0] <= padlen:
+      logger.warn("Skipping file {0} (unable to bandpass filter it, the signal is probably not long enough)".format(obj.path))
+      continue
+    indices.append(i)
+
+  results = [None] * len(objects)
+  filtered = FilterPipeline(Lambda, window, b)([inputs[i][0] for i in indices])
+  for i, signal in zip(indices, filtered):
+    results[i] = signal
+  return results
+
+def get_heart_rate(obj, signal, framerate=61, nsegments=12, nfft=8192, resolution=0.0, interpolation='none'):
+  """finds the heart-rate as the peak of the spectrum of the pulse signal."""
+  frequencies = None
+  if resolution > 0:
+    frequencies = get_band_frequencies(resolution)
+  segment_length = get_segment_length(signal.shape[0], nsegments)
+  segment_nfft = nfft if nfft > 0 else get_nfft(segment_length)
+  if frequencies is None and segment_nfft < segment_length:
+    logger.warn("Skipping file `%s' (nfft < nperseg)", obj.path)
+    return None
+  green_f, green_psd = welch(signal, framerate, segment_length, nfft=segment_nfft, frequencies=frequencies)
+  hr = find_peak_frequency(green_f, green_psd, interpolation=interpolation) * 60.0
+  logger.info("Heart rate of `{0}' = {1}".format(obj.path, hr))
+  return numpy.array([hr], dtype='float64')
+
+
+def main(user_input=None):
+
+  # Parse the command-line arguments
+  if user_input is not None:
+      arguments = user_input
+  else:
+      arguments = sys.argv[1:]
+
+  prog = os.path.basename(sys.argv[0])
+  completions = dict(prog=prog, version=version,)
+  args = docopt(__doc__ % completions, argv=arguments, version='Li CVPR14 pipeline (%s)' % version,)
+
+  # load configuration file
+  configuration = load([os.path.join(args['<configuration>'])])
+
+  # get various parameters, either from config file or command-line
+  protocol = get_parameter(args, configuration, 'protocol', 'all')
+  subset = get_parameter(args, configuration, 'subset', None)
+  directories = {
+      'face': get_parameter(args, configuration, 'facedir', 'face'),
+      'background': get_parameter(args, configuration, 'bgdir', 'bg'),
+      'illumination': get_parameter(args, configuration, 'illumdir', 'illumination'),
+      'motion': get_parameter(args, configuration, 'motiondir', 'motion'),
+      'pulse': get_parameter(args, configuration, 'pulsedir', 'pulse'),
+      'hr': get_parameter(args, configuration, 'hrdir', 'hr'),
+      }
+  save = get_list(get_parameter(args, configuration, 'save', 'hr'), str)
+  npoints = get_parameter(args, configuration, 'npoints', 40)
+  indent = get_parameter(args, configuration, 'indent', 10)
+  quality = get_parameter(args, configuration, 'quality', 0.01)
+  distance = get_parameter(args, configuration, 'distance', 10)
+  wholeface = get_parameter(args, configuration, 'wholeface', False)
+  start = get_parameter(args, configuration, 'start', 0)
+  end = get_parameter(args, configuration, 'end', 0)
+  step = get_parameter(args, configuration, 'step', 0.05)
+  length = get_parameter(args, configuration, 'length', 1)
+  seglength = get_parameter(args, configuration, 'seglength', 61)
+  cutoff = get_parameter(args, configuration, 'cutoff', 0.05)
+  threshold = get_parameter(args, configuration, 'threshold', 0.0)
+  cvpr14 = get_parameter(args, configuration, 'cvpr14', False)
+  Lambda = get_parameter(args, configuration, 'Lambda', 300)
+  window = get_parameter(args, configuration, 'window', 23)
+  framerate = get_parameter(args, configuration, 'framerate', 61)
+  order = get_parameter(args, configuration, 'order', 128)
+  design = get_parameter(args, configuration, 'design', 'fir')
+  filters = get_parameter(args, configuration, 'filters', '')
+  nsegments = get_parameter(args, configuration, 'nsegments', 12)
+  nfft = get_parameter(args, configuration, 'nfft', 8192)
+  resolution = get_parameter(args, configuration, 'resolution', 0.0)
+  interpolation = get_parameter(args, configuration, 'interpolation', 'none')
+  store = get_parameter(args, configuration, 'store', False)
+  overwrite = get_parameter(args, configuration, 'overwrite', False)
+  verbosity_level = get_parameter(args, configuration, 'verbose', 0)
+
+  # if the user wants more verbosity, lowers the logging level
+  from bob.core.log import set_verbosity_level
+  set_verbosity_level(logger, verbosity_level)
+
+  if hasattr(configuration, 'database'):
+    objects = configuration.database.objects(protocol, subset)
+  else:
+    logger.error("Please provide a database in your configuration file !")
+    sys.exit()
+
+  # the stages of the algorithm: the parameters of the extraction are the
+  # ones of the extraction script, so that the signals it saved are re-used
+  pipeline = Pipeline([
+      Stage('extract', [], ['face', 'background'], functools.partial(extract, dbdir=configuration.dbdir),
+        dict(npoints=npoints, indent=indent, quality=quality, distance=distance, wholeface=wholeface)),
+      Stage('illumination', ['face', 'background'], ['illumination'], rectify,
+        dict(start=start, end=end, step=step, length=length)),
+      Stage('motion', ['illumination'], ['motion'], eliminate_motion,
+        dict(seglength=seglength, cutoff=cutoff, threshold=threshold, cvpr14=cvpr14),
+        batch=True, all_objects=(threshold <= 0)),
+      Stage('filter', ['motion'], ['pulse'], filter_signals,
+        dict(Lambda=Lambda, window=window, framerate=framerate, order=order, design=design), batch=True),
+      Stage('hr', ['pulse'], ['hr'], get_heart_rate,
+        dict(framerate=framerate, nsegments=nsegments, nfft=nfft, resolution=resolution, interpolation=interpolation)),
+      ])
+
+  if filters and os.path.exists(filters) and not filter_bank.load(filters):
+    logger.warn("Ignoring the filter cache `%s' (it cannot be read)", filters)
+
+  try:
+    computed = pipeline.run(objects, directories, save, store=store, overwrite=overwrite)
+  except ValueError as e:
+    logger.error(str(e))
+    sys.exit()
+
+  if not computed:
+    logger.info("All the signals are up-to-date, use --overwrite to force a recomputation")
+  for stage in pipeline.stages:
+    if stage.name in computed:
+      logger.info("Stage `{0}': {1} objects processed".format(stage.name, computed[stage.name]))
+
+  # keep the new filter designs for the next runs
+  if filters and filter_bank.modified:
+    filter_bank.save(filters)
+
+  close_stores()
+  return 0
@@ -222,6 +222,25 @@ def test_prune_segments():
   assert cut_index[1] == (40, 50)
 
 
+def test_get_threshold():
+  """
+  Test the threshold on the standard deviation of segments
+  """
+  stds = numpy.random.rand(1000)
+
+  from bob.rppg.cvpr14.motion_utils import get_threshold
+  for cutoff in [0.0, 0.05, 0.5]:
+    sorted_stds = sorted(stds.tolist(), reverse=True)
+    assert get_threshold(stds, cutoff) == sorted_stds[int(cutoff * 1000) + 1]
+
+  # cannot discard all segments
+  nose.tools.assert_raises(ValueError, get_threshold, stds, 1.0)
+
+  # several cutoffs at once
+  from bob.rppg.cvpr14.motion_utils import get_thresholds
+  thresholds = get_thresholds(stds, [0.5, 0.05, 0.1])
+  assert thresholds == [get_threshold(stds, c) for c in [0.5, 0.05, 0.1]]
+
 def test_build_final_signal():
   """
   Test the building of the final signal
@@ -237,6 +256,62 @@ def test_build_final_signal():
   assert signal.shape[0] == 100
   assert numpy.array_equal(signal, numpy.ones(100))
 
+def test_build_final_signal_cvpr14():
+  """
+  Test the building of the final signal, with the bug of the original code
+  """
+  segments = numpy.ones((10, 10))
+  segments[4:] += 4
+  segments[7:] += 2
+  gaps = [False] * 10
+  gaps[4] = True
+  gaps[7] = True
+
+  # the offsets of all previous gaps are accounted for
+  from bob.rppg.cvpr14.motion_utils import build_final_signal
+  signal = build_final_signal(segments, gaps)
+  assert numpy.array_equal(signal, numpy.ones(100))
+
+  # only the gap at the last discontinuity is accounted for
+  from bob.rppg.cvpr14.motion_utils import build_final_signal_cvpr14
+  signal = build_final_signal_cvpr14(segments, gaps)
+  assert numpy.array_equal(signal[:70], numpy.ones(70))
+  assert numpy.array_equal(signal[70:], 5 * numpy.ones(30))
+
+def _legacy_build_final_signal(segments, gaps, cvpr14=False):
+  """the original (segment by segment) stitching, as a reference."""
+  segments = numpy.copy(segments)
+  original_segments = numpy.copy(segments)
+  final_signal = numpy.zeros(segments.shape[0] * segments.shape[1])
+  for i in range(segments.shape[0]):
+    final_signal[i*segments.shape[1]: (i+1)*segments.shape[1]] = segments[i]
+    if gaps[i]:
+      if cvpr14:
+        gap = segments[i, 0] - original_segments[i-1, -1]
+      else:
+        gap = segments[i, 0] - segments[i-1, -1]
+      segments[i:, :] -= gap
+      final_signal[i*segments.shape[1]:(i+1)*segments.shape[1]] = segments[i]
+  return final_signal
+
+def test_build_final_signal_legacy():
+  """
+  Test that the stitching gives the same signals as the original loop
+  """
+  from bob.rppg.cvpr14.motion_utils import build_segments, prune_segments
+  from bob.rppg.cvpr14.motion_utils import build_final_signal, build_final_signal_cvpr14
+  numpy.random.seed(0)
+  for k in range(300):
+    signal = numpy.cumsum(numpy.random.randn(1000)) * numpy.random.uniform(0.1, 100)
+    segments, __ = build_segments(signal, 61)
+    stds = numpy.std(segments, 1, ddof=1)
+    pruned, gaps, __ = prune_segments(segments, numpy.percentile(stds, 70))
+    original = numpy.copy(pruned)
+    assert numpy.allclose(build_final_signal(pruned, gaps), _legacy_build_final_signal(pruned, gaps))
+    assert numpy.allclose(build_final_signal_cvpr14(pruned, gaps), _legacy_build_final_signal(pruned, gaps, cvpr14=True))
+    # the segments are left untouched
+    assert numpy.array_equal(pruned, original)
+
 def test_detrend():
   """
   Test the detrend filter
@@ -269,3 +344,117 @@ def test_average():
   filtered = average(signal, 17)
   assert filtered[0] == signal[0] / 17.0 
   assert numpy.all(signal[17:] - filtered[17:] < 1e-15)
+
+  # same result as the equivalent FIR filter
+  from scipy.signal import lfilter
+  signal = numpy.random.randn(100)
+  filtered = average(signal, 7)
+  assert numpy.allclose(filtered, lfilter(numpy.ones(7) / 7.0, 1.0, signal))
+
+  # several signals at once
+  signals = numpy.random.randn(100, 3)
+  filtered = average(signals, 7, axis=0)
+  for i in range(3):
+    assert numpy.allclose(filtered[:, i], average(signals[:, i], 7))
+
+def test_filter_pipeline():
+  """
+  Test the detrending, averaging and bandpass filtering of several signals at once
+  """
+  from scipy.signal import filtfilt
+  from bob.rppg.base.utils import build_bandpass_filter
+  from bob.rppg.cvpr14.filter_utils import detrend, average, FilterPipeline
+  b = build_bandpass_filter(30, 64)
+  signals = [numpy.random.randn(n) for n in [300, 400, 300]]
+
+  pipeline = FilterPipeline(300, 23, b)
+  filtered = pipeline(signals)
+  assert len(filtered) == 3
+  for signal, result in zip(signals, filtered):
+    reference = filtfilt(b, [1], average(detrend(signal, 300), 23))
+    assert result.shape == signal.shape
+    assert numpy.allclose(result, reference)
+
+  # the in-place processing gives the same signals as the step by step one
+  stacked = numpy.vstack([signals[0], signals[2]])
+  detrended, averaged, result = pipeline.process(stacked)
+  assert numpy.allclose(detrended, [detrend(signals[0], 300), detrend(signals[2], 300)])
+  assert numpy.array_equal(pipeline.filter(stacked), result)
+
+def test_compute_average_colors_bbox():
+  """
+  Test the mean green computation inside a bounding box, against
+  the mean green computed on the cropped face
+  """
+  # smooth image, with a gradient in the face area
+  x, y = numpy.meshgrid(numpy.arange(100), numpy.arange(100))
+  image = numpy.zeros((3, 100, 100), dtype='uint8')
+  image[1] = (50 + x + 0.5*y).astype('uint8')
+
+  from bob.ip.facedetect import BoundingBox
+  bbox = BoundingBox((20, 30), (50, 40))
+
+  from bob.rppg.cvpr14.extract_utils import compute_average_colors_bbox
+  mean_green = compute_average_colors_bbox(image, bbox)
+  assert mean_green == numpy.mean(image[1, 20:70, 30:70])
+
+  # documented deviation with respect to the cropped and rescaled face
+  from bob.rppg.base.utils import crop_face
+  from bob.rppg.cvpr14.extract_utils import compute_average_colors_wholeface
+  face = crop_face(image, bbox, bbox.size[1])
+  assert numpy.abs(mean_green - compute_average_colors_wholeface(face)) < 1.0
+
+def test_pipeline_reuses_extracted_signals():
+  """
+  Test that the pipeline uses the signals saved by the extraction script with its default settings
+  """
+  from docopt import docopt
+  from bob.rppg.base.utils import get_parameter
+  from bob.rppg.base.store_utils import get_parameters_hash, save_signal, load_signal, close_stores
+  from bob.rppg.cvpr14.script import extract_face_and_bg_signals, pipeline
+
+  import tempfile, shutil
+  tmpdir = tempfile.mkdtemp()
+  cwd = os.getcwd()
+  try:
+    os.chdir(tmpdir)
+    configuration = os.path.join(tmpdir, 'config.py')
+    with open(configuration, 'w') as f:
+      f.write("import os\n"
+          "class _Object(object):\n"
+          "  def __init__(self, path):\n"
+          "    self.path = path\n"
+          "  def make_path(self, directory, extension):\n"
+          "    return os.path.join(directory, self.path + extension)\n"
+          "  def load_video(self, dbdir):\n"
+          "    raise RuntimeError('the video of `{0}` should not be decoded'.format(self.path))\n"
+          "class _Database(object):\n"
+          "  def objects(self, protocol, subset):\n"
+          "    return [_Object('client01/video01'), _Object('client02/video01')]\n"
+          "database = _Database()\n"
+          "dbdir = ''\n")
+
+    # the directories and the parameters of the extraction script, by default
+    args = docopt(extract_face_and_bg_signals.__doc__ % dict(prog='extract', version='0'), argv=[configuration])
+    facedir = get_parameter(args, object(), 'facedir', 'face')
+    bgdir = get_parameter(args, object(), 'bgdir', 'bg')
+    parameters = get_parameters_hash(dict(npoints=40, indent=10, quality=0.01, distance=10, wholeface=False))
+
+    class _Object(object):
+      def __init__(self, path):
+        self.path = path
+      def make_path(self, directory, extension):
+        return os.path.join(directory, self.path + extension)
+    objects = [_Object('client01/video01'), _Object('client02/video01')]
+    for obj in objects:
+      save_signal(numpy.random.rand(200), obj, facedir, parameters=parameters)
+      save_signal(numpy.random.rand(200), obj, bgdir, parameters=parameters)
+    close_stores()
+
+    assert pipeline.main([configuration, '--save=illumination']) == 0
+    for obj in objects:
+      assert load_signal(obj, 'illumination').shape == (200,)
+    close_stores()
+  finally:
+    os.chdir(cwd)
+    shutil.rmtree(tmpdir)
@@ -7,7 +7,8 @@ Usage:
   %(prog)s <configuration> [--protocol=<string>] [--subset=<string> ...] 
            [--verbose ...] [--plot]
            [--skindir=<path>] 
-           [--overwrite] [--threshold=<float>] [--skininit]
+           [--overwrite] [--threshold=<float>] [--skininit] [--skin-alpha=<float>]
+           [--lut-bits=<int>] [--thresholds=<list>] [--store]
            [--gridcount] 
 
   %(prog)s (--help | -h)
@@ -30,6 +31,26 @@ Options:
                             still would like me to overwrite them, set this flag.
   --threshold=<float>       Threshold on the skin probability map [default: 0.5].
   --skininit                If you want to reinitialize the skin model at each frame.
+  --lut-bits=<int>          Number of bits per color channel of the lookup table
+                            used to get the skin masks. Zero means that no lookup
+                            table is used. With 8 bits, the masks are the same as
+                            the ones of the skin color filter; with less bits,
+                            they differ on dark pixels. Not used when the skin 
+                            model is re-estimated from scratch at each frame
+                            [default: 0].
+  --skin-alpha=<float>      With --skininit, the weight of the current frame in
+                            the online update of the skin model. Zero means that
+                            the model is re-estimated from scratch at each frame
+                            [default: 0.0].
+  --thresholds=<list>       Comma-separated list of thresholds on the skin
+                            probability map (e.g. 0.3,0.5,0.7). If given, the
+                            skin colors for all thresholds are computed in a
+                            single pass on the video, and stored in the
+                            threshold_<value> sub-directories of the output
+                            directory [default: ].
+  --store                   Store the signals of all objects in a single file
+                            (signals.hdf5 in the output directories) instead of
+                            one file per object.
   --gridcount               Tells the number of objects and exits.
 
 
@@ -61,8 +82,17 @@ import bob.ip.skincolorfilter
 
 from bob.extension.config import load
 from ...base.utils import get_parameter
-
-from ...base.utils import crop_face
+from ...base.utils import get_list
+from ...base.store_utils import get_parameters_hash
+from ...base.store_utils import is_up_to_date
+from ...base.store_utils import save_signal
+from ...base.store_utils import close_stores
+
+from ...base.utils import FaceCropper
+from ...base.skin_utils import SkinColorLUT
+from ...base.skin_utils import OnlineSkinColorModel
+from ...base.skin_utils import compute_skin_probability
+from ...base.skin_utils import compute_threshold_statistics
 from ..extract_utils import compute_average_colors_mask
 
 def main(user_input=None):
@@ -86,6 +116,10 @@ def main(user_input=None):
   skindir = get_parameter(args, configuration, 'skindir', 'skin')
   threshold = get_parameter(args, configuration, 'threshold', 0.5)
   skininit = get_parameter(args, configuration, 'skininit', False)
+  skin_alpha = get_parameter(args, configuration, 'skin_alpha', 0.0)
+  lut_bits = get_parameter(args, configuration, 'lut_bits', 0)
+  thresholds = get_list(get_parameter(args, configuration, 'thresholds', ''))
+  store = get_parameter(args, configuration, 'store', False)
   overwrite = get_parameter(args, configuration, 'overwrite', False)
   plot = get_parameter(args, configuration, 'plot', False)
   gridcount = get_parameter(args, configuration, 'gridcount', False)
@@ -113,6 +147,11 @@ def main(user_input=None):
   except AttributeError:
     sge = 'SGE_TASK_ID' in os.environ # python3
     
+  # all grid tasks would write the same signal store at once, corrupting it
+  if sge and store:
+    logger.error("The signals cannot be stored in a single file by several grid jobs, please remove --store !")
+    sys.exit()
+
   if sge:
     pos = int(os.environ['SGE_TASK_ID']) - 1
     if pos >= len(objects):
@@ -123,17 +162,30 @@ def main(user_input=None):
     print(len(objects))
     sys.exit()
 
+  # a lookup table would be rebuilt at each frame if the skin model is
+  # re-estimated from scratch at each frame: the faces are filtered directly
+  if lut_bits > 0 and skininit and skin_alpha == 0:
+    logger.warn("Not using a lookup table for the skin masks (the skin model is re-estimated at each frame)")
+    lut_bits = 0
+
+  # what the signals are computed from, for each threshold
+  hashes = [get_parameters_hash(dict(threshold=t, skininit=skininit, skin_alpha=skin_alpha, lut_bits=lut_bits))
+      for t in (thresholds if thresholds else [threshold])]
+
   # does the actual work - for every video in the available dataset,
   # extract the average color in both the mask area and in the backround,
   # and then correct face illumination by removing the global illumination
   for obj in objects:
 
-    # expected output face file
-    output = obj.make_path(skindir, '.hdf5')
+    # output directories: one per threshold if several are given
+    if thresholds:
+      outdirs = [os.path.join(skindir, 'threshold_{0}'.format(t)) for t in thresholds]
+    else:
+      outdirs = [skindir]
 
-    # if output exists and not overwriting, skip this file
-    if os.path.exists(output) and not overwrite:
-      logger.info("Skipping output file `%s': already exists, use --overwrite to force an overwrite", output)
+    # if output exists (and is up-to-date) and not overwriting, skip this file
+    if all([is_up_to_date(obj, outdir, h) for outdir, h in zip(outdirs, hashes)]) and not overwrite:
+      logger.info("Skipping output `%s': already exists, use --overwrite to force an overwrite", obj.path)
       continue
 
     # load the video sequence into a reader
@@ -147,7 +199,16 @@ def main(user_input=None):
 
     # average colors of the skin color 
     skin_filter = bob.ip.skincolorfilter.SkinColorFilter()
-    skin_colors = numpy.zeros((len(video), 3), dtype='float64')
+    skin_masker = skin_filter
+    if lut_bits > 0:
+      skin_masker = SkinColorLUT(skin_filter, threshold, lut_bits)
+    skin_model = None
+    if skininit and skin_alpha > 0:
+      skin_model = OnlineSkinColorModel(skin_filter, skin_alpha)
+    skin_colors = numpy.zeros((len(outdirs), len(video), 3), dtype='float64')
+
+    # the face is cropped in the same buffer for all frames
+    face_cropper = FaceCropper()
 
     ################
     ### LET'S GO ###
@@ -157,48 +218,64 @@ def main(user_input=None):
       logger.debug("Processing frame %d / %d...", i, len(video))
      
       facewidth = bounding_boxes[i].size[1]
-      face = crop_face(frame, bounding_boxes[i], facewidth)
+      face = face_cropper(frame, bounding_boxes[i], facewidth)
 
       # skin filter
-      if i == 0 or bool(skininit):
+      if skin_model is not None:
+        skin_model.update(face)
+      elif i == 0 or bool(skininit):
         skin_filter.estimate_gaussian_parameters(face)
         logger.debug("Skin color parameters:\nmean\n{0}\ncovariance\n{1}".format(skin_filter.mean, skin_filter.covariance))
-      skin_mask = skin_filter.get_skin_mask(face, threshold)
 
-      if plot and i == 0:
-        from matplotlib import pyplot
-        skin_mask_image = numpy.copy(face)
-        skin_mask_image[:, skin_mask] = 255
-        pyplot.imshow(numpy.rollaxis(numpy.rollaxis(skin_mask_image, 2),2))
-        pyplot.show()
-
-      if numpy.count_nonzero(skin_mask) != 0:
+      # threshold sweep: the skin probability map is computed once, and the
+      # average colors of the skin pixels are obtained for all thresholds at once
+      if thresholds:
+        probability = compute_skin_probability(face, skin_filter.mean, skin_filter.covariance_inverse)
+        counts, sums = compute_threshold_statistics(face, probability, thresholds)
         # green only
-        skin_colors[i] = compute_average_colors_mask(face, skin_mask)[1]
+        average_colors = sums[:, 1] / numpy.maximum(counts, 1)
       else:
-        logger.warn("No skin pixels detected in frame {0}, using previous value".format(i))
-        if i == 0:
-          skin_colors[i] = project_chrominance(128., 128., 128.)
+        skin_mask = skin_masker.get_skin_mask(face, threshold)
+        counts = [numpy.count_nonzero(skin_mask)]
+        if counts[0] != 0:
+          # green only
+          average_colors = [compute_average_colors_mask(face, skin_mask)[1]]
+
+        if plot and i == 0:
+          from matplotlib import pyplot
+          skin_mask_image = numpy.copy(face)
+          skin_mask_image[:, skin_mask] = 255
+          pyplot.imshow(numpy.rollaxis(numpy.rollaxis(skin_mask_image, 2),2))
+          pyplot.show()
+
+      for k in range(len(outdirs)):
+        if counts[k] != 0:
+          skin_colors[k, i] = average_colors[k]
         else:
-          skin_colors[i] = skin_colors[i-1]
+          logger.warn("No skin pixels detected in frame {0}, using previous value".format(i))
+          if i == 0:
+            skin_colors[k, i] = project_chrominance(128., 128., 128.)
+          else:
+            skin_colors[k, i] = skin_colors[k, i-1]
 
-    if plot:
-      from matplotlib import pyplot
+    for outdir, colors, parameters in zip(outdirs, skin_colors, hashes):
 
-      f, axarr = pyplot.subplots(3, sharex=True)
-      axarr[0].plot(range(skin_colors.shape[0]), skin_colors[:, 0], 'r')
-      axarr[0].set_title("Average red value of the skin pixels")
-      axarr[1].plot(range(skin_colors.shape[0]), skin_colors[:, 1], 'g')
-      axarr[1].set_title("Average green value of the skin pixels")
-      axarr[2].plot(range(skin_colors.shape[0]), skin_colors[:, 2], 'b')
-      axarr[2].set_title("Average blue value of the skin pixels")
+      if plot:
+        from matplotlib import pyplot
+
+        f, axarr = pyplot.subplots(3, sharex=True)
+        axarr[0].plot(range(colors.shape[0]), colors[:, 0], 'r')
+        axarr[0].set_title("Average red value of the skin pixels")
+        axarr[1].plot(range(colors.shape[0]), colors[:, 1], 'g')
+        axarr[1].set_title("Average green value of the skin pixels")
+        axarr[2].plot(range(colors.shape[0]), colors[:, 2], 'b')
+        axarr[2].set_title("Average blue value of the skin pixels")
 
-      pyplot.show()
+        pyplot.show()
 
-    # saves the data into an HDF5 file with a '.hdf5' extension
-    outdir = os.path.dirname(output)
-    if not os.path.exists(outdir): bob.io.base.create_directories_safe(outdir)
-    bob.io.base.save(skin_colors[:, 1], output)
-    logger.info("Output file saved to `%s'...", output)
+      # saves the data into an HDF5 file with a '.hdf5' extension (or into the store)
+      output = save_signal(colors[:, 1], obj, outdir, store=store, parameters=parameters)
+      logger.info("Output saved to `%s'...", output)
 
+  close_stores()
   return 0
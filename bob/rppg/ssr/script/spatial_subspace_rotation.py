@@ -8,7 +8,8 @@ Usage:
            [--protocol=<string>] [--subset=<string> ...] 
            [--verbose ...] [--plot]
            [--pulsedir=<path>]
-           [--threshold=<float>] [--skininit] 
+           [--threshold=<float>] [--skininit] [--skin-alpha=<float>]
+           [--lut-bits=<int>] [--thresholds=<list>] [--store]
            [--stride=<int>] [--start=<int>] [--end=<int>] 
            [--overwrite] [--gridcount]
           
@@ -29,6 +30,26 @@ Options:
                             pulse signal will be stored [default: pulse].
   --threshold=<float>       Threshold on the skin probability map [default: 0.5].
   --skininit                If you want to reinitialize the skin model at each frame.
+  --lut-bits=<int>          Number of bits per color channel of the lookup table
+                            used to get the skin masks. Zero means that no lookup
+                            table is used. With 8 bits, the masks are the same as
+                            the ones of the skin color filter; with less bits,
+                            they differ on dark pixels. Not used when the skin 
+                            model is re-estimated from scratch at each frame
+                            [default: 0].
+  --skin-alpha=<float>      With --skininit, the weight of the current frame in
+                            the online update of the skin model. Zero means that
+                            the model is re-estimated from scratch at each frame
+                            [default: 0.0].
+  --thresholds=<list>       Comma-separated list of thresholds on the skin
+                            probability map (e.g. 0.3,0.5,0.7). If given, the
+                            pulse signals for all thresholds are computed in a
+                            single pass on the video, and stored in the
+                            threshold_<value> sub-directories of the output
+                            directory [default: ].
+  --store                   Store the signals of all objects in a single file
+                            (signals.hdf5 in the output directories) instead of
+                            one file per object.
   -s, --start=<int>         Index of the starting frame [default: 0].
   -e, --end=<int>           Index of the ending frame. If set to zero, the
                             processing will be done to the last frame [default: 0].
@@ -62,6 +83,11 @@ from docopt import docopt
 
 from bob.extension.config import load
 from ...base.utils import get_parameter
+from ...base.utils import get_list
+from ...base.store_utils import get_parameters_hash
+from ...base.store_utils import is_up_to_date
+from ...base.store_utils import save_signal
+from ...base.store_utils import close_stores
 
 version = pkg_resources.require('bob.rppg.base')[0].version
 
@@ -70,8 +96,13 @@ import bob.io.video
 import bob.ip.color
 
 from ...base.utils import crop_face
+from ...base.skin_utils import SkinColorLUT
+from ...base.skin_utils import OnlineSkinColorModel
+from ..ssr_utils import skin_filter
 from ..ssr_utils import get_skin_pixels
+from ..ssr_utils import get_skin_correlations
 from ..ssr_utils import get_eigen
+from ..ssr_utils import get_eigen_from_correlation
 from ..ssr_utils import plot_eigenvectors
 from ..ssr_utils import build_P 
 
@@ -98,6 +129,10 @@ def main(user_input=None):
   end = get_parameter(args, configuration, 'end', 0)
   threshold = get_parameter(args, configuration, 'threshold', 0.5)
   skininit = get_parameter(args, configuration, 'skininit', False)
+  skin_alpha = get_parameter(args, configuration, 'skin_alpha', 0.0)
+  lut_bits = get_parameter(args, configuration, 'lut_bits', 0)
+  thresholds = get_list(get_parameter(args, configuration, 'thresholds', ''))
+  store = get_parameter(args, configuration, 'store', False)
   stride = get_parameter(args, configuration, 'stride', 61)
   overwrite = get_parameter(args, configuration, 'overwrite', False)
   plot = get_parameter(args, configuration, 'plot', False)
@@ -121,6 +156,11 @@ def main(user_input=None):
   except AttributeError:
     sge = 'SGE_TASK_ID' in os.environ # python3
     
+  # all grid tasks would write the same signal store at once, corrupting it
+  if sge and store:
+    logger.error("The signals cannot be stored in a single file by several grid jobs, please remove --store !")
+    sys.exit()
+
   if sge:
     pos = int(os.environ['SGE_TASK_ID']) - 1
     if pos >= len(objects):
@@ -130,15 +170,33 @@ def main(user_input=None):
   if gridcount:
     print(len(objects))
 
+  # a lookup table would be rebuilt at each frame if the skin model is
+  # re-estimated from scratch at each frame: the faces are filtered directly
+  if lut_bits > 0 and skininit and skin_alpha == 0:
+    logger.warn("Not using a lookup table for the skin masks (the skin model is re-estimated at each frame)")
+    lut_bits = 0
+
+  # the lookup table for skin masks (if asked for)
+  skin_lut = None
+  if lut_bits > 0:
+    skin_lut = SkinColorLUT(skin_filter, threshold, lut_bits)
+
+  # what the signals are computed from, for each threshold
+  hashes = [get_parameters_hash(dict(threshold=t, start=start, end=end, skininit=skininit, skin_alpha=skin_alpha, lut_bits=lut_bits, stride=stride))
+      for t in (thresholds if thresholds else [threshold])]
+
   # does the actual work 
   for obj in objects:
 
-    # expected output file
-    output = obj.make_path(pulsedir, '.hdf5')
+    # output directories: one per threshold if several are given
+    if thresholds:
+      outdirs = [os.path.join(pulsedir, 'threshold_{0}'.format(t)) for t in thresholds]
+    else:
+      outdirs = [pulsedir]
 
-    # if output exists and not overwriting, skip this file
-    if os.path.exists(output) and not overwrite:
-      logger.info("Skipping output file `%s': already exists, use --overwrite to force an overwrite", output)
+    # if output exists (and is up-to-date) and not overwriting, skip this file
+    if all([is_up_to_date(obj, outdir, h) for outdir, h in zip(outdirs, hashes)]) and not overwrite:
+      logger.info("Skipping output `%s': already exists, use --overwrite to force an overwrite", obj.path)
       continue
 
     # load the video sequence into a reader
@@ -165,12 +223,17 @@ def main(user_input=None):
     # the temporal stride
     temporal_stride = int(stride)
 
-    # the result -> the pulse signal 
-    output_data = numpy.zeros(nb_final_frames, dtype='float64')
+    # online estimation of the skin color model (if asked for)
+    skin_model = None
+    if skininit and skin_alpha > 0:
+      skin_model = OnlineSkinColorModel(skin_filter, skin_alpha)
+
+    # the result -> the pulse signal (for each threshold)
+    output_data = numpy.zeros((len(outdirs), nb_final_frames), dtype='float64')
 
     # store the eigenvalues and the eigenvectors at each frame 
-    eigenvalues = numpy.zeros((3, nb_final_frames), dtype='float64')
-    eigenvectors = numpy.zeros((3, 3, nb_final_frames), dtype='float64')
+    eigenvalues = numpy.zeros((len(outdirs), 3, nb_final_frames), dtype='float64')
+    eigenvectors = numpy.zeros((len(outdirs), 3, 3, nb_final_frames), dtype='float64')
 
     ################
     ### LET'S GO ###
@@ -182,65 +245,88 @@ def main(user_input=None):
 
         logger.debug("Processing frame %d/%d...", i, nb_final_frames)
 
+        # threshold sweep: get the correlation matrices of skin colored
+        # pixels for all thresholds at once
+        if thresholds:
+          counts, correlations = get_skin_correlations(frame, i, (counter == 0 or skininit), thresholds, bounding_boxes, skin_model=skin_model)
+
+          # no skin pixels detected for some thresholds: go back in time,
+          # as below, to get them in the current frame
+          if numpy.any(counts == 0):
+            logger.warn("No skin pixels detected in frame {0} for thresholds {1}".format(i, numpy.array(thresholds)[counts == 0]))
+          k = 1
+          while numpy.any(counts == 0):
+            missing = (counts == 0)
+            previous_counts, previous_correlations = get_skin_correlations(video[i-k], (i-k), skininit, thresholds, bounding_boxes, skin_frame=frame, skin_model=skin_model)
+            counts[missing] = previous_counts[missing]
+            correlations[missing] = previous_correlations[missing]
+            k += 1
+
+          for t in range(len(thresholds)):
+            eigenvalues[t, :, counter], eigenvectors[t, :, :, counter] = get_eigen_from_correlation(correlations[t])
+
         # get skin colored pixels
-        try:
-          if counter == 0:
-            # init skin parameters in any cases if it's the first frame
-            skin_pixels = get_skin_pixels(frame, i, True, threshold, bounding_boxes)
-          else:
-            skin_pixels = get_skin_pixels(frame, i, skininit, threshold, bounding_boxes)
-        except NameError:
-          if counter == 0:
-            skin_pixels = get_skin_pixels(frame, i, skininit, threshold)
-          else:
-            skin_pixels = get_skin_pixels(frame, i, skininit, threshold)
-        logger.debug("There are {0} skin pixels in this frame".format(skin_pixels.shape[1]))
+        else:
+          try:
+            if counter == 0:
+              # init skin parameters in any cases if it's the first frame
+              skin_pixels = get_skin_pixels(frame, i, True, threshold, bounding_boxes, skin_lut=skin_lut, skin_model=skin_model)
+            else:
+              skin_pixels = get_skin_pixels(frame, i, skininit, threshold, bounding_boxes, skin_lut=skin_lut, skin_model=skin_model)
+          except NameError:
+            if counter == 0:
+              skin_pixels = get_skin_pixels(frame, i, skininit, threshold, skin_lut=skin_lut, skin_model=skin_model)
+            else:
+              skin_pixels = get_skin_pixels(frame, i, skininit, threshold, skin_lut=skin_lut, skin_model=skin_model)
+          logger.debug("There are {0} skin pixels in this frame".format(skin_pixels.shape[1]))
         
-        # no skin pixels detected, generally due to no face detection
-        # go back in time to find a face, and use this bbox to retrieve skin pixels in current frame
-        if skin_pixels.shape[1] == 0:
-          logger.warn("No skin pixels detected in frame {0}".format(i))
-          k = 1
-          while skin_pixels.shape[1] <= 0:
+          # no skin pixels detected, generally due to no face detection
+          # go back in time to find a face, and use this bbox to retrieve skin pixels in current frame
+          if skin_pixels.shape[1] == 0:
+            logger.warn("No skin pixels detected in frame {0}".format(i))
+            k = 1
+            while skin_pixels.shape[1] <= 0:
             
-            try:
-              skin_pixels = get_skin_pixels(video[i-k], (i-k),  skininit, threshold, bounding_boxes, skin_frame=frame)
-            except NameError:
-              skin_pixels = get_skin_pixels(video[i-k], (i-k), skininit, threshold, skin_frame=frame)
+              try:
+                skin_pixels = get_skin_pixels(video[i-k], (i-k),  skininit, threshold, bounding_boxes, skin_frame=frame, skin_lut=skin_lut, skin_model=skin_model)
+              except NameError:
+                skin_pixels = get_skin_pixels(video[i-k], (i-k), skininit, threshold, skin_frame=frame, skin_lut=skin_lut, skin_model=skin_model)
             
-            k += 1
-          logger.warn("got skin pixels in frame {0}".format(i-k))
+              k += 1
+            logger.warn("got skin pixels in frame {0}".format(i-k))
 
-        # build c matrix and get eigenvectors and eigenvalues
-        eigenvalues[:, counter], eigenvectors[:, :, counter] = get_eigen(skin_pixels)
+          # build c matrix and get eigenvectors and eigenvalues
+          eigenvalues[0, :, counter], eigenvectors[0, :, :, counter] = get_eigen(skin_pixels)
 
-        # plot the cluster of skin pixels and eigenvectors (see Figure 1) 
-        if plot  and verbosity_level >= 2:
-          plot_eigenvectors(skin_pixels, eigenvectors[:, :, counter])
+          # plot the cluster of skin pixels and eigenvectors (see Figure 1) 
+          if plot  and verbosity_level >= 2:
+            plot_eigenvectors(skin_pixels, eigenvectors[0, :, :, counter])
 
         # build P and add it to the pulse signal
         if counter >= temporal_stride:
           tau = counter - temporal_stride
-          p = build_P(counter, stride, eigenvectors, eigenvalues)
-          output_data[tau:counter] += (p - numpy.mean(p)) 
+          for t in range(len(outdirs)):
+            p = build_P(counter, stride, eigenvectors[t], eigenvalues[t])
+            output_data[t, tau:counter] += (p - numpy.mean(p)) 
          
         counter += 1
 
       elif i > end_index :
         break
 
-    # plot the pulse signal
-    if plot:
-      import matplotlib.pyplot as plt
-      fig = plt.figure()
-      ax = fig.add_subplot(111)
-      ax.plot(range(nb_final_frames), output_data)
-      plt.show()
+    for outdir, pulse, parameters in zip(outdirs, output_data, hashes):
+
+      # plot the pulse signal
+      if plot:
+        import matplotlib.pyplot as plt
+        fig = plt.figure()
+        ax = fig.add_subplot(111)
+        ax.plot(range(nb_final_frames), pulse)
+        plt.show()
 
-    # saves the data into an HDF5 file with a '.hdf5' extension
-    outdir = os.path.dirname(output)
-    if not os.path.exists(outdir): bob.io.base.create_directories_safe(outdir)
-    bob.io.base.save(output_data, output)
-    logger.info("Output file saved to `%s'...", output)
+      # saves the data into an HDF5 file with a '.hdf5' extension (or into the store)
+      output = save_signal(pulse, obj, outdir, store=store, parameters=parameters)
+      logger.info("Output saved to `%s'...", output)
 
+  close_stores()
   return 0
@@ -8,7 +8,7 @@ Usage:
            [--protocol=<string>] [--subset=<string> ...] 
            [--pulsedir=<path>] 
            [--npoints=<int>] [--indent=<int>] [--quality=<float>] [--distance=<int>]
-           [--stride=<int>] 
+           [--stride=<int>] [--store]
            [--overwrite] [--verbose ...] [--plot] [--gridcount]
 
   %(prog)s (--help | -h)
@@ -31,6 +31,9 @@ Options:
   -e, --distance=<int>      Minimum distance between detected good features to
                             track [default: 10]
   --stride=<int>            Temporal stride [default: 61]
+  --store                   Store the signals of all objects in a single file
+                            (signals.hdf5 in the output directory) instead of
+                            one file per object.
   -O, --overwrite           By default, we don't overwrite existing files. The
                             processing will skip those so as to go faster. If you
                             still would like me to overwrite them, set this flag.
@@ -70,7 +73,11 @@ import numpy
 import bob.io.base
 import bob.ip.facedetect
 
-from ...base.utils import crop_face
+from ...base.utils import FaceCropper
+from ...base.store_utils import get_parameters_hash
+from ...base.store_utils import is_up_to_date
+from ...base.store_utils import save_signal
+from ...base.store_utils import close_stores
 
 from ...cvpr14.extract_utils import kp66_to_mask
 from ...cvpr14.extract_utils import get_good_features_to_track
@@ -110,6 +117,7 @@ def main(user_input=None):
   quality = get_parameter(args, configuration, 'quality', 0.01)
   distance = get_parameter(args, configuration, 'distance', 10)
   stride = get_parameter(args, configuration, 'stride', 61)
+  store = get_parameter(args, configuration, 'store', False)
   overwrite = get_parameter(args, configuration, 'overwrite', False)
   plot = get_parameter(args, configuration, 'plot', False)
   gridcount = get_parameter(args, configuration, 'gridcount', False)
@@ -132,6 +140,11 @@ def main(user_input=None):
   except AttributeError:
     sge = 'SGE_TASK_ID' in os.environ # python3
     
+  # all grid tasks would write the same signal store at once, corrupting it
+  if sge and store:
+    logger.error("The signals cannot be stored in a single file by several grid jobs, please remove --store !")
+    sys.exit()
+
   if sge:
     pos = int(os.environ['SGE_TASK_ID']) - 1
     if pos >= len(objects):
@@ -144,16 +157,16 @@ def main(user_input=None):
   # the temporal stride
   temporal_stride = stride
 
+  # what the signals are computed from
+  parameters = get_parameters_hash(dict(npoints=npoints, indent=indent, quality=quality, distance=distance, stride=stride))
+
   # does the actual work - for every video in the available dataset, 
   # extract the signals and dumps the results to the corresponding directory
   for obj in objects:
 
-    # expected output file
-    output = obj.make_path(pulsedir, '.hdf5')
-
-    # if output exists and not overwriting, skip this file
-    if (os.path.exists(output)) and not overwrite:
-      logger.info("Skipping output file `%s': already exists, use --overwrite to force an overwrite", output)
+    # if output exists (and is up-to-date) and not overwriting, skip this file
+    if is_up_to_date(obj, pulsedir, parameters) and not overwrite:
+      logger.info("Skipping output `%s': already exists, use --overwrite to force an overwrite", obj.path)
       continue
     
     # load video
@@ -171,6 +184,11 @@ def main(user_input=None):
     eigenvalues = numpy.zeros((3, nb_final_frames), dtype='float64')
     eigenvectors = numpy.zeros((3, 3, nb_final_frames), dtype='float64')
 
+    # the faces in the current and previous frames are cropped in
+    # their own buffers, re-used for the whole sequence
+    face_cropper = FaceCropper()
+    prev_face_cropper = FaceCropper()
+
     # loop on video frames
     for i, frame in enumerate(video):
       logger.debug("Processing frame %d/%d...", i+1, len(video))
@@ -191,7 +209,7 @@ def main(user_input=None):
         
         # define the face width for the whole sequence
         facewidth = bbox.size[1]
-        face = crop_face(frame, bbox, facewidth)
+        face = face_cropper(frame, bbox, facewidth)
         good_features = get_good_features_to_track(face,npoints, quality, distance, plot)
       else:
         # subsequent frames:
@@ -201,7 +219,7 @@ def main(user_input=None):
         # -> find the (affine) transformation relating previous corners with
         #    current corners
         # -> apply this transformation to the mask
-        face = crop_face(frame, prev_bb, facewidth)
+        face = face_cropper(frame, prev_bb, facewidth)
         good_features = track_features(prev_face, face, prev_features, plot)
         project = find_transformation(prev_features, good_features)
         if project is None: 
@@ -222,7 +240,7 @@ def main(user_input=None):
         prev_bb = bb
 
       
-      prev_face = crop_face(frame, prev_bb, facewidth)
+      prev_face = prev_face_cropper(frame, prev_bb, facewidth)
       prev_features = get_good_features_to_track(face, npoints, quality, distance, plot)
       if prev_features is None:
         logger.warn("Sequence {0}, frame {1} No features to track"  
@@ -266,10 +284,9 @@ def main(user_input=None):
       ax.plot(range(nb_final_frames), output_data)
       plt.show()
 
-    # saves the data into an HDF5 file with a '.hdf5' extension
-    outdir = os.path.dirname(output)
-    if not os.path.exists(outdir): bob.io.base.create_directories_safe(outdir)
-    bob.io.base.save(output_data, output)
-    logger.info("Output file saved to `%s'...", output)
+    # saves the data into an HDF5 file with a '.hdf5' extension (or into the store)
+    output = save_signal(output_data, obj, pulsedir, store=store, parameters=parameters)
+    logger.info("Output saved to `%s'...", output)
 
+  close_stores()
   return 0
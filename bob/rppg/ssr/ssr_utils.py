@@ -3,12 +3,15 @@
 
 import numpy
 import bob.ip.base
-from ..base.utils import crop_face
+from ..base.utils import FaceCropper
+from ..base.skin_utils import compute_skin_probability
+from ..base.skin_utils import compute_threshold_statistics
 
 from bob.ip.skincolorfilter import SkinColorFilter
 skin_filter = SkinColorFilter()
+face_cropper = FaceCropper()
 
-def get_skin_pixels(face_frame, index, skininit, threshold, bounding_boxes=None, skin_frame=None, plot=False):
+def get_skin_pixels(face_frame, index, skininit, threshold, bounding_boxes=None, skin_frame=None, plot=False, skin_lut=None, skin_model=None):
   """get a list of skin colored pixels inside the given frame.
     
   Parameters
@@ -35,6 +38,16 @@ def get_skin_pixels(face_frame, index, skininit, threshold, bounding_boxes=None,
   plot: bool
     Flag to plot the result of skin pixels detection
 
+  skin_lut: :py:class:`bob.rppg.base.skin_utils.SkinColorLUT`
+    The lookup table used to get the skin mask. It should
+    be built on the skin color filter of this module.
+    If not set, the skin color filter is used.
+
+  skin_model: :py:class:`bob.rppg.base.skin_utils.OnlineSkinColorModel`
+    The online estimation of the skin color model, used instead of
+    a full re-estimation when skininit is set. It should be built on
+    the skin color filter of this module.
+
   Returns
   -------
   skin_pixels: numpy.ndarray
@@ -49,11 +62,17 @@ def get_skin_pixels(face_frame, index, skininit, threshold, bounding_boxes=None,
   else:
     bbox, quality = bob.ip.facedetect.detect_single_face(face_frame)
 
-  face = crop_face(skin_frame, bbox, bbox.size[1])
+  face = face_cropper(skin_frame, bbox, bbox.size[1])
 
   if skininit:
-    skin_filter.estimate_gaussian_parameters(face)
-  skin_mask = skin_filter.get_skin_mask(face, threshold)
+    if skin_model is not None:
+      skin_model.update(face)
+    else:
+      skin_filter.estimate_gaussian_parameters(face)
+  if skin_lut is not None:
+    skin_mask = skin_lut.get_skin_mask(face, threshold)
+  else:
+    skin_mask = skin_filter.get_skin_mask(face, threshold)
   skin_pixels = face[:, skin_mask]
 
   if plot:
@@ -67,6 +86,74 @@ def get_skin_pixels(face_frame, index, skininit, threshold, bounding_boxes=None,
   skin_pixels = skin_pixels.astype('float64') / 255.0
   return skin_pixels
 
+def get_skin_correlations(face_frame, index, skininit, thresholds, bounding_boxes=None, skin_frame=None, skin_model=None):
+  """get the correlation matrices of skin colored pixels for several thresholds.
+
+  The skin probability map of the face is computed once, and the
+  statistics of the skin pixels are accumulated for all the thresholds
+  in the same pass (see
+  :py:func:`bob.rppg.base.skin_utils.compute_threshold_statistics`).
+
+  Parameters
+  ----------
+  face_frame: numpy.ndarray
+    The frame where the face has to be detected.
+
+  index: int
+    The index of the frame containing the face to be detected.
+
+  skininit: bool
+    Flag if you want the parameters of the skin model to be re-estimated.
+
+  thresholds: list of float 
+    The thresholds on the skin color probability (between [0, 1]).
+
+  bounding_boxes: list of :py:class:`bob.ip.facedetect.BoundingBox`
+    The face bounding boxes corresponding to the sequence.
+
+  skin_frame: numpy.ndarray
+    The frame where the skin pixels have to be retrieved.
+    If not set, face_frame will be used.
+
+  skin_model: :py:class:`bob.rppg.base.skin_utils.OnlineSkinColorModel`
+    The online estimation of the skin color model, used instead of
+    a full re-estimation when skininit is set. It should be built on
+    the skin color filter of this module.
+
+  Returns
+  -------
+  counts: numpy.ndarray
+    The number of skin pixels, for each threshold.
+
+  correlations: numpy.ndarray
+    The correlation matrix of the (normalized) RGB values of skin 
+    pixels, for each threshold. It is zero when there are no skin pixels.
+  
+  """
+  if skin_frame is None:
+    skin_frame = face_frame
+
+  if bounding_boxes: 
+    bbox = bounding_boxes[index]
+  else:
+    bbox, quality = bob.ip.facedetect.detect_single_face(face_frame)
+
+  face = face_cropper(skin_frame, bbox, bbox.size[1])
+
+  if skininit:
+    if skin_model is not None:
+      skin_model.update(face)
+    else:
+      skin_filter.estimate_gaussian_parameters(face)
+  probability = compute_skin_probability(face, skin_filter.mean, skin_filter.covariance_inverse)
+  counts, sums, products = compute_threshold_statistics(face, probability, thresholds, second_order=True)
+
+  # same normalization as in get_skin_pixels and get_eigen 
+  correlations = numpy.zeros_like(products)
+  found = counts > 0
+  correlations[found] = products[found] / (255.0 * 255.0 * counts[found, numpy.newaxis, numpy.newaxis])
+  return counts, correlations
+
 def get_eigen(skin_pixels):
   """build the C matrix, get eigenvalues and eigenvectors, sort them.
 
@@ -87,7 +174,25 @@ def get_eigen(skin_pixels):
   # build the correlation matrix
   c = numpy.dot(skin_pixels, skin_pixels.T)
   c = c / skin_pixels.shape[1]
+  return get_eigen_from_correlation(c)
 
+def get_eigen_from_correlation(c):
+  """get eigenvalues and eigenvectors of the C matrix, sort them.
+
+  Parameters
+  ----------
+  c: numpy.ndarray
+    The correlation matrix of the RGB values of skin-colored pixels.
+        
+  Returns
+  -------
+  eigenvalues: numpy.ndarray
+    The eigenvalues of the correlation matrix
+
+  eigenvectors: numpy.ndarray
+    The (sorted) eigenvectors of the correlation matrix
+
+  """
   # get eigenvectors and sort them according to eigenvalues (largest first)
   evals, evecs = numpy.linalg.eig(c)
   idx = evals.argsort()[::-1]   
@@ -37,6 +37,7 @@ setup(
       'bob_rppg_cvpr14_illumination.py = bob.rppg.cvpr14.script.illumination_rectification:main',
       'bob_rppg_cvpr14_motion.py = bob.rppg.cvpr14.script.motion_elimination:main',
       'bob_rppg_cvpr14_filter.py = bob.rppg.cvpr14.script.filter:main',
+      'bob_rppg_cvpr14_pipeline.py = bob.rppg.cvpr14.script.pipeline:main',
       'bob_rppg_chrom_pulse.py = bob.rppg.chrom.script.extract_pulse:main',
       'bob_rppg_chrom_pulse_from_mask.py = bob.rppg.chrom.script.extract_pulse_from_mask:main',
       'bob_rppg_ssr_pulse.py = bob.rppg.ssr.script.spatial_subspace_rotation:main',